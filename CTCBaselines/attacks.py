@@ -7,15 +7,15 @@ from cleverspeech.graph import Constraints
 from cleverspeech.graph import Graphs
 from cleverspeech.graph import Losses
 from cleverspeech.graph import Optimisers
-from cleverspeech.graph import Procedures
 from cleverspeech.graph import Outputs
 
 from cleverspeech.data import Feeds
 from cleverspeech.data.etl.batch_generators import get_standard_batch_generator
-from cleverspeech.data.Results import SingleFileWriter, SingleJsonDB
-from cleverspeech.eval import PerceptualStatsBatch
 from cleverspeech.utils.Utils import log, args
-from cleverspeech.utils.RuntimeUtils import AttackSpawner
+
+from experiments.Common.Batches import get_bucketed_batch_generator
+from experiments.Common.Procedures import FusedUpdateOnDecoding
+from experiments.Common.Runtime import execute
 
 # victim model
 from SecEval import VictimAPI as Victim
@@ -40,6 +40,11 @@ DECODING_STEP = 100
 NUMB_STEPS = DECODING_STEP ** 2
 BATCH_SIZE = 10
 
+# Output directory of a previous run (e.g. with a different loss) to take
+# initial perturbations from. None starts every attack from zero.
+WARM_START = None
+WARM_START_RESCALE = True
+
 # extreme run settings
 LOSS_UPDATE_THRESHOLD = 10.0
 KAPPA = 5.0
@@ -50,40 +55,6 @@ LOSSES = {
 }
 
 
-def execute(settings, attack_fn, batch_gen):
-
-    # set up the directory we'll use for results
-
-    if not os.path.exists(settings["outdir"]):
-        os.makedirs(settings["outdir"], exist_ok=True)
-
-    file_writer = SingleFileWriter(settings["outdir"])
-
-    # Write the current settings to "settings.json" file.
-
-    settings_db = SingleJsonDB(settings["outdir"])
-    settings_db.open("settings").put(settings)
-    log("Wrote settings.")
-
-    # Manage GPU memory and CPU processes usage.
-
-    attack_spawner = AttackSpawner(
-        gpu_device=settings["gpu_device"],
-        max_processes=settings["max_spawns"],
-        delay=settings["spawn_delay"],
-        file_writer=file_writer,
-    )
-
-    with attack_spawner as spawner:
-        for b_id, batch in batch_gen:
-            log("Running for Batch Number: {}".format(b_id), wrap=True)
-            spawner.spawn(settings, attack_fn, batch)
-
-    # Run the stats function on all successful examples once all attacks
-    # are completed.
-    PerceptualStatsBatch.batch_generate_statistic_file(settings["outdir"])
-
-
 def create_attack_graph(sess, batch, settings):
 
     feeds = Feeds.Attack(batch)
@@ -117,7 +88,7 @@ def create_attack_graph(sess, batch, settings):
     )
 
     attack.add_procedure(
-        Procedures.UpdateOnDecoding,
+        FusedUpdateOnDecoding,
         steps=settings["nsteps"],
         decode_step=settings["decode_step"]
     )
@@ -158,11 +129,13 @@ def ctc_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "loss": loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")  # {}.".format(run))
 
@@ -193,11 +166,13 @@ def ctc_v2_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "loss": loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")  # {}.".format(run))
 
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+from cleverspeech.data.etl.batch_generators import get_dense_batch_factory, \
+    get_sparse_batch_generator
+from cleverspeech.utils.Utils import log
+
+
+# Directory of the on-disk cache of whole batches shared by every experiment.
+# None runs the cleverspeech batch factories every time.
+BATCH_CACHE = None
+
+# Run the batch factories anyway and check their batches are identical to the
+# cached ones.
+BATCH_CACHE_CHECK = False
+
+# Settings the batch factories use to pick examples, targets and alignments.
+# Experiments which agree on these (and on the audio and targets files) share
+# cached batches, including whichever targets the batch factory picked for
+# each example the first time.
+BATCH_SETTINGS = (
+    "batch_size", "max_examples", "max_targets", "max_audio_length", "tokens",
+)
+
+FACTORIES = {
+    "dense": get_dense_batch_factory,
+    "sparse": get_sparse_batch_generator,
+}
+
+COMPLETE_FILE = "complete"
+
+
+def _file_stat(path):
+    # follows symlinks, so bucketed copies of a directory hash the same
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def cache_key(settings, kind):
+    """
+    Hash of the inputs of the batch factories: the batch factory kind, the
+    `BATCH_SETTINGS`, the targets file and every wav file of the input
+    directory.
+    """
+    indir = settings["audio_indir"]
+
+    key = {
+        "kind": kind,
+        "settings": {k: settings.get(k) for k in BATCH_SETTINGS},
+        "targets": _file_stat(settings["targets_path"]),
+        "audios": {
+            f: _file_stat(os.path.join(indir, f))
+            for f in sorted(os.listdir(indir)) if f.endswith(".wav")
+        },
+    }
+
+    encoded = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+def _batch_path(cache_dir, b_id):
+    return os.path.join(cache_dir, "batch_{}.pkl".format(b_id))
+
+
+def _cached_batches(cache_dir):
+
+    with open(os.path.join(cache_dir, COMPLETE_FILE), "r") as f:
+        b_ids = json.load(f)
+
+    for b_id in b_ids:
+        with open(_batch_path(cache_dir, b_id), "rb") as f:
+            yield b_id, pickle.load(f)
+
+
+def _caching_batches(batch_gen, cache_dir):
+
+    os.makedirs(cache_dir, exist_ok=True)
+    b_ids = list()
+
+    for b_id, batch in batch_gen:
+
+        with open(_batch_path(cache_dir, b_id), "wb") as f:
+            pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        b_ids.append(b_id)
+        yield b_id, batch
+
+    # only a complete pass of the batch factory is ever read back
+    with open(os.path.join(cache_dir, COMPLETE_FILE), "w") as f:
+        json.dump(b_ids, f)
+
+
+def _differences(cached, fresh, path=""):
+
+    if isinstance(fresh, dict):
+        if not isinstance(cached, dict) or set(cached) != set(fresh):
+            return [path or "."]
+        return [
+            d for k in fresh
+            for d in _differences(cached[k], fresh[k], "{}/{}".format(path, k))
+        ]
+
+    if hasattr(fresh, "__dict__"):
+        return _differences(vars(cached), vars(fresh), path)
+
+    try:
+        same = np.array_equal(np.asarray(cached), np.asarray(fresh))
+    except (TypeError, ValueError):
+        same = cached == fresh
+
+    return [] if same else [path or "."]
+
+
+def _checked_batches(cached, fresh):
+
+    cached, fresh = list(cached), list(fresh)
+
+    if [b_id for b_id, _ in cached] != [b_id for b_id, _ in fresh]:
+        raise ValueError(
+            "Cached batch ids {c} differ from the batch factory's {f}".format(
+                c=[b_id for b_id, _ in cached], f=[b_id for b_id, _ in fresh]
+            )
+        )
+
+    for (b_id, c_batch), (_, f_batch) in zip(cached, fresh):
+
+        differences = _differences(c_batch, f_batch)
+
+        if differences:
+            raise ValueError(
+                "Cached batch {b} differs from the batch factory's: {d}".format(
+                    b=b_id, d=differences
+                )
+            )
+
+    log("Cached batches are identical to the batch factory's.")
+
+    for item in fresh:
+        yield item
+
+
+def get_cached_batch_generator(settings, kind):
+    """
+    Batches from one of the cleverspeech batch factories, cached on disk the
+    first time they're generated. Later runs with the same inputs (see
+    `cache_key`) load the cached batches instead of running the batch factory
+    again.
+
+    Whole batches are cached, not individual alignments, so a batch factory
+    which picks targets at random picks them once: every later run with the
+    same inputs gets the same examples, targets and alignments in the same
+    batches.
+
+    :param settings: the experiment's settings dict. `batch_cache` is the
+            cache directory. With `batch_cache_check` the batch factory runs
+            anyway and its batches must be identical to the cached ones
+    :param kind: "dense" or "sparse"
+    :yield: (batch id, batch) tuples
+    """
+    cache_dir = os.path.join(settings["batch_cache"], cache_key(settings, kind))
+
+    if os.path.exists(os.path.join(cache_dir, COMPLETE_FILE)):
+
+        log("Loading cached {} batches from {}".format(kind, cache_dir))
+
+        if settings.get("batch_cache_check", BATCH_CACHE_CHECK):
+            return _checked_batches(
+                _cached_batches(cache_dir), FACTORIES[kind](settings)
+            )
+
+        return _cached_batches(cache_dir)
+
+    log("Caching {} batches in {}".format(kind, cache_dir))
+    return _caching_batches(FACTORIES[kind](settings), cache_dir)
+
+
+def get_cached_dense_batch_factory(settings):
+    """
+    `get_dense_batch_factory` which uses the batch cache when the
+    `batch_cache` setting is a directory.
+    """
+    if settings.get("batch_cache", BATCH_CACHE) is None:
+        return get_dense_batch_factory(settings)
+    return get_cached_batch_generator(settings, "dense")
+
+
+def get_cached_sparse_batch_generator(settings):
+    """
+    `get_sparse_batch_generator` which uses the batch cache when the
+    `batch_cache` setting is a directory.
+    """
+    if settings.get("batch_cache", BATCH_CACHE) is None:
+        return get_sparse_batch_generator(settings)
+    return get_cached_batch_generator(settings, "sparse")
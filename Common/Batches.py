@@ -0,0 +1,423 @@
+import copy
+
+import numpy as np
+
+from cleverspeech.utils.Utils import log
+
+
+# Maximum fraction of padding samples in the batch factory's batches before
+# their examples are regrouped by length. None disables bucketing (batches are
+# generated in the batch factory's own order).
+BUCKET_WASTE = None
+
+# Number of the batch factory's batches regrouped together, so only this many
+# batches are held in memory at once.
+BUCKET_WINDOW = 10
+
+# Padded per example arrays and the per example field holding each example's
+# real length along the padded axis. Padded arrays which aren't listed are
+# never truncated.
+LENGTH_FIELDS = {
+    ("audios", "padded_audio"): ("audios", "n_samples"),
+    ("targets", "indices"): ("targets", "lengths"),
+}
+
+# Values padded arrays are padded with. Anything not listed is zero padded.
+PAD_VALUES = dict()
+
+# Batch wide maximums of per example lengths, updated when examples are joined
+# into a new batch.
+MAX_FIELDS = {
+    ("audios", "max_samples"): ("audios", "n_samples"),
+}
+
+
+def _is_per_example(value, size):
+    if isinstance(value, np.ndarray):
+        return value.ndim >= 1 and value.shape[0] == size
+    return isinstance(value, (list, tuple)) and len(value) == size
+
+
+def per_example_fields(batch):
+    """
+    Find every value of a batch with one entry per example, e.g.
+    `batch.audios["padded_audio"]` or `batch.targets["phrases"]`.
+
+    :return: list of (attribute name, dict key or None) paths
+    """
+    paths = list()
+
+    for name, value in vars(batch).items():
+        if isinstance(value, dict):
+            for key, v in value.items():
+                if _is_per_example(v, batch.size):
+                    paths.append((name, key))
+
+        elif _is_per_example(value, batch.size):
+            paths.append((name, None))
+
+    return paths
+
+
+def _has_field(batch, path):
+    name, key = path
+    value = getattr(batch, name, None)
+    return value is not None and (key is None or key in value)
+
+
+def _get_field(batch, path):
+    name, key = path
+    value = getattr(batch, name)
+    return value if key is None else value[key]
+
+
+def _set_field(batch, path, value):
+    name, key = path
+    if key is None:
+        setattr(batch, name, value)
+    else:
+        getattr(batch, name)[key] = value
+
+
+def _real_length(batch, path, row):
+    """
+    Number of values of an example's padded array which aren't padding. For
+    arrays without a `LENGTH_FIELDS` entry that's the whole padded width.
+    """
+    length_path = LENGTH_FIELDS.get(path)
+
+    if length_path is None or not _has_field(batch, length_path):
+        return _get_field(batch, path).shape[1]
+
+    return int(_get_field(batch, length_path)[row])
+
+
+def _fit_row(src, path, row, width):
+    """
+    Pad or truncate an example from a padded array so it fits into another
+    batch's padded array of `width`, padding with the field's `PAD_VALUES`.
+
+    :return: the fitted row or None if it doesn't fit (truncation would
+            remove something other than padding)
+    """
+    length = _real_length(src, path, row)
+
+    if length > width:
+        return None
+
+    value = _get_field(src, path)[row][:length]
+
+    padding = [(0, width - value.shape[0])] + [(0, 0)] * (value.ndim - 1)
+    return np.pad(
+        value, padding, mode="constant", constant_values=PAD_VALUES.get(path, 0)
+    )
+
+
+def _fitted_example(dst, src, src_row):
+    """
+    Get every per example value of one example, fitted to the destination
+    batch's shapes.
+
+    :return: dict of field path -> value, or None if the example doesn't fit
+    """
+    values = dict()
+
+    for path in per_example_fields(dst):
+
+        dst_value = _get_field(dst, path)
+        src_value = _get_field(src, path)
+
+        if isinstance(dst_value, np.ndarray) and dst_value.ndim > 1:
+
+            if dst_value.shape[2:] != src_value.shape[2:]:
+                return None
+
+            value = _fit_row(src, path, src_row, dst_value.shape[1])
+
+            if value is None:
+                return None
+
+            values[path] = value
+
+        else:
+            values[path] = src_value[src_row]
+
+    return values
+
+
+def _set_example(dst, dst_row, values):
+
+    for path, value in values.items():
+
+        dst_value = _get_field(dst, path)
+
+        if isinstance(dst_value, tuple):
+            dst_value = list(dst_value)
+            _set_field(dst, path, dst_value)
+
+        dst_value[dst_row] = value
+
+
+def copy_example(dst, dst_row, src, src_row):
+    """
+    Copy one example of a batch into a row of another batch in place, padding
+    or truncating padded arrays to the destination's shapes.
+
+    :return: whether the example fit into the destination batch (if it didn't
+            the destination is unchanged)
+    """
+    values = _fitted_example(dst, src, src_row)
+
+    if values is None:
+        return False
+
+    _set_example(dst, dst_row, values)
+
+    return True
+
+
+def copy_batch(dst, src):
+    """
+    Copy every example of a batch into the first rows of another, at least as
+    large, batch in place.
+
+    :return: whether all the examples fit into the destination batch (if they
+            didn't the destination is unchanged)
+    """
+    if src.size > dst.size:
+        return False
+
+    examples = [_fitted_example(dst, src, row) for row in range(src.size)]
+
+    if any(values is None for values in examples):
+        return False
+
+    for row, values in enumerate(examples):
+        _set_example(dst, row, values)
+
+    return True
+
+
+def select_examples(batch, rows):
+    """
+    Copy a subset of examples from a batch into a new, smaller batch.
+    """
+    selected = copy.deepcopy(batch)
+
+    for path in per_example_fields(batch):
+        value = _get_field(batch, path)
+
+        if isinstance(value, np.ndarray):
+            _set_field(selected, path, value[rows])
+        else:
+            _set_field(selected, path, [value[r] for r in rows])
+
+    selected.size = len(rows)
+
+    return selected
+
+
+def join_examples(examples):
+    """
+    Build a new batch from examples of other batches. Every padded array is
+    padded to the longest of the new batch's examples (see `LENGTH_FIELDS`),
+    not to the longest of the batches they came from.
+
+    :param examples: list of (batch, row) tuples
+    :return: the new batch
+    :raises ValueError: if the examples' padded arrays can't be stacked
+    """
+    first, first_row = examples[0]
+    joined = select_examples(first, [first_row] * len(examples))
+
+    for path in per_example_fields(joined):
+
+        value = _get_field(joined, path)
+
+        if not isinstance(value, np.ndarray) or value.ndim < 2:
+            continue
+
+        width = max(_real_length(b, path, row) for b, row in examples)
+
+        _set_field(
+            joined,
+            path,
+            np.full(
+                (len(examples), width) + value.shape[2:],
+                PAD_VALUES.get(path, 0),
+                dtype=value.dtype,
+            )
+        )
+
+    for path, length_path in MAX_FIELDS.items():
+        if _has_field(joined, path) and _has_field(joined, length_path):
+            longest = max(_get_field(joined, length_path))
+            _set_field(joined, path, type(_get_field(joined, path))(longest))
+
+    for row, (batch, src_row) in enumerate(examples):
+        if not copy_example(joined, row, batch, src_row):
+            raise ValueError(
+                "Examples have padded arrays of different shapes."
+            )
+
+    return joined
+
+
+def bucket_batches(batches, batch_size):
+    """
+    Regroup the examples of a batch factory's batches so examples of a
+    similar length (and similar target length) are batched together. Each
+    example keeps the target the batch factory paired it with.
+
+    Examples are sorted longest first, so attacks that refill retired examples
+    (see `Procedures.RetireAndRefill`) build graphs that later, shorter,
+    examples will fit into.
+
+    :param batches: list of batches generated by the batch factory
+    :param batch_size: number of examples in a batch
+    :return: list of batches
+    """
+    def target_length(batch, row):
+        if not _has_field(batch, ("targets", "lengths")):
+            return 0
+        return int(batch.targets["lengths"][row])
+
+    examples = sorted(
+        (
+            (
+                int(batch.audios["n_samples"][row]),
+                target_length(batch, row),
+                b_idx,
+                row,
+            )
+            for b_idx, batch in enumerate(batches)
+            for row in range(batch.size)
+        ),
+        key=lambda x: (-x[0], -x[1])
+    )
+
+    return [
+        join_examples(
+            [(batches[b], row) for _, _, b, row in examples[i:i + batch_size]]
+        )
+        for i in range(0, len(examples), batch_size)
+    ]
+
+
+def padding_waste(batches):
+    """
+    :return: fraction of the batches' audio samples which are padding
+    """
+    real = sum(int(sum(b.audios["n_samples"])) for b in batches)
+    padded = sum(int(b.audios["max_samples"]) * b.size for b in batches)
+    return 1 - real / padded if padded else 0.0
+
+
+class PaddingReport(object):
+    def __init__(self, name):
+        """
+        Keeps track of how many of the samples in generated batches are real
+        audio and how many are padding.
+
+        :param name: which batches are being reported on, for the log
+        """
+        self.name = name
+        self.real = 0
+        self.padded = 0
+
+    def update(self, b_id, batch, verbose=True):
+        real = int(sum(batch.audios["n_samples"]))
+        padded = int(batch.audios["max_samples"]) * batch.size
+
+        self.real += real
+        self.padded += padded
+
+        if verbose:
+            log(
+                "{n} batch {b} padded / real samples: {p} / {r} ({x:.2f}x)".format(
+                    n=self.name, b=b_id, p=padded, r=real,
+                    x=padded / max(real, 1)
+                )
+            )
+
+    def summary(self):
+        log(
+            "{n} batches padded / real samples: {p} / {r} ({x:.2f}x)".format(
+                n=self.name, p=self.padded, r=self.real,
+                x=self.padded / max(self.real, 1)
+            )
+        )
+
+
+def _windows(batch_gen, size):
+    window = list()
+
+    for _, batch in batch_gen:
+        window.append(batch)
+
+        if len(window) == size:
+            yield window
+            window = list()
+
+    if window:
+        yield window
+
+
+def get_bucketed_batch_generator(batch_factory, settings):
+    """
+    Wrap one of the cleverspeech batch generators so examples of a similar
+    length are batched together, cutting down how much padding the victim
+    model, spectral losses and synthesisers have to process.
+
+    The batch factory runs as usual, so every (audio, target) pair is the
+    same as without bucketing. Its batches are taken `bucket_window` at a
+    time and, if they have more than `bucket_waste` padding, their examples
+    are regrouped by length (see `bucket_batches`).
+
+    The padded vs. real sample ratio of every batch is logged, along with the
+    overall ratio of the batch factory's batches (before) and the batches
+    generated here (after).
+
+    :param batch_factory: a batch generator function, e.g.
+            `get_standard_batch_generator`
+    :param settings: the experiment's settings dict. `bucket_waste` sets the
+            maximum fraction of padding before examples are regrouped (None
+            disables bucketing) and `bucket_window` how many batches are
+            regrouped together
+    :yield: (batch id, batch) tuples
+    """
+
+    before, after = PaddingReport("Generated"), PaddingReport("Bucketed")
+
+    max_waste = settings.get("bucket_waste", BUCKET_WASTE)
+    window_size = settings.get("bucket_window", BUCKET_WINDOW)
+
+    if max_waste is None:
+        for b_id, batch in batch_factory(settings):
+            before.update(b_id, batch)
+            yield b_id, batch
+
+        before.summary()
+        return
+
+    b_id = 0
+
+    for window in _windows(batch_factory(settings), window_size):
+
+        for batch in window:
+            before.update(b_id, batch, verbose=False)
+
+        if padding_waste(window) > max_waste:
+            n_batches = len(window)
+            window = bucket_batches(window, settings["batch_size"])
+            log("Regrouped {n} batches into {b} batches by length.".format(
+                n=n_batches, b=len(window)
+            ))
+
+        for batch in window:
+            after.update(b_id, batch)
+            yield b_id, batch
+            b_id += 1
+
+    before.summary()
+    after.summary()
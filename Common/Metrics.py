@@ -0,0 +1,119 @@
+import numpy as np
+
+
+def levenshtein(a, b):
+    """
+    Edit distance between two sequences (e.g. transcriptions).
+    """
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = list(range(len(b) + 1))
+
+    for i, x in enumerate(a, start=1):
+        current = [i]
+        for j, y in enumerate(b, start=1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (x != y),
+            ))
+        previous = current
+
+    return previous[-1]
+
+
+def batch_levenshtein(a, a_lengths, b, b_lengths):
+    """
+    Edit distances between pairs of padded token sequences, for a whole batch
+    at once.
+
+    Rows of the dynamic programming table are calculated for every pair at
+    the same time. Within a row the insertion chain is resolved with a
+    running minimum: d[i, j] = j + min over k <= j of (t[k] - k), where t
+    holds the deletion and substitution costs.
+
+    :param a: padded token indices [b, n]
+    :param a_lengths: length of each sequence in `a` [b]
+    :param b: padded token indices [b, m]
+    :param b_lengths: length of each sequence in `b` [b]
+    :return: edit distances [b]
+    """
+    a, b = np.asarray(a), np.asarray(b)
+    a_lengths = np.asarray(a_lengths)
+    b_lengths = np.asarray(b_lengths)
+
+    size, n = a.shape
+    m = b.shape[1]
+    rows = np.arange(size)
+
+    j = np.arange(m + 1)
+    previous = np.tile(j, (size, 1))
+
+    distances = previous[rows, b_lengths].copy()
+
+    for i in range(1, n + 1):
+
+        cost = a[:, i - 1, None] != b
+
+        t = np.empty_like(previous)
+        t[:, 0] = i
+        t[:, 1:] = np.minimum(previous[:, 1:] + 1, previous[:, :-1] + cost)
+
+        current = np.minimum.accumulate(t - j, axis=1) + j
+
+        done = a_lengths == i
+        distances[done] = current[done, b_lengths[done]]
+
+        previous = current
+
+    return distances
+
+
+def encode(hypotheses, references, level="char"):
+    """
+    Encode pairs of transcriptions as padded integer arrays.
+
+    :param level: "char" for characters or "word" for words
+    :return: (hypotheses, hypothesis lengths, references, reference lengths)
+    """
+    if level == "word":
+        hypotheses = [h.split() for h in hypotheses]
+        references = [r.split() for r in references]
+    elif level != "char":
+        raise ValueError("Unknown edit distance level: {}".format(level))
+
+    vocab = dict()
+
+    def pad(sequences):
+        lengths = np.asarray([len(s) for s in sequences], dtype=np.int64)
+        padded = np.full([len(sequences), max(lengths.max(initial=0), 1)], -1)
+        for row, s in enumerate(sequences):
+            padded[row, :len(s)] = [vocab.setdefault(x, len(vocab)) for x in s]
+        return padded, lengths
+
+    return pad(hypotheses) + pad(references)
+
+
+def edit_distances(hypotheses, references, level="char"):
+    """
+    Character or word level edit distances between batches of transcriptions.
+    """
+    if len(hypotheses) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    return batch_levenshtein(*encode(hypotheses, references, level=level))
+
+
+def error_rates(hypotheses, references, level="char"):
+    """
+    Character (CER) or word (WER) error rates -- edit distances divided by
+    the reference lengths.
+    """
+    if len(hypotheses) == 0:
+        return np.zeros(0)
+
+    encoded = encode(hypotheses, references, level=level)
+    reference_lengths = encoded[3]
+
+    return batch_levenshtein(*encoded) / np.maximum(reference_lengths, 1)
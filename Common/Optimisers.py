@@ -0,0 +1,223 @@
+import numpy as np
+import tensorflow as tf
+
+from cleverspeech.graph.Optimisers import AdamOptimiser
+from cleverspeech.utils.Utils import lcomp
+
+
+def per_example(value, size, name):
+    """
+    Non-trainable [size] variable for a setting which can be a single value or
+    one value per example. Refilled examples are reset to these values too
+    (see `Procedures.RetireAndRefill`).
+    """
+    values = np.broadcast_to(
+        np.asarray(value, dtype=np.float32), [size]
+    ).copy()
+
+    return tf.Variable(values, trainable=False, dtype=tf.float32, name=name)
+
+
+def _per_row(value, rank):
+    # reshape [b] -> [b, 1, ...] so it broadcasts against a variable's rows
+    return tf.reshape(value, [-1] + [1] * (rank - 1))
+
+
+def length_mask(lengths, max_samples, var):
+    """
+    Mask of the entries of an optimisation variable which belong to real audio
+    rather than padding. The second dimension of the variable is assumed to
+    span the padded audio, i.e. samples or synthesis frames.
+
+    :param lengths: number of samples of each example [b]
+    :param max_samples: number of samples of the padded audio
+    :param var: the optimisation variable [b, n, ...]
+    :return: mask broadcastable to the variable's shape, or None for
+            variables with one value per example
+    """
+    shape = var.shape.as_list()
+
+    if len(shape) < 2:
+        return None
+
+    n = shape[1]
+    valid = tf.cast(
+        tf.ceil(tf.cast(lengths, tf.float32) * n / max_samples), tf.int32
+    )
+    mask = tf.sequence_mask(valid, maxlen=n, dtype=tf.float32)
+
+    return tf.reshape(mask, [-1, n] + [1] * (len(shape) - 2))
+
+
+class BatchwiseAdamOptimiser(AdamOptimiser):
+    """
+    Adam with separate state for every example in a batch, so padding and the
+    other examples in a batch don't affect how an example is optimised.
+
+    - `learning_rate` and `epsilon` can be one value per example.
+    - each example has its own step counter for bias correction, which starts
+      from zero again when the example is refilled.
+    - moments are only updated for the entries of an optimisation variable
+      covering an example's real audio, so padded entries are never moved.
+    """
+    def create_optimiser(self):
+
+        batch = self.attack.batch
+        size = batch.size
+        max_samples = int(batch.audios["max_samples"])
+
+        self.learning_rates = per_example(
+            self.learning_rate, size, "batchwise_adam_lr"
+        )
+        self.epsilons = per_example(
+            self.epsilon, size, "batchwise_adam_epsilon"
+        )
+        self.steps = per_example(0, size, "batchwise_adam_steps")
+
+        lengths = getattr(self.attack.graph, "lengths", None)
+
+        if lengths is None:
+            self.lengths = tf.placeholder_with_default(
+                np.asarray(batch.audios["n_samples"], dtype=np.int32),
+                shape=[size],
+                name="batchwise_adam_lengths"
+            )
+            lengths = self.lengths
+
+        opt_vars = self.attack.graph.opt_vars
+
+        grads = tf.gradients(
+            self.attack.loss_fn,
+            opt_vars,
+            colocate_gradients_with_ops=True,
+        )
+        assert None not in grads
+
+        step = self.steps.assign_add(tf.ones([size]))
+
+        self.variables = [self.learning_rates, self.epsilons, self.steps]
+        updates = list()
+
+        for var, grad in zip(opt_vars, grads):
+
+            rank = len(var.shape.as_list())
+
+            m = tf.Variable(
+                tf.zeros(var.shape), trainable=False, name="batchwise_adam_m"
+            )
+            v = tf.Variable(
+                tf.zeros(var.shape), trainable=False, name="batchwise_adam_v"
+            )
+            self.variables += [m, v]
+
+            mask = length_mask(lengths, max_samples, var)
+            if mask is None:
+                mask = tf.ones_like(var)
+
+            m_t = self.beta1 * m + (1 - self.beta1) * grad
+            v_t = self.beta2 * v + (1 - self.beta2) * tf.square(grad)
+
+            m_t = m + mask * (m_t - m)
+            v_t = v + mask * (v_t - v)
+
+            t = _per_row(step, rank)
+            m_hat = m_t / (1 - tf.pow(self.beta1, t))
+            v_hat = v_t / (1 - tf.pow(self.beta2, t))
+
+            lr = _per_row(self.learning_rates, rank)
+            eps = _per_row(self.epsilons, rank)
+
+            delta = mask * lr * m_hat / (tf.sqrt(v_hat) + eps)
+
+            updates += [
+                m.assign(m_t), v.assign(v_t), var.assign_sub(delta)
+            ]
+
+        self.train = tf.group(*updates)
+
+    def extra_feeds(self, batch):
+        if not hasattr(self, "lengths"):
+            return dict()
+        return {
+            self.lengths: np.asarray(batch.audios["n_samples"], dtype=np.int32)
+        }
+
+
+def first_loss_grads(attack):
+    """
+    Upstream gradients given by the attack's first loss (its `grads`
+    attribute), or None if it doesn't give any.
+    """
+    return getattr(attack.loss[0], "grads", None)
+
+
+def example_grad_norms(grad_var):
+    """
+    L2 norm of the gradients for each example, over all optimisation
+    variables.
+
+    :param grad_var: list of (gradient, variable) tuples
+    :return: norms [b]
+    """
+    squares = [
+        tf.reduce_sum(tf.square(g), axis=list(range(1, g.shape.ndims)))
+        for g, _ in grad_var
+    ]
+    return tf.sqrt(tf.add_n(squares))
+
+
+class CustomGradientOptimiser(AdamOptimiser):
+    def __init__(self, attack, *args, grad_loss=first_loss_grads, optimizer_fn=None, **kwargs):
+        """
+        Optimiser which backpropagates custom upstream gradients (e.g. ones a
+        loss calculated itself) through any `tf.train.Optimizer`.
+
+        The per example gradient norms of every step are registered as the
+        "grad_norm" step fetch, so procedures with `FusedFetches` fetch them
+        in the same session run as the optimisation step.
+
+        :param grad_loss: function of the attack returning the gradients of
+                `attack.loss_fn` to backpropagate, or None to use its own
+                gradients
+        :param optimizer_fn: function of the learning rate returning a
+                `tf.train.Optimizer`. None uses Adam with this optimiser's
+                beta1, beta2 and epsilon.
+        """
+        self.grad_loss_fn = grad_loss
+        self.optimizer_fn = optimizer_fn
+
+        super().__init__(attack, *args, **kwargs)
+
+    def build_optimizer(self):
+
+        if self.optimizer_fn is not None:
+            return self.optimizer_fn(self.learning_rate)
+
+        return tf.train.AdamOptimizer(
+            learning_rate=self.learning_rate,
+            beta1=self.beta1,
+            beta2=self.beta2,
+            epsilon=self.epsilon,
+        )
+
+    def create_optimiser(self):
+
+        self.optimizer = self.build_optimizer()
+
+        grad_loss = None
+        if self.grad_loss_fn is not None:
+            grad_loss = self.grad_loss_fn(self.attack)
+
+        grad_var = self.optimizer.compute_gradients(
+            self.attack.loss_fn,
+            self.attack.graph.opt_vars,
+            colocate_gradients_with_ops=True,
+            grad_loss=grad_loss,
+        )
+        assert None not in lcomp(grad_var, i=0)
+
+        self.grad_norms = example_grad_norms(grad_var)
+        self.step_fetches = {"grad_norm": self.grad_norms}
+
+        self.train = self.optimizer.apply_gradients(grad_var)
+        self.variables = self.optimizer.variables()
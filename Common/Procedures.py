@@ -0,0 +1,1023 @@
+import os
+import queue
+import time
+import uuid
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from cleverspeech.graph import Procedures
+from cleverspeech.utils.Utils import log
+
+from experiments.Common.Batches import copy_batch, copy_example, \
+    select_examples
+from experiments.Common.Metrics import edit_distances
+
+
+POLL_SECONDS = 0.5
+
+
+class FusedFetches(object):
+    """
+    Procedure mixin that fetches extra per-step tensors in the same session run
+    as the optimiser's training op, instead of separate runs of the whole
+    forward graph every time something wants to read them.
+
+    Register tensors once with `add_step_fetches` (e.g. when an `Outputs` class
+    is created) and read them with `get_fetched`. The values come from the
+    forward pass of the most recent optimisation step, so they're one update
+    behind the current deltas. Anything in the optimiser's `step_fetches` dict
+    (e.g. gradient norms) is registered automatically.
+    """
+    def __init__(self, attack, *args, **kwargs):
+
+        self.step_fetches = OrderedDict()
+        self.fetched = dict()
+
+        self.add_step_fetches(**getattr(attack.optimiser, "step_fetches", {}))
+
+        super().__init__(attack, *args, **kwargs)
+
+    def add_step_fetches(self, **tensors):
+        """
+        :param tensors: name -> tensor to fetch with every optimisation step.
+        """
+        self.step_fetches.update(tensors)
+
+    def tf_run(self, tf_variables):
+
+        is_train_step = tf_variables is self.attack.optimiser.train
+
+        if not is_train_step or not self.step_fetches:
+            return super().tf_run(tf_variables)
+
+        names = list(self.step_fetches.keys())
+
+        results = super().tf_run(
+            [tf_variables] + [self.step_fetches[n] for n in names]
+        )
+        self.fetched = dict(zip(names, results[1:]))
+
+        return results[0]
+
+    def get_fetched(self, *names):
+        """
+        Get the values of registered tensors for the whole batch. Falls back to
+        a single session run for anything that hasn't been fetched yet (i.e.
+        before the first optimisation step).
+
+        :param names: names the tensors were registered with
+        :return: list of numpy arrays, one per name
+        """
+
+        missing = [n for n in names if n not in self.fetched]
+
+        if missing:
+            values = super().tf_run([self.step_fetches[n] for n in missing])
+            self.fetched.update(zip(missing, values))
+
+        return [self.fetched[n] for n in names]
+
+
+def refeed(attack):
+    """
+    Recreate an attack's feeds from its (modified) batch. Graph, optimiser and
+    loss objects can define `extra_feeds(batch)` to feed any values they built
+    from the batch that aren't in the standard feeds (e.g. per example lengths).
+    """
+    attack.create_feeds()
+
+    for obj in [attack.graph, attack.optimiser] + list(attack.loss):
+        if hasattr(obj, "extra_feeds"):
+            attack.feeds.attack.update(obj.extra_feeds(attack.batch))
+
+
+def _is_batch_values(value, size):
+    """
+    Whether a constant has a value for each example, i.e. it has a row per
+    example and isn't the same value everywhere (like zeros).
+    """
+    if value.ndim < 1 or value.shape[0] != size or value.size == 0:
+        return False
+    return not np.all(value == value.flat[0])
+
+
+def stale_batch_constants(attack):
+    """
+    Find constants in the attack's graph with a value for each example, e.g.
+    `batch.audios["ds_feats"]` passed straight to a tf op, a variable's
+    initial value computed from the batch with numpy (like a pitch track) or
+    values assigned to a variable once it's been created. Swapping examples
+    into the batch doesn't change them, so new examples would be optimised
+    and reset with the old examples' values.
+
+    Constants which are the same value everywhere don't count, and neither do
+    defaults of `tf.placeholder_with_default` as long as whatever made the
+    placeholder feeds it with `extra_feeds` (see `refeed`). Any constant with
+    a row per example is counted, so a graph can be refused because of a
+    constant that only happens to have that shape.
+
+    :return: list of constant op names
+    """
+    size = attack.batch.size
+    stale = list()
+
+    for op in attack.sess.graph.get_operations():
+
+        if op.type != "Const":
+            continue
+
+        consumers = [c.type for c in op.outputs[0].consumers()]
+        if consumers and all(c == "PlaceholderWithDefault" for c in consumers):
+            continue
+
+        # only read the values of constants with a per example shape (the
+        # victim model's weights can be constants too)
+        shape = op.outputs[0].shape.as_list()
+        if not shape or shape[0] != size:
+            continue
+
+        if _is_batch_values(tf.make_ndarray(op.get_attr("value")), size):
+            stale.append(op.name)
+
+    return stale
+
+
+def reassigned_variables(attack):
+    """
+    Find non-trainable per example variables whose values no longer match
+    their initial values, e.g. bounds or masks created as zeros and then
+    assigned the batch's values. Resetting them for a swapped in example
+    would give it the zeros instead of its own values. Only meaningful
+    before the first optimisation step.
+
+    :return: list of variable names
+    """
+    trainable = set(tf.trainable_variables())
+    variables = [v for v in example_variables(attack) if v not in trainable]
+
+    if not variables:
+        return list()
+
+    current = attack.sess.run(variables)
+    initial = attack.sess.run(
+        [v.initial_value for v in variables], feed_dict=attack.feeds.attack
+    )
+
+    return [
+        var.op.name for var, value, init in zip(variables, current, initial)
+        if not np.array_equal(value, init)
+    ]
+
+
+def check_refeedable(attack):
+    """
+    :raises ValueError: if the graph holds any per example values as
+            constants (see `stale_batch_constants`) or in variables that were
+            assigned after they were initialised (see `reassigned_variables`)
+    """
+    stale = stale_batch_constants(attack)
+
+    if stale:
+        raise ValueError(
+            "Graph holds per example values as constants, so examples can't "
+            "be swapped into it: {}".format(stale)
+        )
+
+    reassigned = reassigned_variables(attack)
+
+    if reassigned:
+        raise ValueError(
+            "Graph assigns per example values to variables after they're "
+            "initialised, so swapped in examples can't be reset: {}".format(
+                reassigned
+            )
+        )
+
+
+def example_variables(attack):
+    """
+    Variables with one row per example that need resetting when an example is
+    swapped out -- the optimisation variables, the optimiser's slots for them
+    and any non-trainable per example variables (e.g. constraint bounds).
+    """
+    size = attack.batch.size
+    opt_vars = list(attack.graph.opt_vars)
+    trainable = set(tf.trainable_variables())
+
+    variables = list()
+
+    for var in tf.global_variables():
+        shape = var.shape.as_list()
+
+        if not shape or shape[0] != size:
+            continue
+
+        if var in opt_vars or var not in trainable:
+            variables.append(var)
+
+    return variables
+
+
+class RefillQueue(object):
+    def __init__(self, batches):
+        """
+        Examples waiting to replace retired examples in running attacks.
+
+        Items on the queue are (batch id, batch, rejected by, token) tuples,
+        ending with a single None. Examples that don't fit into this process'
+        graph are put back on the queue as a new batch, marked as rejected by
+        this process so they're left for another process (or the parent
+        process once all attacks have finished).
+
+        :param batches: a multiprocessing queue shared with the parent
+        """
+        self.batches = batches
+        self.pending = list()
+        self.exhausted = False
+        self.pid = os.getpid()
+
+    def _next_item(self, block):
+
+        seen = set()
+
+        while not self.exhausted:
+
+            try:
+                item = self.batches.get(block=block)
+            except queue.Empty:
+                return None
+
+            if item is None:
+                # leave the end marker for the other processes
+                self.batches.put(None)
+                self.exhausted = True
+                return None
+
+            _, _, rejected_by, token = item
+
+            if self.pid not in rejected_by:
+                return item
+
+            self.batches.put(item)
+
+            # only our own rejects are left on the queue
+            if token in seen:
+                if not block:
+                    return None
+                time.sleep(POLL_SECONDS)
+
+            seen.add(token)
+
+        return None
+
+    def get(self, block):
+        """
+        :param block: wait for an example if none are available right now
+        :return: (batch id, batch, row, rejected by) of the next example or
+                None
+        """
+        if not self.pending:
+
+            item = self._next_item(block)
+
+            if item is None:
+                return None
+
+            b_id, batch, rejected_by, _ = item
+            self.pending = [
+                (b_id, batch, row, rejected_by) for row in range(batch.size)
+            ]
+
+        return self.pending.pop(0)
+
+    def get_batch(self):
+        """
+        Wait for the next whole batch.
+
+        :return: (batch id, batch, rejected by, token) or None
+        """
+        return self._next_item(block=True)
+
+    def reject(self, example):
+        b_id, batch, row, rejected_by = example
+        self.batches.put(
+            (
+                b_id,
+                select_examples(batch, [row]),
+                rejected_by | {self.pid},
+                uuid.uuid4().hex,
+            )
+        )
+
+    def reject_batch(self, item):
+        b_id, batch, rejected_by, _ = item
+        self.batches.put(
+            (b_id, batch, rejected_by | {self.pid}, uuid.uuid4().hex)
+        )
+
+
+class RetireAndRefill(object):
+    """
+    Procedure mixin that retires examples once they've succeeded a number of
+    times (or used up their own step budget) and replaces them with new
+    examples from a `RefillQueue`, so the batch keeps doing useful work
+    instead of waiting on a few stragglers.
+
+    Does nothing unless `enable_refill` is called. When it is, `steps` becomes
+    the step budget for each example rather than the whole batch, and the
+    attack runs until every slot has been retired and there are no more
+    examples to refill with.
+
+    `enable_reuse` turns the attack into a persistent worker instead. Once the
+    procedure has finished a batch, the next whole batch from the queue is
+    loaded into the existing graph and the procedure runs again, so the victim
+    model, losses and optimiser are only built once per process.
+
+    Both run inside the procedure's own loop. Examples are swapped between
+    the results it yields, `steps_rule` keeps the loop going while there's
+    work left and `tf_run` counts each example's steps.
+
+    The graph isn't rebuilt, so new examples must fit into the batch's padded
+    shapes (anything else is put back on the queue). Swapped in examples'
+    per example variables are reset to their initial values, so anything the
+    graph builds from the batch -- including variables' initial values -- has
+    to be fed (see `refeed`). Graphs which hold any per example values as
+    constants are refused (see `check_refeedable`).
+    """
+    def __init__(self, attack, *args, **kwargs):
+
+        self.refill = None
+        self.reuse = False
+        self.steps_per_example = kwargs.get("steps")
+
+        super().__init__(attack, *args, **kwargs)
+
+    def enable_refill(self, refill, retire_after=1, example_steps=None):
+        """
+        :param refill: a `RefillQueue`
+        :param retire_after: retire an example after this many successful
+                decodings
+        :param example_steps: optimisation steps an example gets before it's
+                considered hopeless and retired (default: the procedure's
+                `steps`)
+        :raises ValueError: if the graph can't be refilled (see
+                `check_refeedable`)
+        """
+        check_refeedable(self.attack)
+
+        size = self.attack.batch.size
+
+        self.refill = refill
+        self.retire_after = retire_after
+
+        if example_steps is not None:
+            self.steps_per_example = example_steps
+
+        self.live = np.ones(size, dtype=bool)
+        self.example_steps = np.zeros(size, dtype=np.int64)
+        self.successes = np.zeros(size, dtype=np.int64)
+        self.reset_vars = example_variables(self.attack)
+
+    def enable_reuse(self, refill):
+        """
+        :param refill: a `RefillQueue` to take new batches from
+        :raises ValueError: if the graph can't take new batches (see
+                `check_refeedable`)
+        """
+        check_refeedable(self.attack)
+
+        self.refill = refill
+        self.reuse = True
+        self.live = np.ones(self.attack.batch.size, dtype=bool)
+        self.reset_vars = example_variables(self.attack)
+
+    def steps_rule(self):
+        # with refill the procedure's steps are each example's own budget, so
+        # it keeps going while any example is live or could be refilled.
+        if self.refill is None or self.reuse:
+            return super().steps_rule()
+        return self.live.any() or not self.refill.exhausted
+
+    def tf_run(self, tf_variables):
+
+        is_train_step = tf_variables is self.attack.optimiser.train
+
+        result = super().tf_run(tf_variables)
+
+        if is_train_step and self.refill is not None and not self.reuse:
+            self.example_steps[self.live] += 1
+
+        return result
+
+    def run(self):
+        if self.refill is None:
+            return super().run()
+        elif self.reuse:
+            return self.run_with_reuse()
+        return self.run_with_refill()
+
+    def run_with_reuse(self):
+
+        while True:
+
+            for results in super().run():
+
+                # a smaller batch doesn't use every row of the graph
+                results["data"] = [
+                    d for d in results["data"] if self.live[d["idx"]]
+                ]
+
+                yield results
+
+            if not self.next_batch():
+                break
+
+    def next_batch(self):
+        """
+        Load the next batch from the queue into the existing graph.
+
+        :return: whether there was another batch that fit into the graph
+        """
+        start = time.time()
+
+        while True:
+
+            item = self.refill.get_batch()
+
+            if item is None:
+                return False
+
+            b_id, batch, _, _ = item
+
+            if copy_batch(self.attack.batch, batch):
+                break
+
+            self.refill.reject_batch(item)
+
+        rows = np.arange(self.attack.batch.size)
+
+        refeed(self.attack)
+        self.reset_examples(rows)
+
+        self.live[:] = rows < batch.size
+        self.current_step = 0
+
+        self.fetched = dict()
+
+        log("Loaded Batch Number {b} into the existing graph in {t:.2f}s.".format(
+            b=b_id, t=time.time() - start
+        ))
+
+        return True
+
+    def run_with_refill(self):
+
+        for results in super().run():
+
+            results["data"] = [
+                d for d in results["data"] if self.live[d["idx"]]
+            ]
+
+            # results get written while we're suspended here, so only swap
+            # examples out once we're resumed, before the next step.
+            yield results
+
+            self.retire(results["data"])
+            self.fill_slots(block=not self.live.any())
+
+    def retire(self, data):
+
+        for d in data:
+            if d["success"]:
+                self.successes[d["idx"]] += 1
+
+        succeeded = self.successes >= self.retire_after
+        hopeless = self.example_steps >= self.steps_per_example
+
+        for idx in np.where(self.live & (succeeded | hopeless))[0]:
+            log(
+                "Retired example {i} after {n} steps ({r}).".format(
+                    i=idx,
+                    n=self.example_steps[idx],
+                    r="succeeded" if succeeded[idx] else "step budget",
+                )
+            )
+            self.live[idx] = False
+
+    def fill_slots(self, block=False):
+
+        filled = list()
+
+        for idx in np.where(~self.live)[0]:
+
+            example = self.refill.get(block=block and not filled)
+
+            while example is not None:
+
+                _, batch, row, _ = example
+
+                if copy_example(self.attack.batch, idx, batch, row):
+                    filled.append(idx)
+                    break
+
+                self.refill.reject(example)
+                example = self.refill.get(block=block and not filled)
+
+            if example is None:
+                break
+
+        if not filled:
+            return
+
+        refeed(self.attack)
+        self.reset_examples(filled)
+
+        self.live[filled] = True
+        self.example_steps[filled] = 0
+        self.successes[filled] = 0
+
+        # anything cached for the previous examples is stale now
+        self.fetched = dict()
+
+        log("Refilled example slots {}.".format(filled))
+
+    def reset_examples(self, rows):
+        """
+        Reset the per example variables for the given rows to their initial
+        values, computed with the new examples' feeds.
+        """
+        sess = self.attack.sess
+        feed = self.attack.feeds.attack
+
+        current = sess.run(self.reset_vars)
+        initial = sess.run(
+            [v.initial_value for v in self.reset_vars], feed_dict=feed
+        )
+
+        for var, value, init in zip(self.reset_vars, current, initial):
+            value[rows] = init[rows]
+            var.load(value, sess)
+
+
+class Checkpoints(object):
+    """
+    Procedure mixin that periodically saves the per example variables (deltas,
+    optimiser slots, constraint bounds) and the current step, and restores them
+    when the same batch is attacked again -- e.g. after the host was preempted.
+
+    Does nothing unless `enable_checkpoints` is called. Restoring happens just
+    before the first optimisation step, after any initialisation the procedure
+    does itself. The checkpoint is removed once the batch is finished.
+    """
+    def __init__(self, attack, *args, **kwargs):
+
+        self.checkpoint_path = None
+        self.checkpoint_every = None
+        self.checkpoint_restored = False
+
+        super().__init__(attack, *args, **kwargs)
+
+    def enable_checkpoints(self, path, every):
+        """
+        :param path: file to save the checkpoint to (.npz)
+        :param every: save a checkpoint every this many optimisation steps
+        """
+        self.checkpoint_path = path
+        self.checkpoint_every = every
+        self.checkpoint_vars = example_variables(self.attack)
+
+    def save_checkpoint(self):
+
+        values = self.attack.sess.run(self.checkpoint_vars)
+
+        arrays = {"var_{}".format(i): v for i, v in enumerate(values)}
+        arrays["names"] = np.asarray([v.name for v in self.checkpoint_vars])
+        arrays["step"] = np.asarray(self.current_step)
+
+        tmp_path = self.checkpoint_path + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def restore_checkpoint(self):
+
+        if not os.path.exists(self.checkpoint_path):
+            return
+
+        with np.load(self.checkpoint_path) as data:
+
+            names = [v.name for v in self.checkpoint_vars]
+
+            if list(data["names"]) != names:
+                log("Checkpoint variables don't match the graph, ignoring it.")
+                return
+
+            for i, var in enumerate(self.checkpoint_vars):
+                var.load(data["var_{}".format(i)], self.attack.sess)
+
+            self.current_step = int(data["step"])
+
+        log("Restored checkpoint from step {}.".format(self.current_step))
+
+    def tf_run(self, tf_variables):
+
+        is_train_step = tf_variables is self.attack.optimiser.train
+
+        if self.checkpoint_path is None or not is_train_step:
+            return super().tf_run(tf_variables)
+
+        if not self.checkpoint_restored:
+            self.restore_checkpoint()
+            self.checkpoint_restored = True
+
+        result = super().tf_run(tf_variables)
+
+        if self.current_step > 0 and self.current_step % self.checkpoint_every == 0:
+            self.save_checkpoint()
+
+        return result
+
+    def run(self):
+        if self.checkpoint_path is None:
+            return super().run()
+        return self.run_with_checkpoints()
+
+    def run_with_checkpoints(self):
+
+        yield from super().run()
+
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+class WarmStart(object):
+    """
+    Procedure mixin that initialises the perturbation with values found by a
+    previous run (e.g. one with a different loss) instead of zeros, optionally
+    clipped to the current hard constraint's bounds.
+
+    Does nothing unless `enable_warm_start` is called. The values are loaded
+    just before the first optimisation step, after any initialisation the
+    procedure does itself, so a restored checkpoint (see `Checkpoints`) still
+    takes precedence.
+    """
+    def __init__(self, attack, *args, **kwargs):
+
+        self.warm_start_values = None
+
+        super().__init__(attack, *args, **kwargs)
+
+    def enable_warm_start(self, var, values, rescale=True):
+        """
+        :param var: the optimisation variable holding the perturbation
+        :param values: initial values for the variable
+        :param rescale: clip the values with the attack's hard constraint so
+                they're within the current bounds
+        """
+        self.warm_start_var = var
+        self.warm_start_values = values
+        self.warm_start_clip = None
+
+        if rescale:
+            self.warm_start_input = tf.placeholder(tf.float32, var.shape)
+            self.warm_start_clip = self.attack.hard_constraint.clip(
+                self.warm_start_input
+            )
+
+    def apply_warm_start(self):
+
+        values = self.warm_start_values
+
+        if self.warm_start_clip is not None:
+            values = self.attack.sess.run(
+                self.warm_start_clip,
+                feed_dict={self.warm_start_input: values}
+            )
+
+        self.warm_start_var.load(values, self.attack.sess)
+        self.warm_start_values = None
+
+    def tf_run(self, tf_variables):
+
+        is_train_step = tf_variables is self.attack.optimiser.train
+
+        if is_train_step and self.warm_start_values is not None:
+            self.apply_warm_start()
+
+        return super().tf_run(tf_variables)
+
+
+def greedy_decodings(argmax, lengths, tokens, blank):
+    """
+    Greedy CTC decoding of a batch of argmax paths -- merge repeated tokens
+    and drop blanks.
+
+    :param argmax: most likely token index for each frame [b, n_frames]
+    :param lengths: number of frames for each example [b]
+    :param tokens: the victim's tokens, indexed by token index
+    :param blank: index of the blank token
+    :return: list of transcriptions
+    """
+    argmax = np.asarray(argmax)
+    b, n = argmax.shape
+
+    previous = np.concatenate(
+        [np.full([b, 1], -1, dtype=argmax.dtype), argmax[:, :-1]], axis=1
+    )
+    frames = np.arange(n)[None, :] < np.asarray(lengths)[:, None]
+    keep = frames & (argmax != blank) & (argmax != previous)
+
+    return [
+        "".join(tokens[t] for t in path[k]) for path, k in zip(argmax, keep)
+    ]
+
+
+class GreedyPreCheck(object):
+    """
+    Procedure mixin that decides when to run the victim's beam search decoder
+    with a cheap greedy decoding of the argmax path, fetched in the same
+    session run as every optimisation step.
+
+    On the procedure's usual decoding steps the beam search only runs when at
+    least one example's greedy transcription is within `max_distance` edits
+    of its target, otherwise the step reports no decodings. In between, it
+    runs as soon as an example's greedy transcription becomes exactly its
+    target, so successes are found close to the step they happen instead of
+    at the next decoding step.
+
+    Does nothing unless `enable_greedy_check` is called, which has the
+    procedure's loop call `decode_step_logic` on every step. Needs
+    `FusedFetches` later in the MRO.
+    """
+    def __init__(self, attack, *args, **kwargs):
+
+        self.greedy_max_distance = None
+
+        super().__init__(attack, *args, **kwargs)
+
+    def enable_greedy_check(self, tokens, max_distance):
+        """
+        :param tokens: the tokens the victim was built with, one for each
+                class of its logits. The blank is the last class, as for
+                TensorFlow's CTC ops
+        :param max_distance: maximum edit distance between an example's greedy
+                transcription and its target for the beam search to run on a
+                decoding step
+        :raises ValueError: if the victim's logits don't have one class for
+                each token
+        """
+        n_classes = self.attack.victim.logits.shape.as_list()[-1]
+
+        if n_classes != len(tokens):
+            raise ValueError(
+                "Victim has {n} classes but {t} tokens, can't greedy "
+                "decode".format(n=n_classes, t=len(tokens))
+            )
+
+        self.greedy_tokens = tokens
+        self.greedy_blank = n_classes - 1
+        self.greedy_max_distance = max_distance
+        self.greedy_matched = np.zeros(self.attack.batch.size, dtype=bool)
+
+        # the loop asks on every step and `decode_step_logic` decides whether
+        # the beam search is worth running
+        self.greedy_decode_every = self.decode_step
+        self.decode_step = 1
+
+        self.add_step_fetches(
+            greedy_argmax=tf.argmax(self.attack.victim.logits, axis=-1)
+        )
+
+    def greedy_distances(self):
+        """
+        :return: edit distance between each example's greedy transcription and
+                its target
+        :raises ValueError: if the argmax paths aren't batch major or examples
+                have more frames than the victim's logits
+        """
+        argmax, = self.get_fetched("greedy_argmax")
+        lengths = np.asarray(self.attack.batch.audios["ds_feats"])
+
+        if argmax.shape[0] != self.attack.batch.size:
+            raise ValueError(
+                "Victim logits aren't batch major: {}".format(argmax.shape)
+            )
+
+        if lengths.max() > argmax.shape[1]:
+            raise ValueError(
+                "Examples have up to {n} frames but the victim's logits have "
+                "{m}".format(n=lengths.max(), m=argmax.shape[1])
+            )
+
+        decodings = greedy_decodings(
+            argmax, lengths, self.greedy_tokens, self.greedy_blank
+        )
+        targets = self.attack.batch.targets["phrases"]
+
+        return edit_distances(decodings, targets)
+
+    def decode_step_logic(self):
+
+        if self.greedy_max_distance is None:
+            return super().decode_step_logic()
+
+        distances = self.greedy_distances()
+
+        matched = distances == 0
+        newly_matched = matched & ~self.greedy_matched
+        self.greedy_matched = matched
+
+        if self.current_step % self.greedy_decode_every == 0:
+
+            if (distances <= self.greedy_max_distance).any():
+                return super().decode_step_logic()
+
+            log("Step {}: no greedy transcription is close to its target, skipped beam search.".format(
+                self.current_step
+            ))
+
+        elif newly_matched.any():
+
+            log("Step {s}: greedy transcriptions of examples {i} match their targets, decoding early.".format(
+                s=self.current_step, i=list(np.where(newly_matched)[0])
+            ))
+
+            return super().decode_step_logic()
+
+        return {"step": self.current_step, "data": []}
+
+
+class AsyncDecode(object):
+    """
+    Procedure mixin that runs the victim's beam search decoder in a background
+    thread so optimisation carries on while the batch is being decoded.
+
+    On each decoding step the current deltas (and optimisation variables) are
+    snapshotted and decoded in the background with the deltas fed in place of
+    the graph's `final_deltas`, so the decoding is exactly that of the
+    snapshot even though optimisation has moved on. The step returns the
+    results of the previous decoding, waiting for it if it hasn't finished.
+    Examples which succeeded are rolled back to their snapshotted variables
+    first, so anything written or updated for a success uses the perturbation
+    that was actually decoded.
+
+    Does nothing unless `enable_async_decode` is called. Results are reported
+    one decoding step late, plus a final one when the procedure finishes.
+    """
+    def __init__(self, attack, *args, **kwargs):
+
+        self.decode_pool = None
+        self.pending_decode = None
+
+        super().__init__(attack, *args, **kwargs)
+
+    def enable_async_decode(self):
+        self.decode_pool = ThreadPoolExecutor(max_workers=1)
+
+    def snapshot_values(self):
+        """
+        Any other values success is checked against, calculated when the
+        snapshot is taken.
+        """
+        return dict()
+
+    def success_inputs(self, snapshot, decodings):
+        """
+        :return: the arguments for `check_for_success` for a snapshot
+        """
+        return decodings, snapshot["targets"]
+
+    def take_snapshot(self):
+
+        graph = self.attack.graph
+
+        deltas, *opt_values = self.tf_run(
+            [graph.final_deltas] + list(graph.opt_vars)
+        )
+
+        feed = dict(self.attack.feeds.attack)
+        feed[graph.final_deltas] = deltas
+
+        return {
+            "step": self.current_step,
+            "feed": feed,
+            "opt_values": opt_values,
+            "targets": list(self.attack.batch.targets["phrases"]),
+            "values": self.snapshot_values(),
+        }
+
+    def snapshot_decode_logic(self, snapshot):
+        """
+        Decode a snapshot. Runs in the decoding thread.
+        """
+        top_5_decodings, top_5_probs = self.attack.victim.inference(
+            self.attack.batch,
+            feed=snapshot["feed"],
+            decoder="batch",
+            top_five=True,
+        )
+
+        decodings = [d[0] for d in top_5_decodings]
+        probs = [p[0] for p in top_5_probs]
+        targets = snapshot["targets"]
+
+        successes = self.check_for_success(
+            *self.success_inputs(snapshot, decodings)
+        )
+
+        return {
+            "step": snapshot["step"],
+            "data": [
+                {
+                    "idx": idx,
+                    "success": success,
+                    "decodings": decodings[idx],
+                    "target_phrase": targets[idx],
+                    "probs": probs[idx],
+                    "top_five_decodings": top_5_decodings[idx],
+                    "top_five_probs": top_5_probs[idx],
+                }
+                for idx, success in successes
+            ]
+        }
+
+    def collect_decode(self):
+        """
+        Wait for the pending decoding and roll examples which succeeded back
+        to the snapshot that was decoded.
+
+        :return: the decoding's results or None if nothing was pending
+        """
+        if self.pending_decode is None:
+            return None
+
+        snapshot, future = self.pending_decode
+        self.pending_decode = None
+
+        results = future.result()
+
+        rows = [d["idx"] for d in results["data"] if d["success"]]
+
+        if rows:
+            sess = self.attack.sess
+            for var, values in zip(self.attack.graph.opt_vars, snapshot["opt_values"]):
+                current = sess.run(var)
+                current[rows] = values[rows]
+                var.load(current, sess)
+
+            # anything cached from the current variables is stale now
+            self.fetched = dict()
+
+        return results
+
+    def decode_step_logic(self):
+
+        if self.decode_pool is None:
+            return super().decode_step_logic()
+
+        return self.async_decode_step_logic()
+
+    def async_decode_step_logic(self):
+        """
+        Procedures defining their own `decode_step_logic` should call this
+        instead when `decode_pool` is set.
+        """
+        results = self.collect_decode()
+
+        snapshot = self.take_snapshot()
+        self.pending_decode = snapshot, self.decode_pool.submit(
+            self.snapshot_decode_logic, snapshot
+        )
+
+        if results is None:
+            results = {"step": self.current_step, "data": []}
+
+        return results
+
+    def run(self):
+        if self.decode_pool is None:
+            return super().run()
+        return self.run_with_async_decode()
+
+    def run_with_async_decode(self):
+
+        try:
+            yield from super().run()
+
+            results = self.collect_decode()
+            if results is not None:
+                yield results
+
+        finally:
+            self.decode_pool.shutdown(wait=True)
+
+
+class FusedUpdateOnDecoding(RetireAndRefill, WarmStart, GreedyPreCheck, AsyncDecode, Checkpoints, FusedFetches, Procedures.UpdateOnDecoding):
+    pass
+
+
+class FusedCTCAlignUpdateOnDecode(WarmStart, GreedyPreCheck, AsyncDecode, Checkpoints, FusedFetches, Procedures.CTCAlignUpdateOnDecode):
+    pass
@@ -0,0 +1,378 @@
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from cleverspeech.utils.Utils import log
+
+from experiments.Common.Metrics import error_rates
+
+
+STORE_NAME = "results"
+SETTINGS_FILE = "settings.json"
+
+# Scratch directories statistics are generated in (see `Stats`), which hold
+# symlinks to results that shouldn't be picked up twice.
+STAGING_PREFIX = ".stats-"
+
+# Numeric lists at least this long (deltas, adversarial audio etc.) are written
+# to the memory mapped array blob instead of the database.
+MIN_ARRAY_LENGTH = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS examples (
+    id INTEGER PRIMARY KEY,
+    result_id TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS arrays (
+    example INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (example, key)
+);
+CREATE TABLE IF NOT EXISTS stats_processed (
+    result_id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def find_results(outdir):
+    """
+    Find all example result documents written to an output directory.
+
+    :param outdir: the experiment's output directory
+    :return: dict of result id (json path relative to outdir) -> absolute path
+    """
+    results = dict()
+
+    for root, dirs, files in os.walk(outdir):
+
+        # never look at our own staging directories
+        dirs[:] = [d for d in dirs if not d.startswith(STAGING_PREFIX)]
+
+        for f in files:
+            if f.endswith(".json") and f != SETTINGS_FILE:
+                path = os.path.join(root, f)
+                results[os.path.relpath(path, outdir)] = path
+
+    return results
+
+
+def _is_array(value):
+    return (
+        isinstance(value, list)
+        and len(value) >= MIN_ARRAY_LENGTH
+        and all(isinstance(v, (int, float)) for v in value[:10])
+    )
+
+
+def _first(value):
+    # lists (e.g. of decodings) are stored as JSON text
+    if isinstance(value, str) and value.startswith("["):
+        value = json.loads(value)
+    if isinstance(value, list):
+        value = value[0] if value else ""
+    return "" if value is None else str(value)
+
+
+def _is_scalar(value):
+    return value is None or isinstance(value, (bool, int, float, str))
+
+
+class RunStore(object):
+    def __init__(self, outdir, name=STORE_NAME):
+        """
+        Append only store of every example result for a run -- a single SQLite
+        database with one column per scalar result field (anything else is
+        stored as JSON text) and an array blob of float32 values for the
+        deltas / audio, read back through `np.memmap`.
+
+        Reporting can then select whole columns at once instead of opening
+        and parsing every example's JSON document.
+
+        :param outdir: the experiment's output directory
+        :param name: file name stem for the database and array blob
+        """
+        self.outdir = outdir
+        self.db_path = os.path.join(outdir, name + ".sqlite")
+        self.blob_path = os.path.join(outdir, name + ".arrays.f32")
+
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.executescript(_SCHEMA)
+
+        self.columns = self._existing_columns()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def _existing_columns(self):
+        rows = self.conn.execute("PRAGMA table_info(examples)").fetchall()
+        return set(r[1].lower() for r in rows)
+
+    def _add_column(self, key):
+        # sqlite column names are case insensitive
+        if key.lower() not in self.columns:
+            self.conn.execute('ALTER TABLE examples ADD COLUMN "{}"'.format(key))
+            self.columns.add(key.lower())
+
+    def _append_array(self, values):
+        """
+        :return: offset (in float32 values) of the array in the blob
+        """
+        array = np.asarray(values, dtype=np.float32)
+
+        with open(self.blob_path, "ab") as f:
+            offset = f.tell() // array.itemsize
+            f.write(array.tobytes())
+
+        return offset
+
+    def _write_array(self, offset, values):
+        """
+        Overwrite an array of the same length already in the blob.
+        """
+        array = np.asarray(values, dtype=np.float32)
+
+        with open(self.blob_path, "r+b") as f:
+            f.seek(offset * array.itemsize)
+            f.write(array.tobytes())
+
+    def _replace_arrays(self, example, arrays):
+        """
+        Replace an example's arrays, overwriting them in place in the blob
+        when the new array has the same length so the blob doesn't grow every
+        time a changed document is added again.
+        """
+        previous = {
+            key: (offset, length) for key, offset, length in self.conn.execute(
+                "SELECT key, offset, length FROM arrays WHERE example = ?",
+                (example,)
+            )
+        }
+
+        for key in set(previous) - set(arrays):
+            self.conn.execute(
+                "DELETE FROM arrays WHERE example = ? AND key = ?",
+                (example, key)
+            )
+
+        for key, values in arrays.items():
+
+            if key in previous and previous[key][1] == len(values):
+                self._write_array(previous[key][0], values)
+                continue
+
+            offset = self._append_array(values)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO arrays VALUES (?, ?, ?, ?)",
+                (example, key, offset, len(values))
+            )
+
+    def add(self, result_id, doc, mtime=0.0):
+        """
+        Add (or replace) one example's result document. A replaced document
+        keeps its example id, so example order doesn't change.
+
+        :param result_id: unique id of the result, e.g. its json path
+                relative to the output directory
+        :param doc: the result document (dict)
+        :param mtime: modification time of the result document
+        """
+        row = {"result_id": result_id, "mtime": mtime}
+        arrays = dict()
+
+        for key, value in doc.items():
+            key = key.replace('"', "")
+
+            if key.lower() in ("id", "result_id", "mtime"):
+                key = "doc_" + key
+
+            if _is_array(value):
+                arrays[key] = value
+            elif _is_scalar(value):
+                row[key] = value
+            else:
+                row[key] = json.dumps(value)
+
+        for key in row:
+            self._add_column(key)
+
+        existing = self.conn.execute(
+            "SELECT id FROM examples WHERE result_id = ?", (result_id,)
+        ).fetchone()
+
+        if existing is None:
+            keys = list(row.keys())
+            cursor = self.conn.execute(
+                "INSERT INTO examples ({k}) VALUES ({v})".format(
+                    k=", ".join('"{}"'.format(k) for k in keys),
+                    v=", ".join("?" for _ in keys),
+                ),
+                [row[k] for k in keys]
+            )
+            example = cursor.lastrowid
+
+        else:
+            example = existing[0]
+
+            # fields the new document doesn't have any more are cleared
+            values = {k.lower(): v for k, v in row.items()}
+            keys = sorted(self.columns - {"id", "result_id"})
+
+            self.conn.execute(
+                "UPDATE examples SET {s} WHERE id = ?".format(
+                    s=", ".join('"{}" = ?'.format(k) for k in keys)
+                ),
+                [values.get(k) for k in keys] + [example]
+            )
+
+        self._replace_arrays(example, arrays)
+
+        return example
+
+    def ingest(self):
+        """
+        Add every result document in the output directory that's new or has
+        changed since it was last added.
+
+        :return: number of result documents added
+        """
+        known = dict(
+            self.conn.execute("SELECT result_id, mtime FROM examples")
+        )
+
+        n_added = 0
+
+        for result_id, path in sorted(find_results(self.outdir).items()):
+
+            mtime = os.path.getmtime(path)
+
+            if known.get(result_id) == mtime:
+                continue
+
+            try:
+                with open(path, "r") as f:
+                    doc = json.load(f)
+            except ValueError:
+                log("Skipping unreadable result document: {}".format(path))
+                continue
+
+            if not isinstance(doc, dict):
+                continue
+
+            self.add(result_id, doc, mtime=mtime)
+            n_added += 1
+
+        self.conn.commit()
+
+        return n_added
+
+    def query(self, sql, params=()):
+        return self.conn.execute(sql, params).fetchall()
+
+    def column(self, key):
+        """
+        All values of a scalar result field, in example order.
+        """
+        if key.lower() not in self.columns:
+            raise KeyError("No result field called {}".format(key))
+
+        rows = self.conn.execute(
+            'SELECT "{}" FROM examples ORDER BY id'.format(key)
+        ).fetchall()
+
+        return [r[0] for r in rows]
+
+    def array(self, example, key):
+        """
+        Memory map of one example's array field, e.g. its deltas.
+
+        :param example: the example's row id
+        :param key: the array's result field name
+        """
+        row = self.conn.execute(
+            "SELECT offset, length FROM arrays WHERE example = ? AND key = ?",
+            (example, key)
+        ).fetchone()
+
+        if row is None:
+            raise KeyError("No {} array for example {}".format(key, example))
+
+        offset, length = row
+
+        return np.memmap(
+            self.blob_path,
+            dtype=np.float32,
+            mode="r",
+            offset=offset * np.dtype(np.float32).itemsize,
+            shape=(length,)
+        )
+
+    def arrays(self, key):
+        """
+        Memory maps of an array field for every example that has it.
+
+        :return: dict of result id -> memory mapped array
+        """
+        rows = self.conn.execute(
+            "SELECT e.id, e.result_id FROM examples e "
+            "JOIN arrays a ON a.example = e.id WHERE a.key = ? ORDER BY e.id",
+            (key,)
+        ).fetchall()
+
+        return {result_id: self.array(example, key) for example, result_id in rows}
+
+    def stats_processed(self):
+        """
+        Result ids that statistics have already been generated for.
+        """
+        rows = self.conn.execute("SELECT result_id FROM stats_processed")
+        return set(r[0] for r in rows)
+
+    def mark_stats_processed(self, result_ids):
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO stats_processed VALUES (?)",
+            [(r,) for r in result_ids]
+        )
+        self.conn.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value)
+        )
+        self.conn.commit()
+
+    def error_rates(self, level="char", hypotheses="decodings", references="target_phrase"):
+        """
+        Character or word error rates of every example, in example order,
+        calculated for the whole run in one batch.
+
+        :param level: "char" or "word"
+        :param hypotheses: result field of the decoded transcriptions
+        :param references: result field of the target transcriptions
+        """
+        return error_rates(
+            [_first(v) for v in self.column(hypotheses)],
+            [_first(v) for v in self.column(references)],
+            level=level,
+        )
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+
+from cleverspeech.utils.Utils import log
+
+from experiments.Common.Batches import select_examples
+from experiments.Common.Results import RunStore, find_results
+
+
+CHECKPOINT_DIR = ".checkpoints"
+
+# Result store metadata holding the settings hash of the run(s) whose results
+# are in `outdir`, or `MIXED_SETTINGS` if they came from different settings.
+SETTINGS_KEY = "settings_hash"
+MIXED_SETTINGS = "mixed"
+
+# How to identify an example -- (audio, target) pairs -- in a batch and in the
+# result documents written for it.
+BATCH_ID_FIELDS = (("audios", "basenames"), ("targets", "phrases"))
+RESULT_ID_FIELDS = ("basenames", "target_phrase")
+
+
+def settings_hash(settings, ignore=()):
+    """
+    Hash of the settings that affect an experiment's results.
+
+    :param settings: the experiment's settings dict
+    :param ignore: keys that don't affect the results (e.g. runtime settings)
+    """
+    relevant = {k: v for k, v in settings.items() if k not in ignore}
+    encoded = json.dumps(relevant, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+def _as_id(value):
+    if isinstance(value, (list, tuple)) and len(value) == 1:
+        value = value[0]
+    return str(value)
+
+
+def stored_id(value):
+    # lists are stored as JSON text in the result store
+    if isinstance(value, str) and value.startswith("["):
+        value = json.loads(value)
+    return _as_id(value)
+
+
+def example_ids(batch):
+    """
+    :return: list of (audio id, target) tuples for each example in a batch
+    """
+    (a_name, a_key), (t_name, t_key) = BATCH_ID_FIELDS
+
+    audios = getattr(batch, a_name)[a_key]
+    targets = getattr(batch, t_name)[t_key]
+
+    return [(_as_id(a), _as_id(t)) for a, t in zip(audios, targets)]
+
+
+def batch_key(batch, s_hash):
+    """
+    Unique name for a batch of examples run with some settings, e.g. for
+    checkpoint files.
+    """
+    encoded = json.dumps([s_hash] + example_ids(batch))
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+def record_settings(outdir, s_hash):
+    """
+    Record which settings the results in `outdir` were generated with. Results
+    already there without a recorded hash, or with a different one, mark the
+    directory as mixed so it's never resumed.
+    """
+    has_results = bool(find_results(outdir))
+
+    with RunStore(outdir) as store:
+
+        previous = store.get_meta(SETTINGS_KEY)
+
+        if previous == s_hash or (previous is None and not has_results):
+            store.set_meta(SETTINGS_KEY, s_hash)
+        else:
+            store.set_meta(SETTINGS_KEY, MIXED_SETTINGS)
+
+
+def completed_examples(outdir, s_hash):
+    """
+    Find the (audio id, target) pairs that already have results in `outdir`
+    from a run with the same settings.
+
+    :return: set of (audio id, target) tuples or None if results can't be
+            reused (no or different recorded settings, or missing id fields)
+    """
+    with RunStore(outdir) as store:
+
+        store.ingest()
+
+        if not store.query("SELECT 1 FROM examples LIMIT 1"):
+            return set()
+
+        previous = store.get_meta(SETTINGS_KEY)
+
+        if previous is None:
+            log("No settings recorded for the existing results, not resuming.")
+            return None
+
+        if previous != s_hash:
+            log("Settings have changed since the last run, not resuming.")
+            return None
+
+        audio_field, target_field = RESULT_ID_FIELDS
+
+        try:
+            audios = store.column(audio_field)
+            targets = store.column(target_field)
+        except KeyError:
+            log("Results don't have {} fields, not resuming.".format(
+                RESULT_ID_FIELDS
+            ))
+            return None
+
+    return set(
+        (stored_id(a), stored_id(t))
+        for a, t in zip(audios, targets) if a is not None and t is not None
+    )
+
+
+def get_resumable_batch_generator(batch_gen, settings, s_hash):
+    """
+    Skip examples that already have results in `outdir` from a previous run
+    with the same settings. Batches with some completed examples are cut down
+    to the examples that still need attacking.
+
+    :param batch_gen: a generator of (batch id, batch) tuples
+    :param settings: the experiment's settings dict
+    :param s_hash: hash of the settings which affect results
+    :return: generator of (batch id, batch) tuples
+    """
+    # find the completed examples now, before this run records its settings
+    done = completed_examples(settings["outdir"], s_hash)
+
+    if not done:
+        return batch_gen
+
+    log("Found {} completed examples to skip.".format(len(done)))
+
+    return _skip_completed(batch_gen, done)
+
+
+def _skip_completed(batch_gen, done):
+
+    n_skipped = 0
+
+    for b_id, batch in batch_gen:
+
+        todo = [
+            idx for idx, ex_id in enumerate(example_ids(batch))
+            if ex_id not in done
+        ]
+        n_skipped += batch.size - len(todo)
+
+        if not todo:
+            log("Skipping completed Batch Number {}.".format(b_id))
+            continue
+
+        if len(todo) < batch.size:
+            batch = select_examples(batch, todo)
+
+        yield b_id, batch
+
+    log("Skipped {} completed examples.".format(n_skipped))
+
+
+def checkpoint_path(settings, batch, s_hash):
+    directory = os.path.join(settings["outdir"], CHECKPOINT_DIR)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, batch_key(batch, s_hash) + ".npz")
@@ -0,0 +1,608 @@
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import threading
+import time
+
+from cleverspeech.data.Results import SingleFileWriter, SingleJsonDB
+from cleverspeech.utils.RuntimeUtils import AttackSpawner
+from cleverspeech.utils.Utils import log
+
+from experiments.Common.Batches import BUCKET_WASTE, BUCKET_WINDOW
+from experiments.Common.Procedures import RefillQueue
+from experiments.Common.Results import RunStore
+from experiments.Common.Resume import checkpoint_path, \
+    get_resumable_batch_generator, record_settings, settings_hash
+from experiments.Common.Stats import IncrementalStats, WriteSignal
+from experiments.Common.WarmStart import delta_variable, initial_deltas, \
+    prior_deltas
+
+
+# Runtime settings every experiment gets unless its settings dict (or the
+# command line) says otherwise. They're written to `settings.json` along with
+# everything else.
+#
+# pipeline: prefetch batches in a background thread while the spawner is busy
+#           and generate statistics for results as they land instead of in
+#           one pass at the end.
+# prefetch: maximum number of batches to keep ready when pipelining.
+# spawn_mode: "delay" sleeps for `spawn_delay` seconds after every spawn.
+#             "adaptive" spawns the next attack as soon as the previous one
+#             has built its graph and there's at least `min_free_ram` GB of
+#             memory available.
+# ready_timeout: maximum seconds to wait for a spawned attack to report it's
+#             ready (e.g. if it crashed while building the graph).
+# bucket_waste: maximum fraction of padding in the batch generator's batches
+#             before their examples are regrouped by length (see
+#             `Batches.get_bucketed_batch_generator`). None keeps the batch
+#             generator's own batches.
+# bucket_window: number of the batch generator's batches regrouped together
+#             when bucketing. Only this many batches are held in memory.
+# refill: only spawn `max_spawns` attacks and use the remaining batches to
+#             replace examples in those attacks as they're retired (see
+#             `Procedures.RetireAndRefill`).
+# retire_after: retire an example after this many successful decodings.
+# example_steps: optimisation steps an example gets before it's retired as
+#             hopeless. None uses the procedure's `steps`.
+# persistent: only spawn `max_spawns` attacks, which load each of the
+#             remaining batches into their existing graph once they've
+#             finished their current batch (see `Procedures.RetireAndRefill`).
+# result_store: once all attacks have finished, collect every example's
+#             results into one SQLite database and array blob in `outdir`
+#             (see `Results.RunStore`).
+# stats_workers: number of processes used to generate statistics. Only
+#             results without statistics from a previous run are processed.
+# resume: skip examples that already have results in `outdir` from a run
+#             with the same settings. Results without a recorded settings
+#             hash are never resumed (see `Resume`).
+# checkpoint_steps: save each attack's deltas and optimiser state every this
+#             many steps and restore them if the batch is attacked again.
+#             None disables checkpoints. Not used with refill / persistent.
+# greedy_check: only run the beam search decoder on a decoding step when an
+#             example's greedy transcription is within this many edits of its
+#             target, and run it early when one matches its target exactly
+#             (see `Procedures.GreedyPreCheck`). None decodes on every
+#             decoding step as usual.
+# async_decode: run the beam search decoder in a background thread while
+#             optimisation carries on (see `Procedures.AsyncDecode`). Not used
+#             with refill / persistent.
+
+RUNTIME_SETTINGS = {
+    "pipeline": False,
+    "prefetch": 2,
+    "spawn_mode": "delay",
+    "min_free_ram": 4.0,
+    "ready_timeout": 600,
+    "bucket_waste": BUCKET_WASTE,
+    "bucket_window": BUCKET_WINDOW,
+    "refill": False,
+    "retire_after": 1,
+    "example_steps": None,
+    "persistent": False,
+    "result_store": False,
+    "stats_workers": 1,
+    "resume": False,
+    "checkpoint_steps": None,
+    "greedy_check": None,
+    "async_decode": False,
+}
+
+# Settings that don't change an experiment's results, so they're left out of
+# the settings hash used when resuming. Anything else (e.g. refill,
+# greedy_check, async_decode, bucket_waste, bucket_window) changes which
+# examples are attacked together or how they're optimised and decoded.
+NON_RESULT_SETTINGS = {
+    "outdir", "gpu_device", "max_spawns", "spawn_delay",
+    "pipeline", "prefetch", "spawn_mode", "min_free_ram", "ready_timeout",
+    "result_store", "stats_workers", "resume", "checkpoint_steps",
+    "batch_cache", "batch_cache_check",
+}
+
+READY_DIR = ".ready"
+POLL_SECONDS = 0.5
+
+
+class _ProducerError(object):
+    def __init__(self, error):
+        self.error = error
+
+
+_EXHAUSTED = object()
+
+
+def prefetch(batch_gen, n_batches):
+    """
+    Generate batches in a background thread, keeping up to `n_batches` ready
+    so the ETL work overlaps with waiting on the attack spawner.
+
+    :param batch_gen: a generator of (batch id, batch) tuples
+    :param n_batches: maximum number of batches to keep ready
+    :yield: the same (batch id, batch) tuples as `batch_gen`
+    """
+
+    ready = queue.Queue(maxsize=max(1, n_batches))
+
+    def producer():
+        try:
+            for item in batch_gen:
+                ready.put(item)
+        except Exception as e:
+            ready.put(_ProducerError(e))
+        else:
+            ready.put(_EXHAUSTED)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    while True:
+        item = ready.get()
+
+        if item is _EXHAUSTED:
+            break
+
+        elif isinstance(item, _ProducerError):
+            raise item.error
+
+        yield item
+
+    thread.join()
+
+
+def free_ram_gb():
+    """
+    Memory available for new processes without swapping, in GB.
+    """
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) / 1024 ** 2
+
+    raise OSError("Could not read MemAvailable from /proc/meminfo.")
+
+
+class ReadySignal(object):
+    def __init__(self, attack_fn, path):
+        """
+        Wraps an attack graph function so the spawned process writes a file
+        once its graph has been built and variables allocated, letting the
+        parent process know it's safe to spawn the next attack.
+
+        :param attack_fn: function that builds the attack graph for a batch
+        :param path: file to create once the attack graph has been built
+        """
+        self.attack_fn = attack_fn
+        self.path = path
+
+    def __call__(self, sess, batch, settings):
+        attack = self.attack_fn(sess, batch, settings)
+        with open(self.path, "w"):
+            pass
+        return attack
+
+    def wait(self, timeout):
+        """
+        Block until the spawned attack has built its graph.
+
+        :return: whether the attack reported it was ready before the timeout
+        """
+        deadline = time.time() + timeout
+
+        while not os.path.exists(self.path):
+            if time.time() > deadline:
+                return False
+            time.sleep(POLL_SECONDS)
+
+        os.remove(self.path)
+        return True
+
+
+class TimedSetup(object):
+    def __init__(self, attack_fn):
+        """
+        Wraps an attack graph function to log how long building the attack
+        took, so per batch setup overheads can be compared between modes.
+
+        :param attack_fn: function that builds the attack graph for a batch
+        """
+        self.attack_fn = attack_fn
+
+    def __call__(self, sess, batch, settings):
+        start = time.time()
+        attack = self.attack_fn(sess, batch, settings)
+        log("Built attack graph in {:.2f}s.".format(time.time() - start))
+        return attack
+
+
+class RefillAttack(object):
+    def __init__(self, attack_fn, batches):
+        """
+        Wraps an attack graph function so the spawned attack takes examples
+        from a queue of batches shared with the parent, either to refill
+        retired examples or, with the persistent setting, to load whole
+        batches into the graph once the current batch is done.
+
+        :param attack_fn: function that builds the attack graph for a batch
+        :param batches: multiprocessing queue of batches
+        """
+        self.attack_fn = attack_fn
+        self.batches = batches
+
+    def __call__(self, sess, batch, settings):
+        attack = self.attack_fn(sess, batch, settings)
+        procedure = attack.procedure
+
+        if not hasattr(procedure, "enable_refill"):
+            log("Procedure can't take queued examples, running batch as normal.")
+
+        else:
+            try:
+                if settings["persistent"]:
+                    procedure.enable_reuse(RefillQueue(self.batches))
+                else:
+                    procedure.enable_refill(
+                        RefillQueue(self.batches),
+                        retire_after=settings["retire_after"],
+                        example_steps=settings["example_steps"],
+                    )
+            except ValueError as e:
+                log("{}. Running batch as normal.".format(e))
+
+        return attack
+
+
+class ResumableAttack(object):
+    def __init__(self, attack_fn, s_hash):
+        """
+        Wraps an attack graph function so the spawned attack saves checkpoints
+        of its optimisation state and restores them if the same batch is
+        attacked again with the same settings.
+
+        :param attack_fn: function that builds the attack graph for a batch
+        :param s_hash: hash of the settings which affect results
+        """
+        self.attack_fn = attack_fn
+        self.s_hash = s_hash
+
+    def __call__(self, sess, batch, settings):
+        attack = self.attack_fn(sess, batch, settings)
+        procedure = attack.procedure
+
+        if not hasattr(procedure, "enable_checkpoints"):
+            log("Procedure can't save checkpoints, running without them.")
+
+        elif settings["refill"] or settings["persistent"]:
+            log("Checkpoints aren't used when examples are swapped out.")
+
+        else:
+            procedure.enable_checkpoints(
+                checkpoint_path(settings, batch, self.s_hash),
+                settings["checkpoint_steps"],
+            )
+
+        return attack
+
+
+class WarmStartAttack(object):
+    def __init__(self, attack_fn):
+        """
+        Wraps an attack graph function so the spawned attack starts from the
+        perturbations a previous run found for the same audio and target
+        pairs, instead of from zero. The previous run's output directory is
+        the `warm_start` setting.
+
+        :param attack_fn: function that builds the attack graph for a batch
+        """
+        self.attack_fn = attack_fn
+
+    def __call__(self, sess, batch, settings):
+        attack = self.attack_fn(sess, batch, settings)
+        procedure = attack.procedure
+        var = delta_variable(attack)
+
+        if not hasattr(procedure, "enable_warm_start") or var is None:
+            log("Attack can't be warm started, starting from zero.")
+
+        elif settings["refill"] or settings["persistent"]:
+            log("Warm starts aren't used when examples are swapped out.")
+
+        else:
+            deltas = prior_deltas(settings["warm_start"], batch)
+            log("Warm starting {n} of {b} examples from {d}.".format(
+                n=len(deltas), b=batch.size, d=settings["warm_start"]
+            ))
+
+            if deltas:
+                procedure.enable_warm_start(
+                    var,
+                    initial_deltas(deltas, batch.size, var.shape.as_list()[1]),
+                    rescale=settings.get("warm_start_rescale", True),
+                )
+
+        return attack
+
+
+class GreedyCheckAttack(object):
+    def __init__(self, attack_fn):
+        """
+        Wraps an attack graph function so the spawned attack only runs the
+        beam search decoder once an example's greedy transcription is close to
+        its target.
+
+        :param attack_fn: function that builds the attack graph for a batch
+        """
+        self.attack_fn = attack_fn
+
+    def __call__(self, sess, batch, settings):
+        attack = self.attack_fn(sess, batch, settings)
+        procedure = attack.procedure
+
+        if not hasattr(procedure, "enable_greedy_check"):
+            log("Procedure can't do greedy pre-checks, decoding as normal.")
+
+        else:
+            try:
+                procedure.enable_greedy_check(
+                    settings["tokens"], settings["greedy_check"]
+                )
+            except ValueError as e:
+                log("{}. Decoding as normal.".format(e))
+
+        return attack
+
+
+class AsyncDecodeAttack(object):
+    def __init__(self, attack_fn):
+        """
+        Wraps an attack graph function so the spawned attack decodes in a
+        background thread instead of pausing optimisation while it decodes.
+
+        :param attack_fn: function that builds the attack graph for a batch
+        """
+        self.attack_fn = attack_fn
+
+    def __call__(self, sess, batch, settings):
+        attack = self.attack_fn(sess, batch, settings)
+        procedure = attack.procedure
+
+        if not hasattr(procedure, "enable_async_decode"):
+            log("Procedure can't decode asynchronously, decoding as normal.")
+
+        elif settings["refill"] or settings["persistent"]:
+            log("Asynchronous decoding isn't used when examples are swapped out.")
+
+        else:
+            procedure.enable_async_decode()
+
+        return attack
+
+
+def drain(batches):
+    """
+    Empty a refill queue once all attacks have finished.
+
+    :return: list of (batch id, batch) tuples that were never used
+    """
+    leftovers = list()
+
+    while True:
+        try:
+            item = batches.get_nowait()
+        except queue.Empty:
+            break
+
+        if item is not None:
+            b_id, batch, _, _ = item
+            leftovers.append((b_id, batch))
+
+    return leftovers
+
+
+def wait_for_free_ram(min_free_gb, timeout):
+    """
+    Back-pressure for adaptive spawning -- block until there's enough memory
+    available for another attack process.
+    """
+    deadline = time.time() + timeout
+
+    while free_ram_gb() < min_free_gb:
+        if time.time() > deadline:
+            log("Timed out waiting for {} GB of free memory.".format(min_free_gb))
+            return
+        time.sleep(POLL_SECONDS)
+
+
+def execute(settings, attack_fn, batch_gen):
+    """
+    Run an attack for every batch from a batch generator, writing results and
+    statistics into `settings["outdir"]`.
+
+    :param settings: the experiment's settings dict
+    :param attack_fn: function that builds the attack graph for a batch
+    :param batch_gen: a generator of (batch id, batch) tuples
+    """
+
+    for key, value in RUNTIME_SETTINGS.items():
+        settings.setdefault(key, value)
+
+    # set up the directory we'll use for results
+
+    if not os.path.exists(settings["outdir"]):
+        os.makedirs(settings["outdir"], exist_ok=True)
+
+    # lets the statistics know which results have been completely written.
+    file_writer = WriteSignal(
+        SingleFileWriter(settings["outdir"]), settings["outdir"]
+    )
+
+    # Write the current settings to "settings.json" file.
+
+    settings_db = SingleJsonDB(settings["outdir"])
+    settings_db.open("settings").put(settings)
+    log("Wrote settings.")
+
+    s_hash = settings_hash(settings, ignore=NON_RESULT_SETTINGS)
+
+    if settings["resume"]:
+        batch_gen = get_resumable_batch_generator(batch_gen, settings, s_hash)
+
+    record_settings(settings["outdir"], s_hash)
+
+    if settings["checkpoint_steps"]:
+        attack_fn = ResumableAttack(attack_fn, s_hash)
+
+    if settings.get("warm_start"):
+        with RunStore(settings["warm_start"]) as store:
+            store.ingest()
+        attack_fn = WarmStartAttack(attack_fn)
+
+    if settings["greedy_check"] is not None:
+        attack_fn = GreedyCheckAttack(attack_fn)
+
+    if settings["async_decode"]:
+        attack_fn = AsyncDecodeAttack(attack_fn)
+
+    if settings["pipeline"]:
+
+        batches = prefetch(batch_gen, settings["prefetch"])
+
+        stats = IncrementalStats(
+            settings["outdir"], workers=settings["stats_workers"]
+        )
+
+        with stats:
+            spawn_attacks(
+                settings, attack_fn, batches, file_writer, on_spawn=stats.update
+            )
+
+    else:
+
+        spawn_attacks(settings, attack_fn, batch_gen, file_writer)
+
+        # Run the stats function on all new successful examples once all
+        # attacks are completed.
+        stats = IncrementalStats(
+            settings["outdir"], workers=settings["stats_workers"]
+        )
+        stats.process(final=True)
+
+    if settings["result_store"]:
+        with RunStore(settings["outdir"]) as store:
+            n_added = store.ingest()
+        log("Added {} results to the run's result store.".format(n_added))
+
+
+def spawn_attacks(settings, attack_fn, batches, file_writer, on_spawn=None):
+    """
+    Spawn an attack process for every batch.
+
+    :param settings: the experiment's settings dict
+    :param attack_fn: function that builds the attack graph for a batch
+    :param batches: iterable of (batch id, batch) tuples
+    :param file_writer: writes results from attack processes to disk
+    :param on_spawn: optional function called after every spawn
+    """
+
+    adaptive = settings["spawn_mode"] == "adaptive"
+
+    if not adaptive and settings["spawn_mode"] != "delay":
+        raise ValueError(
+            "Unknown spawn mode: {}".format(settings["spawn_mode"])
+        )
+
+    # signals left behind by a previous run with the same batch ids would make
+    # `ReadySignal.wait` return straight away.
+    ready_dir = os.path.join(settings["outdir"], READY_DIR)
+    shutil.rmtree(ready_dir, ignore_errors=True)
+    if adaptive:
+        os.makedirs(ready_dir, exist_ok=True)
+
+    # Manage GPU memory and CPU processes usage.
+
+    attack_spawner = AttackSpawner(
+        gpu_device=settings["gpu_device"],
+        max_processes=settings["max_spawns"],
+        delay=0 if adaptive else settings["spawn_delay"],
+        file_writer=file_writer,
+    )
+
+    if settings["refill"] or settings["persistent"]:
+        manager = mp.Manager()
+        refills = manager.Queue()
+        spawn_fn = TimedSetup(RefillAttack(attack_fn, refills))
+    else:
+        manager = refills = None
+        spawn_fn = TimedSetup(attack_fn)
+
+    start, previous = time.time(), None
+    n_batches, n_queued = 0, 0
+
+    with attack_spawner as spawner:
+        for b_id, batch in batches:
+
+            if refills is not None and n_batches >= settings["max_spawns"]:
+                log("Queued Batch Number {}.".format(b_id))
+                refills.put((b_id, batch, frozenset(), None))
+                n_queued += 1
+                continue
+
+            n_batches += 1
+
+            if adaptive:
+
+                if previous is not None:
+                    if not previous.wait(settings["ready_timeout"]):
+                        log("Timed out waiting for previous attack to start.")
+
+                wait_for_free_ram(
+                    settings["min_free_ram"], settings["ready_timeout"]
+                )
+
+                path = os.path.join(ready_dir, "batch_{}".format(b_id))
+                previous = fn = ReadySignal(spawn_fn, path)
+
+            else:
+                fn = spawn_fn
+
+            log("Running for Batch Number: {}".format(b_id), wrap=True)
+            spawner.spawn(settings, fn, batch)
+
+            if on_spawn is not None:
+                on_spawn()
+
+        if refills is not None:
+            refills.put(None)
+
+    # nothing waits for the last attack's signal.
+    shutil.rmtree(ready_dir, ignore_errors=True)
+
+    leftovers = list()
+
+    if refills is not None:
+
+        # Anything the attacks couldn't use (e.g. examples too long for any
+        # of the running attacks' graphs) gets its own attack.
+        leftovers = drain(refills)
+        manager.shutdown()
+
+        # queued batches the attacks took count as run here, the leftovers
+        # are counted by the attacks they get below.
+        n_batches += max(0, n_queued - len(leftovers))
+
+    hours = (time.time() - start) / 3600
+
+    log("Ran {n} batches in {h:.2f} hours ({r:.2f} batches/hour).".format(
+        n=n_batches, h=hours, r=n_batches / hours if hours > 0 else 0.0
+    ))
+
+    if leftovers:
+        log("Running {} batches the attacks couldn't use.".format(
+            len(leftovers)
+        ))
+        spawn_attacks(
+            dict(settings, refill=False, persistent=False),
+            attack_fn,
+            leftovers,
+            file_writer,
+            on_spawn=on_spawn,
+        )
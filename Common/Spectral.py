@@ -0,0 +1,212 @@
+import tensorflow as tf
+
+
+def get_plans(attack):
+    """
+    Get the `SpectralPlans` shared by every spectral loss of an attack,
+    creating them the first time they're needed.
+    """
+    if not hasattr(attack, "spectral_plans"):
+        attack.spectral_plans = SpectralPlans()
+    return attack.spectral_plans
+
+
+class SpectralPlans(object):
+    def __init__(self):
+        """
+        Cache of signals, framings and STFTs used by spectral losses, so losses
+        on the same signal with the same settings share one transform instead
+        of each adding their own to the graph.
+
+        Nothing is added to the graph until a loss asks for it, so only the
+        terms which feed a loss are ever built.
+        """
+        self.signals = dict()
+        self.frames = dict()
+        self.stfts = dict()
+        self.magnitudes = dict()
+
+    def signal(self, name, build_fn):
+        """
+        :param name: name to share the signal under, e.g. "audio-deltas"
+        :param build_fn: function that builds the signal tensor [b, n_samples]
+        :return: the signal tensor
+        """
+        if name not in self.signals:
+            self.signals[name] = build_fn()
+        return self.signals[name]
+
+    def framed(self, signal, frame_length, frame_step, pad_end):
+        """
+        Windowed frames of a signal, as used by `tf.signal.stft`.
+
+        :return: windowed frames [b, n_frames, frame_length]
+        """
+        key = (signal, frame_length, frame_step, pad_end)
+
+        if key not in self.frames:
+            frames = tf.signal.frame(
+                signal, frame_length, frame_step, pad_end=pad_end
+            )
+            window = tf.signal.hann_window(frame_length, dtype=frames.dtype)
+            self.frames[key] = frames * window
+
+        return self.frames[key]
+
+    def stft(self, signal, frame_length, frame_step, fft_length, pad_end):
+
+        key = (signal, frame_length, frame_step, fft_length, pad_end)
+
+        if key not in self.stfts:
+            self.stfts[key] = tf.signal.stft(
+                signals=signal,
+                frame_length=frame_length,
+                frame_step=frame_step,
+                fft_length=fft_length,
+                pad_end=pad_end
+            )
+
+        return self.stfts[key]
+
+    def magnitude(self, signal, frame_length, frame_step, fft_length, pad_end):
+
+        key = (signal, frame_length, frame_step, fft_length, pad_end)
+
+        if key not in self.magnitudes:
+            stft = self.stft(
+                signal, frame_length, frame_step, fft_length, pad_end
+            )
+            self.magnitudes[key] = tf.cast(tf.abs(stft), tf.float32)
+
+        return self.magnitudes[key]
+
+    def power_mean(self, signal, frame_length, frame_step, fft_length, pad_end):
+        """
+        Mean squared STFT magnitude of each example, calculated in the time
+        domain with Parseval's theorem instead of an FFT.
+
+        For an even `fft_length` N the rfft bins 0 ... N/2 of a real, windowed
+        frame wx hold half the frame's spectral energy plus half the DC and
+        Nyquist bins, so
+
+            sum_k |X_k| ** 2 = (N * sum(wx ** 2) + X_0 ** 2 + X_N/2 ** 2) / 2
+
+        where X_0 = sum(wx) and X_N/2 = sum((-1) ** n * wx). That's exactly the
+        same value as squaring the STFT's magnitude, in linear time.
+
+        :return: mean squared magnitude over frames and bins [b]
+        """
+        if fft_length % 2 != 0 or frame_length > fft_length:
+            raise ValueError(
+                "Parseval power needs an even fft_length >= frame_length."
+            )
+
+        wx = self.framed(signal, frame_length, frame_step, pad_end)
+
+        # 1, -1, 1, -1, ...
+        alternating = 1.0 - 2.0 * tf.cast(
+            tf.range(frame_length) % 2, wx.dtype
+        )
+
+        energy = tf.reduce_sum(tf.square(wx), axis=-1)
+        dc = tf.reduce_sum(wx, axis=-1)
+        nyquist = tf.reduce_sum(wx * alternating, axis=-1)
+
+        power = (fft_length * energy + tf.square(dc) + tf.square(nyquist)) / 2
+        n_bins = fft_length // 2 + 1
+
+        return tf.reduce_mean(power, axis=-1) / n_bins
+
+    def magnitude_mean(self, signal, frame_length, frame_step, fft_length, pad_end, norm, parseval=True):
+        """
+        Mean of the STFT magnitudes raised to `norm` for each example, using
+        the Parseval fast path for the squared magnitude when possible.
+
+        :return: mean over frames and bins [b]
+        """
+        even = fft_length % 2 == 0 and frame_length <= fft_length
+
+        if parseval and norm == 2 and even:
+            return self.power_mean(
+                signal, frame_length, frame_step, fft_length, pad_end
+            )
+
+        magnitude = self.magnitude(
+            signal, frame_length, frame_step, fft_length, pad_end
+        )
+
+        return tf.reduce_mean(magnitude ** norm, axis=[1, 2])
+
+    def multi_scale_magnitude_mean(self, signal, frame_sizes, pad_end, norm, hop_ratio=2, max_ratio=4, parseval=True):
+        """
+        Mean of the STFT magnitudes raised to `norm` at several resolutions,
+        averaged over the resolutions. Each resolution uses frame and FFT
+        lengths of `frame_size` and a frame step of `frame_size * hop_ratio`.
+
+        Frame sizes are grouped so the largest size in a group is at most
+        `max_ratio` times the smallest. Every group's windowed frames are
+        zero padded to the group's largest size and transformed with one rfft.
+        The N point spectrum of a frame is every (N_max / N)-th bin of its zero
+        padded N_max point spectrum, so the results are exactly the same as
+        separate STFTs for each size.
+
+        :return: mean over resolutions, frames and bins [b]
+        """
+        frame_sizes = sorted(int(f) for f in frame_sizes)
+
+        if parseval and norm == 2 and all(f % 2 == 0 for f in frame_sizes):
+            means = [
+                self.power_mean(signal, f, f * hop_ratio, f, pad_end)
+                for f in frame_sizes
+            ]
+            return tf.reduce_mean(tf.stack(means, axis=0), axis=0)
+
+        means = list()
+
+        for group in self.group_frame_sizes(frame_sizes, max_ratio):
+
+            fft_length = group[-1]
+
+            framed = [
+                self.framed(signal, f, f * hop_ratio, pad_end) for f in group
+            ]
+            n_frames = [tf.shape(f)[1] for f in framed]
+
+            # [b, sum of frames for each size, fft_length]
+            stacked = tf.concat(
+                [
+                    tf.pad(f, [[0, 0], [0, 0], [0, fft_length - size]])
+                    for f, size in zip(framed, group)
+                ],
+                axis=1
+            )
+
+            spectra = tf.split(tf.signal.rfft(stacked), n_frames, axis=1)
+
+            for spectrum, size in zip(spectra, group):
+                stride = fft_length // size
+                bins = spectrum[:, :, ::stride][:, :, :size // 2 + 1]
+
+                magnitude = tf.cast(tf.abs(bins), tf.float32)
+                means.append(tf.reduce_mean(magnitude ** norm, axis=[1, 2]))
+
+        return tf.reduce_mean(tf.stack(means, axis=0), axis=0)
+
+    @staticmethod
+    def group_frame_sizes(frame_sizes, max_ratio):
+        """
+        Group sorted frame sizes so each size divides the group's largest size
+        and the largest is at most `max_ratio` times the smallest.
+        """
+        groups = list()
+
+        for size in sorted(frame_sizes, reverse=True):
+            for group in groups:
+                largest = group[-1]
+                if largest % size == 0 and largest <= size * max_ratio:
+                    group.insert(0, size)
+                    break
+            else:
+                groups.append([size])
+
+        return groups
@@ -0,0 +1,388 @@
+import csv
+import math
+import os
+import shutil
+import tempfile
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+from cleverspeech.eval import PerceptualStatsBatch
+from cleverspeech.utils.Utils import log
+
+from experiments.Common.Results import RunStore, STAGING_PREFIX, find_results
+
+
+# Statistics files `PerceptualStatsBatch` writes with one row per result, so
+# files for different subsets of results can be concatenated. Anything else it
+# writes (e.g. summaries over all results) is regenerated from every result.
+ROW_WISE_STATS = {"stats.csv"}
+
+# Touched by `WriteSignal` each time the results writer finishes writing.
+WRITTEN_MARKER = ".written"
+
+
+def result_files(json_path):
+    """
+    All the files belonging to one example's results -- the json document plus
+    any audio etc. written next to it with the same file name stem (e.g.
+    `x_1.json` and `x_1.wav`, but not `x_10.json`).
+    """
+    indir, name = os.path.split(json_path)
+    stem = os.path.splitext(name)[0]
+    return [
+        os.path.join(indir, f) for f in os.listdir(indir)
+        if (f == stem or f.startswith(stem + "."))
+        and os.path.isfile(os.path.join(indir, f))
+    ]
+
+
+class WriteSignal(object):
+    def __init__(self, file_writer, outdir):
+        """
+        Wraps the results writer so it touches a marker file in `outdir` every
+        time it finishes writing, so `IncrementalStats` only picks up results
+        whose files were all written before then. The writer runs in its own
+        process, so the signal goes through the file system.
+
+        :param file_writer: e.g. a `SingleFileWriter`
+        :param outdir: the experiment's output directory
+        """
+        self.file_writer = file_writer
+        self.path = os.path.join(outdir, WRITTEN_MARKER)
+
+    def __getattr__(self, name):
+
+        # don't recurse while unpickling, before `file_writer` is set
+        if name == "file_writer":
+            raise AttributeError(name)
+
+        attr = getattr(self.file_writer, name)
+
+        if not callable(attr):
+            return attr
+
+        def signalled(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            with open(self.path, "a"):
+                os.utime(self.path, None)
+            return result
+
+        return signalled
+
+
+def written_before(outdir):
+    """
+    :return: time the results writer last finished writing, or None if it
+            hasn't written anything since the marker was cleared
+    """
+    path = os.path.join(outdir, WRITTEN_MARKER)
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def merge_file(src, dst, append=True):
+    """
+    Merge a row-wise statistics file generated for a subset of results into
+    the full output file -- rows are appended and the header is only written
+    once.
+    """
+    if not append or not os.path.exists(dst):
+        shutil.copyfile(src, dst)
+        return
+
+    with open(src, "r") as in_f, open(dst, "a") as out_f:
+        reader = csv.reader(in_f)
+        writer = csv.writer(out_f)
+        next(reader, None)
+        writer.writerows(reader)
+
+
+def stage_statistics(outdir, json_paths):
+    """
+    Run `PerceptualStatsBatch` over a subset of results by symlinking them into
+    a scratch directory. Each result keeps its directory relative to `outdir`,
+    so results with the same file name in different directories don't clash.
+
+    :param outdir: the experiment's output directory
+    :param json_paths: absolute paths of the result documents to process
+    :return: the scratch directory and the names of the top level entries
+            staged in it
+    """
+    staging = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=outdir)
+
+    try:
+        staged = set()
+        for json_path in json_paths:
+            for f in result_files(json_path):
+                rel = os.path.relpath(f, outdir)
+                dst = os.path.join(staging, rel)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.symlink(os.path.abspath(f), dst)
+                staged.add(rel.split(os.sep)[0])
+
+        PerceptualStatsBatch.batch_generate_statistic_file(staging)
+
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    return staging, staged
+
+
+def merge_statistics(outdir, staging, staged, replace=(), complete=False, only=None):
+    """
+    Merge the row-wise statistics files (see `ROW_WISE_STATS`) written to a
+    scratch directory by `stage_statistics` back into `outdir` and remove the
+    scratch directory. Summary files are only copied when the staged results
+    were every result.
+
+    :param replace: names of statistics files to overwrite instead of append to
+    :param complete: whether every result was staged
+    :param only: names of the statistics files to merge (default: all)
+    :return: names of the row-wise statistics files that were merged and
+            names of the summary files
+    """
+    merged, summaries = set(), set()
+
+    try:
+        for name in os.listdir(staging):
+
+            path = os.path.join(staging, name)
+
+            if name in staged or not os.path.isfile(path):
+                continue
+
+            if only is not None and name not in only:
+                continue
+
+            dst = os.path.join(outdir, name)
+
+            if name in ROW_WISE_STATS:
+                merge_file(path, dst, append=name not in replace)
+                merged.add(name)
+            else:
+                if complete:
+                    shutil.copyfile(path, dst)
+                summaries.add(name)
+
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return merged, summaries
+
+
+def generate_statistics(outdir, json_paths, replace=(), workers=1, complete=False):
+    """
+    Generate statistics for a subset of results and merge the row-wise
+    statistics files into `outdir`. Summary files are only copied as well
+    when the subset is every result (see `generate_summaries`).
+
+    :param outdir: the experiment's output directory
+    :param json_paths: absolute paths of the result documents to process
+    :param replace: names of statistics files to overwrite instead of append to
+    :param workers: number of processes to split the results between
+    :param complete: whether `json_paths` is every result processed so far
+    :return: names of the row-wise statistics files that were merged, names
+            of the summary files and whether the summaries were copied
+    """
+    json_paths = sorted(json_paths)
+
+    if workers <= 1 or len(json_paths) <= 1:
+
+        staging, staged = stage_statistics(outdir, json_paths)
+        merged, summaries = merge_statistics(
+            outdir, staging, staged, replace=replace, complete=complete,
+        )
+
+        return merged, summaries, complete
+
+    size = int(math.ceil(len(json_paths) / workers))
+    chunks = [
+        json_paths[i:i + size] for i in range(0, len(json_paths), size)
+    ]
+
+    merged, summaries = set(), set()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(stage_statistics, outdir, chunk) for chunk in chunks
+        ]
+
+        # merge in order so the statistics files' rows stay deterministic.
+        for future in futures:
+            staging, staged = future.result()
+            chunk_merged, chunk_summaries = merge_statistics(
+                outdir, staging, staged, replace=set(replace) - merged,
+            )
+            merged.update(chunk_merged)
+            summaries.update(chunk_summaries)
+
+    return merged, summaries, False
+
+
+def generate_summaries(outdir, json_paths, names):
+    """
+    Regenerate summary statistics files from every result.
+
+    :param json_paths: absolute paths of every result document
+    :param names: names of the summary files to copy into `outdir`
+    """
+    staging, staged = stage_statistics(outdir, sorted(json_paths))
+    merge_statistics(
+        outdir, staging, staged, replace=names, complete=True, only=names,
+    )
+
+
+class IncrementalStats(object):
+    def __init__(self, outdir, workers=1, resume=True):
+        """
+        Generate statistics for results as they're written to disk by running
+        `PerceptualStatsBatch` over only the new results in a background thread.
+
+        Call `update()` whenever results might have been written (e.g. after a
+        spawn returns) and `finish()` once all attacks have completed, or just
+        call `process(final=True)` to generate statistics for every new result
+        right away. Until then, results are only picked up once the results
+        writer has signalled it's finished writing them (see `WriteSignal`).
+        Row-wise statistics files are appended to as results are processed,
+        summary files are regenerated from every result at the end.
+
+        The ids of processed results are recorded in the run's `RunStore`, so
+        re-running or resuming an experiment only processes results that are
+        new since last time. Without any recorded results (or with `resume`
+        off) statistics files left over from a previous run are overwritten
+        the first time they're merged, as every result gets reprocessed.
+
+        :param outdir: the experiment's output directory
+        :param workers: number of processes to generate statistics with
+        :param resume: skip results already recorded as processed
+        """
+        self.outdir = outdir
+        self.workers = workers
+        self.processed = set()
+        self.merged = set()
+        self.summaries = set()
+        self.summaries_stale = False
+
+        if resume:
+            with RunStore(outdir) as store:
+                self.processed = store.stats_processed()
+
+        if self.processed:
+            # append to the existing statistics files.
+            self.merged = set(os.listdir(outdir))
+
+        self.__wake = threading.Event()
+        self.__done = threading.Event()
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__loop, daemon=True)
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.__done.set()
+            self.__wake.set()
+
+    def update(self):
+        self.__wake.set()
+
+    def finish(self):
+        self.__done.set()
+        self.__wake.set()
+        self.__thread.join()
+
+        # everything has been written by now.
+        self.process(final=True)
+
+        if self.__error is not None:
+            raise self.__error
+
+    def new_results(self, final=False):
+        """
+        :param final: whether every result has been written, otherwise only
+                results the writer has signalled it finished are new
+        :return: dict of result id -> json path
+        """
+        written = None if final else written_before(self.outdir)
+
+        if not final and written is None:
+            return dict()
+
+        new = dict()
+
+        for result_id, path in find_results(self.outdir).items():
+
+            if result_id in self.processed:
+                continue
+
+            # files written at the same time as the signal might belong to
+            # the next write, so they wait for the one after.
+            if final or all(
+                os.path.getmtime(f) < written for f in result_files(path)
+            ):
+                new[result_id] = path
+
+        return new
+
+    def process(self, final=False):
+        """
+        :param final: whether every result has been written, in which case
+                summary statistics files are brought up to date too
+        """
+        new = self.new_results(final=final)
+
+        if new:
+
+            replace = {
+                f for f in os.listdir(self.outdir) if f not in self.merged
+            }
+
+            merged, summaries, current = generate_statistics(
+                self.outdir,
+                new.values(),
+                replace=replace,
+                workers=self.workers,
+                complete=not self.processed,
+            )
+
+            self.merged.update(merged)
+            self.summaries.update(summaries)
+            self.summaries_stale = self.summaries_stale or not current
+
+            self.processed.update(new.keys())
+
+            with RunStore(self.outdir) as store:
+                store.mark_stats_processed(new.keys())
+
+            log("Generated statistics for {n} new results ({t} total).".format(
+                n=len(new), t=len(self.processed)
+            ))
+
+        if final and self.summaries and self.summaries_stale:
+
+            all_paths = [
+                path for result_id, path in find_results(self.outdir).items()
+                if result_id in self.processed
+            ]
+
+            generate_summaries(self.outdir, all_paths, self.summaries)
+            self.summaries_stale = False
+
+            log("Regenerated summary statistics from {} results.".format(
+                len(all_paths)
+            ))
+
+    def __loop(self):
+        while not self.__done.is_set():
+            self.__wake.wait()
+            self.__wake.clear()
+            try:
+                self.process()
+            except Exception as e:
+                self.__error = e
+                return
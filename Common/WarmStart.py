@@ -0,0 +1,96 @@
+import numpy as np
+
+from cleverspeech.utils.Utils import log
+
+from experiments.Common.Results import RunStore
+from experiments.Common.Resume import RESULT_ID_FIELDS, example_ids, \
+    stored_id
+
+
+# Result field holding the perturbation found for an example.
+DELTAS_FIELD = "deltas"
+
+
+def prior_deltas(outdir, batch, field=DELTAS_FIELD):
+    """
+    Look up the perturbations a previous run found for each example (audio
+    and target pair) of a batch.
+
+    The previous run's result store must already be up to date (see
+    `Results.RunStore.ingest`).
+
+    :param outdir: output directory of the previous run
+    :param batch: the batch being attacked
+    :param field: result field holding the perturbations
+    :return: dict of batch row -> numpy array of the perturbation
+    """
+    audio_field, target_field = RESULT_ID_FIELDS
+
+    with RunStore(outdir) as store:
+
+        if not {audio_field, target_field} <= store.columns:
+            log("No {} fields in {}, not warm starting.".format(
+                RESULT_ID_FIELDS, outdir
+            ))
+            return dict()
+
+        rows = store.query(
+            'SELECT id, "{a}", "{t}" FROM examples'.format(
+                a=audio_field, t=target_field
+            )
+        )
+
+        lookup = {
+            (stored_id(a), stored_id(t)): example
+            for example, a, t in rows if a is not None and t is not None
+        }
+
+        deltas = dict()
+
+        for row, ex_id in enumerate(example_ids(batch)):
+
+            if ex_id not in lookup:
+                continue
+
+            try:
+                deltas[row] = np.array(store.array(lookup[ex_id], field))
+            except KeyError:
+                continue
+
+    return deltas
+
+
+def initial_deltas(deltas, size, width):
+    """
+    Stack prior perturbations into a padded [size, width] array. Examples
+    without a prior perturbation start from zero, perturbations longer than
+    `width` are truncated.
+
+    :param deltas: dict of batch row -> perturbation
+    :param size: number of examples in the batch
+    :param width: number of samples in the batch's padded audio
+    """
+    initial = np.zeros([size, width], dtype=np.float32)
+
+    for row, delta in deltas.items():
+        n = min(width, delta.shape[0])
+        initial[row, :n] = delta[:n]
+
+    return initial
+
+
+def delta_variable(attack):
+    """
+    The optimisation variable which holds the perturbation directly, i.e.
+    one with a [batch size, max samples] shape.
+
+    :return: the variable or None (e.g. synthesis attacks optimise the
+            synthesiser's parameters instead)
+    """
+    shape = [attack.batch.size, int(attack.batch.audios["max_samples"])]
+
+    for var in attack.graph.opt_vars:
+        if var.shape.as_list() == shape:
+            return var
+
+    return None
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the shared code:
+
+spawn: batches per hour of a few small baseline CTC batches with the
+    "delay" and "adaptive" spawn modes (needs the usual data and GPU).
+setup: time per batch of the same baseline batches with only a few steps
+    each, with and without persistent workers, so the time is mostly per
+    batch setup.
+edit_distance: the batched edit distances in `Metrics`, compared with
+    calculating the distance for one transcription at a time in Python.
+
+Usage: python3 benchmarks.py [benchmark ...] (default: all of them)
+"""
+import math
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from experiments.Common.Metrics import edit_distances, levenshtein
+
+
+TOKENS = " abcdefghijklmnopqrstuvwxyz'"
+BATCH_SIZES = [10, 100, 1000]
+MAX_LENGTH = 100
+N_REPEATS = 5
+
+# small baseline runs, so the runtime's own overheads aren't hidden by long
+# optimisations
+RUN_SETTINGS = {
+    "max_examples": 40,
+    "batch_size": 10,
+    "nsteps": 100,
+    "decode_step": 50,
+    "max_spawns": 2,
+}
+
+
+def random_transcriptions(n):
+    lengths = np.random.randint(1, MAX_LENGTH, n)
+    return [
+        "".join(np.random.choice(list(TOKENS), length)) for length in lengths
+    ]
+
+
+def timed(fn, *args, **kwargs):
+
+    start = time.time()
+    for _ in range(N_REPEATS):
+        result = fn(*args, **kwargs)
+
+    return (time.time() - start) / N_REPEATS, result
+
+
+def looped_distances(hypotheses, references, level="char"):
+    if level == "word":
+        return [levenshtein(h.split(), r.split()) for h, r in zip(hypotheses, references)]
+    return [levenshtein(h, r) for h, r in zip(hypotheses, references)]
+
+
+def timed_run(**settings):
+    """
+    Run the baseline CTC attack on a few batches in a temporary directory.
+
+    :param settings: anything to change from `RUN_SETTINGS`
+    :return: number of batches and the seconds they took
+    """
+    # only these benchmarks need the victim model and tensorflow
+    from experiments.CTCBaselines.attacks import ctc_run
+
+    settings = dict(RUN_SETTINGS, **settings)
+
+    with tempfile.TemporaryDirectory() as outdir:
+        settings["outdir"] = outdir
+
+        start = time.time()
+        ctc_run(settings)
+        seconds = time.time() - start
+
+    return math.ceil(settings["max_examples"] / settings["batch_size"]), seconds
+
+
+def spawn_benchmarks():
+
+    print("Spawn modes, {} examples in batches of {}:".format(
+        RUN_SETTINGS["max_examples"], RUN_SETTINGS["batch_size"]
+    ))
+
+    for mode in ["delay", "adaptive"]:
+
+        n_batches, seconds = timed_run(spawn_mode=mode)
+
+        print("{:>9}: {:8.2f} batches / hour".format(
+            mode, n_batches * 3600 / seconds
+        ))
+
+
+def setup_benchmarks():
+
+    print("Per batch setup, {} examples in batches of {}:".format(
+        RUN_SETTINGS["max_examples"], RUN_SETTINGS["batch_size"]
+    ))
+
+    for persistent in [False, True]:
+
+        n_batches, seconds = timed_run(
+            persistent=persistent,
+            spawn_mode="adaptive",
+            max_spawns=1,
+            nsteps=10,
+            decode_step=10,
+        )
+
+        print("{:>14}: {:8.2f} s / batch".format(
+            "persistent" if persistent else "new graphs", seconds / n_batches
+        ))
+
+
+def edit_distance_benchmarks():
+
+    for level in ["char", "word"]:
+
+        print("{} level edit distances:".format(level))
+
+        for batch_size in BATCH_SIZES:
+
+            np.random.seed(0)
+            hypotheses = random_transcriptions(batch_size)
+            references = random_transcriptions(batch_size)
+
+            loop_t, looped = timed(
+                looped_distances, hypotheses, references, level=level
+            )
+            batch_t, batched = timed(
+                edit_distances, hypotheses, references, level=level
+            )
+
+            print("{:>6} examples: looped {:8.2f} ms, batched {:8.2f} ms".format(
+                batch_size, loop_t * 1e3, batch_t * 1e3
+            ))
+
+            assert np.array_equal(looped, batched)
+
+
+BENCHMARKS = {
+    "spawn": spawn_benchmarks,
+    "setup": setup_benchmarks,
+    "edit_distance": edit_distance_benchmarks,
+}
+
+
+if __name__ == '__main__':
+
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -7,19 +7,20 @@ from cleverspeech.graph import Constraints
 from cleverspeech.graph import Graphs
 from cleverspeech.graph import Losses
 from cleverspeech.graph import Optimisers
-from cleverspeech.graph import Procedures
 from cleverspeech.graph import Outputs
 from cleverspeech.graph.CTCAlignmentSearch import create_tf_ctc_alignment_search_graph
 
 from cleverspeech.data import Feeds
 from cleverspeech.data.etl.batch_generators import get_standard_batch_generator
-from cleverspeech.data.etl.batch_generators import get_dense_batch_factory
-from cleverspeech.data.etl.batch_generators import get_sparse_batch_generator
-from cleverspeech.data.Results import SingleJsonDB, SingleFileWriter
-from cleverspeech.eval import PerceptualStatsBatch
-from cleverspeech.utils.RuntimeUtils import AttackSpawner
 from cleverspeech.utils.Utils import log, args
 
+from experiments.Common.BatchCache import get_cached_dense_batch_factory, \
+    get_cached_sparse_batch_generator
+from experiments.Common.Batches import get_bucketed_batch_generator
+from experiments.Common.Procedures import FusedUpdateOnDecoding, \
+    FusedCTCAlignUpdateOnDecode
+from experiments.Common.Runtime import execute
+
 # victim model import
 from SecEval import VictimAPI as DeepSpeech
 
@@ -44,6 +45,11 @@ DECODING_STEP = 100
 NUMB_STEPS = DECODING_STEP ** 2
 BATCH_SIZE = 10
 
+# Output directory of a previous run (e.g. with a different loss) to take
+# initial perturbations from. None starts every attack from zero.
+WARM_START = None
+WARM_START_RESCALE = True
+
 # extreme run settings
 LOSS_UPDATE_THRESHOLD = 10.0
 
@@ -53,40 +59,6 @@ KAPPA_HYPERS = [
 KAPPA = 0.5
 
 
-def execute(settings, attack_fn, batch_gen):
-
-    # set up the directory we'll use for results
-
-    if not os.path.exists(settings["outdir"]):
-        os.makedirs(settings["outdir"], exist_ok=True)
-
-    file_writer = SingleFileWriter(settings["outdir"])
-
-    # Write the current settings to "settings.json" file.
-
-    settings_db = SingleJsonDB(settings["outdir"])
-    settings_db.open("settings").put(settings)
-    log("Wrote settings.")
-
-    # Manage GPU memory and CPU processes usage.
-
-    attack_spawner = AttackSpawner(
-        gpu_device=settings["gpu_device"],
-        max_processes=settings["max_spawns"],
-        delay=settings["spawn_delay"],
-        file_writer=file_writer,
-    )
-
-    with attack_spawner as spawner:
-        for b_id, batch in batch_gen:
-            log("Running for Batch Number: {}".format(b_id), wrap=True)
-            spawner.spawn(settings, attack_fn, batch)
-
-    # Run the stats function on all successful examples once all attacks
-    # are completed.
-    PerceptualStatsBatch.batch_generate_statistic_file(settings["outdir"])
-
-
 def create_standard_attack_graph(sess, batch, settings):
 
     feeds = Feeds.Attack(batch)
@@ -138,7 +110,7 @@ def create_standard_attack_graph(sess, batch, settings):
         learning_rate=settings["learning_rate"]
     )
     attack.add_procedure(
-        Procedures.UpdateOnDecoding,
+        FusedUpdateOnDecoding,
         steps=settings["nsteps"],
         decode_step=settings["decode_step"],
         loss_update_idx=0,
@@ -205,7 +177,7 @@ def create_ctcalign_attack_graph(sess, batch, settings):
         learning_rate=settings["learning_rate"]
     )
     attack.add_procedure(
-        Procedures.CTCAlignUpdateOnDecode,
+        FusedCTCAlignUpdateOnDecode,
         alignment,
         steps=settings["nsteps"],
         decode_step=settings["decode_step"],
@@ -251,11 +223,13 @@ def ctc_dense_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "additional_loss": additional_loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_dense_batch_factory(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_dense_batch_factory, settings)
     execute(settings, create_standard_attack_graph, batch_gen)
     log("Finished run {}.".format(KAPPA))
 
@@ -291,11 +265,13 @@ def rctc_dense_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "additional_loss": additional_loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_dense_batch_factory(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_dense_batch_factory, settings)
     execute(settings, create_standard_attack_graph, batch_gen)
     log("Finished run {}.".format(KAPPA))
 
@@ -328,11 +304,13 @@ def dense_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "additional_loss": additional_loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_dense_batch_factory(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_dense_batch_factory, settings)
     execute(settings, create_standard_attack_graph, batch_gen)
     log("Finished run {}.".format(KAPPA))
 
@@ -368,11 +346,13 @@ def ctc_sparse_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "additional_loss": additional_loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_sparse_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_sparse_batch_generator, settings)
     execute(settings, create_standard_attack_graph, batch_gen)
     log("Finished run {}.".format(KAPPA))
 
@@ -407,11 +387,13 @@ def rctc_sparse_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "additional_loss": additional_loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_sparse_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_sparse_batch_generator, settings)
     execute(settings, create_standard_attack_graph, batch_gen)
     log("Finished run {}.".format(KAPPA))
 
@@ -443,11 +425,13 @@ def sparse_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "additional_loss": additional_loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_sparse_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_sparse_batch_generator, settings)
     execute(settings, create_standard_attack_graph, batch_gen)
     log("Finished run {}.".format(KAPPA))
 
@@ -479,11 +463,13 @@ def ctc_ctcalign_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "additional_loss": additional_loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
     execute(settings, create_ctcalign_attack_graph, batch_gen)
     log("Finished run {}.".format(KAPPA))
 
@@ -515,11 +501,13 @@ def rctc_ctcalign_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "additional_loss": additional_loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
     execute(settings, create_ctcalign_attack_graph, batch_gen)
     log("Finished run {}.".format(KAPPA))
 
@@ -551,11 +539,13 @@ def ctcalign_run(master_settings):
         "max_examples": MAX_EXAMPLES,
         "max_targets": MAX_TARGETS,
         "max_audio_length": MAX_AUDIO_LENGTH,
+        "warm_start": WARM_START,
+        "warm_start_rescale": WARM_START_RESCALE,
         "additional_loss": additional_loss,
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
     execute(settings, create_ctcalign_attack_graph, batch_gen)
     log("Finished run {}.".format(KAPPA))
 
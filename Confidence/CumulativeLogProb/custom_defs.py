@@ -3,8 +3,6 @@ from collections import OrderedDict
 import tensorflow as tf
 
 from cleverspeech.graph.Losses import BaseLogitDiffLoss
-from cleverspeech.graph.Optimisers import AdamOptimiser
-from cleverspeech.utils.Utils import lcomp
 from cleverspeech.graph.Outputs import Base as Outputs
 
 
@@ -98,39 +96,27 @@ class FwdMultBackLogProbsLoss(BaseLogProbsLoss):
         self.loss_fn *= self.weights
 
 
-class AdamOptimiserWithGrads(AdamOptimiser):
-    def create_optimiser(self):
+class LogProbOutputs(Outputs):
+    def __init__(self, attack, *args, **kwargs):
 
-        adv_optimizer = tf.train.AdamOptimizer(
-            learning_rate=self.learning_rate,
-            beta1=self.beta1,
-            beta2=self.beta2,
-            epsilon=self.epsilon,
-        )
+        super().__init__(attack, *args, **kwargs)
 
-        grad_var = adv_optimizer.compute_gradients(
-            self.attack.loss_fn,
-            self.attack.graph.opt_vars,
-            colocate_gradients_with_ops=True,
-            grad_loss=self.attack.loss[0].grads,
-        )
-        assert None not in lcomp(grad_var, i=0)
-        self.train = adv_optimizer.apply_gradients(grad_var)
-        self.variables = adv_optimizer.variables()
+        # Fetch the current target alignment's forward log probability and the
+        # log probability of the most likely alignment calculated by viberti
+        # with every optimisation step rather than running the graph again
+        # for each example.
 
+        attack.procedure.add_step_fetches(
+            t_alpha=attack.loss[0].fwd_target_log_probs,
+            ml_alpha=attack.loss[0].fwd_other_log_probs,
+        )
 
-class LogProbOutputs(Outputs):
     def custom_logging_modifications(self, log_output, batch_idx):
 
-        # Display in log files the current target alignment#s forward log
-        # probability and the log probability of the most likely alignment
-        # calculated by viberti
-
-        target_log_probs = self.attack.loss[0].fwd_target_log_probs
-        most_likely_log_probs = self.attack.loss[0].fwd_other_log_probs
+        # Display in log files
 
-        target_log_probs, most_likely_log_probs = self.attack.procedure.tf_run(
-            [target_log_probs, most_likely_log_probs]
+        target_log_probs, most_likely_log_probs = self.attack.procedure.get_fetched(
+            "t_alpha", "ml_alpha"
         )
 
         additional = OrderedDict(
@@ -148,11 +134,8 @@ class LogProbOutputs(Outputs):
 
         # As above, except write it to disk in the result json file
 
-        target_log_probs = self.attack.loss[0].fwd_target_log_probs
-        most_likely_log_probs = self.attack.loss[0].fwd_other_log_probs
-
-        target_log_probs, most_likely_log_probs = self.attack.procedure.tf_run(
-            [target_log_probs, most_likely_log_probs]
+        target_log_probs, most_likely_log_probs = self.attack.procedure.get_fetched(
+            "t_alpha", "ml_alpha"
         )
 
         additional = OrderedDict(
@@ -165,4 +148,3 @@ class LogProbOutputs(Outputs):
         db_output.update(additional)
 
         return db_output
-
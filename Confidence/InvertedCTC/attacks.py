@@ -12,13 +12,14 @@ from cleverspeech.graph.CTCAlignmentSearch import create_tf_ctc_alignment_search
 
 from cleverspeech.data import Feeds
 from cleverspeech.data.etl.batch_generators import get_standard_batch_generator
-from cleverspeech.data.etl.batch_generators import get_dense_batch_factory
-from cleverspeech.data.etl.batch_generators import get_sparse_batch_generator
-from cleverspeech.data.Results import SingleJsonDB, SingleFileWriter
-from cleverspeech.eval import PerceptualStatsBatch
-from cleverspeech.utils.RuntimeUtils import AttackSpawner
 from cleverspeech.utils.Utils import log, args
 
+from experiments.Common.BatchCache import get_cached_dense_batch_factory, \
+    get_cached_sparse_batch_generator
+from experiments.Common.Batches import get_bucketed_batch_generator
+from experiments.Common.Procedures import FusedUpdateOnDecoding
+from experiments.Common.Runtime import execute
+
 # Victim model import
 from SecEval import VictimAPI as DeepSpeech
 
@@ -47,40 +48,6 @@ BATCH_SIZE = 10
 LOSS_UPDATE_THRESHOLD = 10.0
 
 
-def execute(settings, attack_fn, batch_gen):
-
-    # set up the directory we'll use for results
-
-    if not os.path.exists(settings["outdir"]):
-        os.makedirs(settings["outdir"], exist_ok=True)
-
-    file_writer = SingleFileWriter(settings["outdir"])
-
-    # Write the current settings to "settings.json" file.
-
-    settings_db = SingleJsonDB(settings["outdir"])
-    settings_db.open("settings").put(settings)
-    log("Wrote settings.")
-
-    # Manage GPU memory and CPU processes usage.
-
-    attack_spawner = AttackSpawner(
-        gpu_device=settings["gpu_device"],
-        max_processes=settings["max_spawns"],
-        delay=settings["spawn_delay"],
-        file_writer=file_writer,
-    )
-
-    with attack_spawner as spawner:
-        for b_id, batch in batch_gen:
-            log("Running for Batch Number: {}".format(b_id), wrap=True)
-            spawner.spawn(settings, attack_fn, batch)
-
-    # Run the stats function on all successful examples once all attacks
-    # are completed.
-    PerceptualStatsBatch.batch_generate_statistic_file(settings["outdir"])
-
-
 def create_adaptive_kappa_attack_graph(sess, batch, settings):
 
     feeds = Feeds.Attack(batch)
@@ -120,7 +87,7 @@ def create_adaptive_kappa_attack_graph(sess, batch, settings):
         learning_rate=settings["learning_rate"]
     )
     attack.add_procedure(
-        Procedures.UpdateOnDecoding,
+        FusedUpdateOnDecoding,
         steps=settings["nsteps"],
         decode_step=settings["decode_step"]
     )
@@ -163,7 +130,7 @@ def dense_adaptive_kappa_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_dense_batch_factory(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_dense_batch_factory, settings)
     execute(settings, create_adaptive_kappa_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -196,7 +163,7 @@ def sparse_adaptive_kappa_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_sparse_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_sparse_batch_generator, settings)
     execute(settings, create_adaptive_kappa_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -285,7 +252,7 @@ def ctcalign_adaptive_kappa_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")
 
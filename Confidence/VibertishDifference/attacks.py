@@ -8,20 +8,22 @@ from cleverspeech.graph import Constraints
 from cleverspeech.graph import Graphs
 from cleverspeech.graph import Losses
 from cleverspeech.graph import Optimisers
-from cleverspeech.graph import Procedures
 from cleverspeech.graph.Outputs import Base as Outputs
 
 from cleverspeech.graph.CTCAlignmentSearch import create_tf_ctc_alignment_search_graph
 from cleverspeech.data.etl.batch_generators import get_standard_batch_generator
-from cleverspeech.data.etl.batch_generators import get_sparse_batch_generator
-from cleverspeech.data.etl.batch_generators import get_dense_batch_factory
 
 from cleverspeech.data import Feeds
-from cleverspeech.data.Results import SingleJsonDB, SingleFileWriter
 
-from cleverspeech.eval import PerceptualStatsBatch
-from cleverspeech.utils.RuntimeUtils import AttackSpawner
-from cleverspeech.utils.Utils import log, args, lcomp
+from cleverspeech.utils.Utils import log, args
+
+from experiments.Common.BatchCache import get_cached_dense_batch_factory, \
+    get_cached_sparse_batch_generator
+from experiments.Common.Batches import get_bucketed_batch_generator
+from experiments.Common.Optimisers import CustomGradientOptimiser
+from experiments.Common.Runtime import execute
+from experiments.Common.Procedures import FusedUpdateOnDecoding, \
+    FusedCTCAlignUpdateOnDecode
 
 # victim model import
 from SecEval import VictimAPI as DeepSpeech
@@ -65,61 +67,41 @@ LOSSES = {
 # all others instead of optimising for individual class labels per frame.
 
 
-def execute(settings, attack_fn, batch_gen):
-
-    # set up the directory we'll use for results
-
-    if not os.path.exists(settings["outdir"]):
-        os.makedirs(settings["outdir"], exist_ok=True)
-
-    file_writer = SingleFileWriter(settings["outdir"])
-
-    # Write the current settings to "settings.json" file.
-
-    settings_db = SingleJsonDB(settings["outdir"])
-    settings_db.open("settings").put(settings)
-    log("Wrote settings.")
-
-    # Manage GPU memory and CPU processes usage.
-
-    attack_spawner = AttackSpawner(
-        gpu_device=settings["gpu_device"],
-        max_processes=settings["max_spawns"],
-        delay=settings["spawn_delay"],
-        file_writer=file_writer,
-    )
+class LogProbOutputs(Outputs):
+    def __init__(self, attack, *args, **kwargs):
 
-    with attack_spawner as spawner:
-        for b_id, batch in batch_gen:
-            log("Running for Batch Number: {}".format(b_id), wrap=True)
-            spawner.spawn(settings, attack_fn, batch)
+        super().__init__(attack, *args, **kwargs)
 
-    # Run the stats function on all successful examples once all attacks
-    # are completed.
-    PerceptualStatsBatch.batch_generate_statistic_file(settings["outdir"])
+        # Fetch the current target alignment's forward log probability and the
+        # log probability of the most likely alignment calculated by viberti
+        # with every optimisation step rather than running the graph again
+        # for each example.
 
+        attack.procedure.add_step_fetches(
+            t_alpha=attack.loss[0].fwd_target_log_probs,
+            ml_alpha=attack.loss[0].fwd_current_log_probs,
+        )
 
-class LogProbOutputs(Outputs):
     def custom_logging_modifications(self, log_output, batch_idx):
 
-        # Display in log files the current target alignment#s forward log
-        # probability and the log probability of the most likely alignment
-        # calculated by viberti
-
-        target_log_probs = self.attack.loss[0].fwd_target_log_probs
-        most_likely_log_probs = self.attack.loss[0].fwd_current_log_probs
+        # Display in log files
 
-        target_log_probs, most_likely_log_probs = self.attack.procedure.tf_run(
-            [target_log_probs, most_likely_log_probs]
+        t_alpha, ml_alpha = self.attack.procedure.get_fetched(
+            "t_alpha", "ml_alpha"
         )
 
         additional = OrderedDict(
             [
-                ("t_alpha", target_log_probs[batch_idx]),
-                ("ml_alpha", most_likely_log_probs[batch_idx])
+                ("t_alpha", t_alpha[batch_idx]),
+                ("ml_alpha", ml_alpha[batch_idx])
             ]
         )
 
+        # gradient norm telemetry from optimisers which register it
+        if "grad_norm" in self.attack.procedure.step_fetches:
+            grad_norm, = self.attack.procedure.get_fetched("grad_norm")
+            additional["grad_norm"] = grad_norm[batch_idx]
+
         log_output.update(additional)
 
         return log_output
@@ -128,11 +110,8 @@ class LogProbOutputs(Outputs):
 
         # As above, except write to disk in the result json file
 
-        target_log_probs = self.attack.loss[0].fwd_target_log_probs
-        most_likely_log_probs = self.attack.loss[0].fwd_current_log_probs
-
-        t_alpha, ml_alpha = self.attack.procedure.tf_run(
-            [target_log_probs, most_likely_log_probs]
+        t_alpha, ml_alpha = self.attack.procedure.get_fetched(
+            "t_alpha", "ml_alpha"
         )
 
         additional = OrderedDict(
@@ -147,20 +126,6 @@ class LogProbOutputs(Outputs):
         return db_output
 
 
-class AdamOptimiserWithGrads(Optimisers.AdamOptimiser):
-    def create_optimiser(self):
-
-        grad_var = self.optimizer.compute_gradients(
-            self.attack.loss_fn,
-            self.attack.graph.opt_vars,
-            colocate_gradients_with_ops=True,
-            grad_loss=self.attack.loss[0].grads,
-        )
-        assert None not in lcomp(grad_var, i=0)
-        self.train = self.optimizer.apply_gradients(grad_var)
-        self.variables = self.optimizer.variables()
-
-
 def create_attack_graph(sess, batch, settings):
 
     feeds = Feeds.Attack(batch)
@@ -195,7 +160,7 @@ def create_attack_graph(sess, batch, settings):
         learning_rate=settings["learning_rate"]
     )
     attack.add_procedure(
-        Procedures.UpdateOnDecoding,
+        FusedUpdateOnDecoding,
         steps=settings["nsteps"],
         decode_step=settings["decode_step"]
     )
@@ -241,11 +206,11 @@ def create_ctcalign_attack_graph(sess, batch, settings):
     attack.create_loss_fn()
 
     attack.add_optimiser(
-        custom_defs.AdamOptimiserWithGrads,
-        learning_rate=settings["learning_rate"]
+        CustomGradientOptimiser,
+        learning_rate=settings["learning_rate"],
     )
     attack.add_procedure(
-        Procedures.CTCAlignUpdateOnDecode,
+        FusedCTCAlignUpdateOnDecode,
         alignment,
         steps=settings["nsteps"],
         decode_step=settings["decode_step"],
@@ -290,7 +255,7 @@ def dense_fwd_only_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_dense_batch_factory(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_dense_batch_factory, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -325,7 +290,7 @@ def dense_back_only_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_dense_batch_factory(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_dense_batch_factory, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -360,7 +325,7 @@ def dense_fwd_plus_back_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_dense_batch_factory(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_dense_batch_factory, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -395,7 +360,7 @@ def dense_fwd_mult_back_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_dense_batch_factory(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_dense_batch_factory, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -430,7 +395,7 @@ def sparse_fwd_only_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_sparse_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_sparse_batch_generator, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -465,7 +430,7 @@ def sparse_back_only_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_sparse_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_sparse_batch_generator, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -500,7 +465,7 @@ def sparse_fwd_plus_back_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_sparse_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_sparse_batch_generator, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -535,7 +500,7 @@ def sparse_fwd_mult_back_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_sparse_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_cached_sparse_batch_generator, settings)
     execute(settings, create_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -570,7 +535,7 @@ def ctcalign_fwd_only_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
     execute(settings, create_ctcalign_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -605,7 +570,7 @@ def ctcalign_back_only_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
     execute(settings, create_ctcalign_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -640,7 +605,7 @@ def ctcalign_fwd_plus_back_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
     execute(settings, create_ctcalign_attack_graph, batch_gen)
     log("Finished run.")
 
@@ -675,7 +640,7 @@ def ctcalign_fwd_mult_back_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
     execute(settings, create_ctcalign_attack_graph, batch_gen)
     log("Finished run.")
 
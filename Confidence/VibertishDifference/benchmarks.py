@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the viberti passes used by the Vibertish losses.
+
+Compares the unrolled (one `reduce_max` op per frame) implementation against
+`custom_defs.batch_viterbi` for graph build time and per-step latency.
+
+Usage: python3 benchmarks.py [n_runs]
+"""
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import custom_defs
+
+
+BATCH_SIZE = 10
+N_TOKENS = 29
+N_FRAMES = [50, 250, 750]
+N_RUNS = 100
+
+
+def unrolled_viterbi(log_softmax):
+    """
+    The unrolled forward + backward passes, one python loop iteration (and set
+    of graph ops) per frame per direction.
+    """
+    batch_size = log_softmax.get_shape().as_list()[0]
+
+    def one_direction(x):
+        res = list()
+        best_alpha = tf.zeros([batch_size], tf.float32)
+        for current_log_probs in tf.unstack(x, axis=1):
+            alpha_log_probs = current_log_probs + best_alpha[:, tf.newaxis]
+            best_alpha = tf.reduce_max(alpha_log_probs, axis=-1)
+            res.append(best_alpha)
+        return tf.stack(res, axis=1)
+
+    fwd = one_direction(log_softmax)
+    back = one_direction(tf.reverse(log_softmax, axis=[1]))
+
+    return fwd, back
+
+
+def vectorised_viterbi(log_softmax):
+    lengths = tf.fill([log_softmax.get_shape().as_list()[0]], tf.shape(log_softmax)[1])
+    return custom_defs.batch_viterbi(log_softmax, lengths=lengths)
+
+
+def benchmark(viterbi_fn, n_frames, n_runs):
+
+    graph = tf.Graph()
+
+    with graph.as_default():
+
+        start = time.time()
+        x = tf.placeholder(tf.float32, [BATCH_SIZE, n_frames, N_TOKENS])
+        fwd, back = viterbi_fn(tf.nn.log_softmax(x))
+        build_time = time.time() - start
+        n_ops = len(graph.get_operations())
+
+        feed = {x: np.random.randn(BATCH_SIZE, n_frames, N_TOKENS)}
+
+        with tf.Session(graph=graph) as sess:
+
+            # warm up
+            results = sess.run([fwd, back], feed_dict=feed)
+
+            start = time.time()
+            for _ in range(n_runs):
+                sess.run([fwd, back], feed_dict=feed)
+            step_time = (time.time() - start) / n_runs
+
+    return build_time, step_time, n_ops, results
+
+
+def main(n_runs):
+
+    header = "{:>8} {:>12} {:>8} {:>14} {:>14}".format(
+        "frames", "impl", "ops", "build (ms)", "step (ms)"
+    )
+    print(header)
+    print("-" * len(header))
+
+    for n_frames in N_FRAMES:
+
+        outputs = dict()
+
+        for name, fn in [("unrolled", unrolled_viterbi), ("vectorised", vectorised_viterbi)]:
+
+            build_time, step_time, n_ops, outputs[name] = benchmark(
+                fn, n_frames, n_runs
+            )
+
+            print("{:>8} {:>12} {:>8} {:>14.2f} {:>14.3f}".format(
+                n_frames, name, n_ops, build_time * 1e3, step_time * 1e3
+            ))
+
+        # sanity check that both implementations agree.
+        for a, b in zip(outputs["unrolled"], outputs["vectorised"]):
+            assert np.allclose(a, b, atol=1e-3)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else N_RUNS)
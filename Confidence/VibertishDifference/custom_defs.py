@@ -1,9 +1,74 @@
+import numpy as np
 import tensorflow as tf
 
 from cleverspeech.graph.Losses import BaseLoss, BaseLogitDiffLoss
 
 
-class BaseVibertishLoss(BaseLogitDiffLoss):
+def batch_viterbi(log_softmax, lengths=None):
+    """
+    Run the viberti forward and backward passes over a batch of log softmax
+    outputs in one go.
+
+    There's no transition term in the recurrence, so the best alpha at time t
+    is max(current + previous) == max(current) + previous. That means the whole
+    recurrence collapses into a cumulative sum of the per-frame maxima, which
+    keeps the graph a constant size regardless of the number of frames instead
+    of unrolling one `reduce_max` op per frame, per direction.
+
+    Frames beyond each example's actual length are masked to zero so padding
+    never contributes to the cumulative log probabilities.
+
+    :param log_softmax: negative value tensor [batch size, n_frames, tokens]
+    :param lengths: actual number of frames per example [batch size] or None
+    :return: forward and backward cumulative log probabilities, both of shape
+        [batch size, n_frames]
+    """
+
+    best_per_frame = tf.reduce_max(log_softmax, axis=-1)
+
+    if lengths is not None:
+        mask = tf.sequence_mask(
+            lengths,
+            maxlen=tf.shape(best_per_frame)[1],
+            dtype=best_per_frame.dtype,
+        )
+        best_per_frame *= mask
+
+    # stack the forward and reversed frames so both directions are calculated
+    # by the same cumsum op.
+    both_directions = tf.stack(
+        [best_per_frame, tf.reverse(best_per_frame, axis=[1])],
+        axis=0
+    )
+    fwd, back = tf.unstack(tf.cumsum(both_directions, axis=2), axis=0)
+
+    return fwd, back
+
+
+def frame_lengths(batch, name):
+    """
+    Number of frames of each example, as a placeholder defaulting to the
+    batch's values so refilled examples can feed their own (see
+    `extra_feeds`).
+    """
+    return tf.placeholder_with_default(
+        np.asarray(batch.audios["ds_feats"], dtype=np.int32),
+        shape=[batch.size],
+        name=name,
+    )
+
+
+class FrameLengthFeeds(object):
+    """
+    Feeds the `n_frames` placeholder of a loss built with `frame_lengths`.
+    """
+    def extra_feeds(self, batch):
+        return {
+            self.n_frames: np.asarray(batch.audios["ds_feats"], dtype=np.int32)
+        }
+
+
+class BaseVibertishLoss(FrameLengthFeeds, BaseLogitDiffLoss):
     def __init__(self, attack_graph, target_argmax, weight_settings=(None, None)):
 
         super().__init__(
@@ -13,13 +78,27 @@ class BaseVibertishLoss(BaseLogitDiffLoss):
             softmax=True
         )
 
+        self.n_frames = frame_lengths(attack_graph.batch, "vibertish_n_frames")
+
+        # mask the target side with the same frames as the current side, so
+        # both cumulative log probabilities cover only the real frames.
         log_smax_target = tf.log(self.target_logit)
+        log_smax_target = tf.where(
+            tf.sequence_mask(
+                self.n_frames, maxlen=tf.shape(log_smax_target)[1]
+            ),
+            log_smax_target,
+            tf.zeros_like(log_smax_target),
+        )
+
         fwd_target = self.target_probs(log_smax_target)
         back_target = self.target_probs(log_smax_target, backward_pass=True)
 
         log_smax_current = tf.log(self.current + 1e-8)
-        fwd_current = self.viberti_probs(log_smax_current)
-        back_current = self.viberti_probs(log_smax_current, backward_pass=True)
+        fwd_current, back_current = batch_viterbi(
+            log_smax_current,
+            lengths=self.n_frames,
+        )
 
         # comparison log probabilities to calcalute loss.
         self.fwd_target_log_probs = fwd_target[:, -1]
@@ -42,52 +121,15 @@ class BaseVibertishLoss(BaseLogitDiffLoss):
         Calculate the most likely alignment based on the Viberti forward pass
 
         :param log_softmax: negative value tensor [batch size, n_frames, tokens]
-        :return: vector of alpha log probability estimates [n_frames]
-        """
-
-        if backward_pass:
-            log_softmax = tf.reverse(log_softmax, axis=[1])
-
-        frames = tf.unstack(log_softmax, axis=1)
-        batch_size = log_softmax.get_shape().as_list()[0]
-
-        log_probs = tf.stack(self.__viberti(frames, batch_size), axis=1)
-
-        return log_probs
-
-    @staticmethod
-    def __viberti(frames, batch_size):
-        """
-        Run the viberti algorithm on the log softmax outputs.
-
-        TODO: Handle the batch dimension.
-
-        :param frames: unstacked list of tensors of size [batch, tokens]
-        :return: vector of cumulative log probabilities [n_frames]
+        :return: alpha log probability estimates [batch size, n_frames]
         """
 
-        res = list()
-        best_alpha = tf.zeros([batch_size, 1], tf.float32)
-
-        for current_log_probs in frames:
-            # at first step, max of current because previous = 0
-            # at second step, max of current + previous
-            # at third step, max of current + previous
-            # ...
-            # at time = t, max of current + previous
-
-            # for each time we want to find the best alpha (cumulative log prob)
-            # we can then just keep that one and ignore all others
-
-            alpha_log_probs = current_log_probs + best_alpha
-            best_alpha = tf.reduce_max(alpha_log_probs, axis=-1)
-
-            res.append(best_alpha)
+        fwd, back = batch_viterbi(log_softmax)
 
-        return res
+        return back if backward_pass else fwd
 
 
-class VibertiMostLikely(BaseLoss):
+class VibertiMostLikely(FrameLengthFeeds, BaseLoss):
     def __init__(self, attack_graph, weight_settings=(None, None)):
 
         super().__init__(
@@ -96,48 +138,15 @@ class VibertiMostLikely(BaseLoss):
             weight_settings=weight_settings
         )
 
-        smax_log = tf.log(attack_graph.victm.logits + 1e-8)
-        self.fwd_most_likely = self.viberti_probs(smax_log)
-
-    def viberti_probs(self, log_softmax, backward_pass=False):
-        """
-        Calculate the most likely alignment based on the Viberti forward pass
-
-        :param log_softmax: negative value tensor [batch size, n_frames, tokens]
-        :return: vector of alpha log probability estimates [n_frames]
-        """
-
-        if backward_pass:
-            log_softmax = tf.reverse(log_softmax, axis=[1])
-
-        log_probs = self.__viberti(log_softmax)
-
-        return log_probs
-
-    @staticmethod
-    def __viberti(log_softmax):
-        """
-        Run the viberti algorithm on the log softmax outputs to find the log
-        probs, per frame, of the most likely alignment.
-
-        TODO: Handle the batch dimension.
-
-        :param frames: unstacked list of tensors of size [batch, tokens]
-        :return: vector of cumulative log probabilities [n_frames]
-        """
-        batch_size = log_softmax.get_shape().as_list()[0]
-        res = list()
-        best_alpha = tf.zeros([batch_size, 1], tf.float32)
-        frames = tf.unstack(log_softmax, axis=1)
-
-        for current_log_probs in frames:
-
-            alpha_log_probs = current_log_probs + best_alpha
-            best_alpha = tf.reduce_max(alpha_log_probs, axis=-1)
-
-            res.append(best_alpha)
+        self.n_frames = frame_lengths(
+            attack_graph.batch, "viberti_most_likely_n_frames"
+        )
 
-        return tf.stack(res)
+        smax_log = tf.log(attack_graph.victm.logits + 1e-8)
+        self.fwd_most_likely, _ = batch_viterbi(
+            smax_log,
+            lengths=self.n_frames,
+        )
 
 
 class FwdOnlyVibertish(BaseVibertishLoss):
@@ -5,6 +5,118 @@ from experiments.Perceptual.Synthesis.Synthesisers.Base import Synth
 from cleverspeech.utils.Utils import np_one
 
 
+def frame_audio(audios, frame_length, frame_step):
+    """
+    Split a batch of audio into frames.
+
+    :param audios: padded audio examples [b, maxlen]
+    :param frame_length: number of samples per frame
+    :param frame_step: number of samples between the start of each frame
+    :return: framed audio [b, n_frames, frame_length]
+    """
+    audios = np.asarray(audios, dtype=np.float32)
+    n_frames = ((audios.shape[1] - frame_length) // frame_step) + 1
+
+    idx = np.arange(frame_length)[np.newaxis, :]
+    idx = idx + frame_step * np.arange(n_frames)[:, np.newaxis]
+
+    return audios[:, idx]
+
+
+def estimate_pitch(audios, frame_length, frame_step, sample_rate, default_hz, min_hz=50.0, max_hz=500.0):
+    """
+    Estimate the pitch track of a batch of audio with per-frame autocorrelation.
+
+    Frames without any energy or any clear periodicity within the search range
+    are set to the default frequency.
+
+    :param audios: padded audio examples [b, maxlen]
+    :param frame_length: number of samples per frame
+    :param frame_step: number of samples between the start of each frame
+    :param sample_rate: sample rate of the audio
+    :param default_hz: frequency to use for frames without a pitch estimate
+    :param min_hz: lowest pitch to search for
+    :param max_hz: highest pitch to search for
+    :return: pitch in Hz for each frame [b, n_frames, 1]
+    """
+    frames = frame_audio(audios, frame_length, frame_step)
+    frames = frames - frames.mean(axis=-1, keepdims=True)
+
+    # autocorrelation via the power spectrum, zero padded so it's not circular
+    spectrum = np.fft.rfft(frames, n=2 * frame_length, axis=-1)
+    autocorr = np.fft.irfft(np.abs(spectrum) ** 2, axis=-1)[..., :frame_length]
+
+    min_lag = max(1, int(sample_rate // max_hz))
+    max_lag = min(frame_length - 1, int(sample_rate // min_hz))
+
+    if max_lag <= min_lag:
+        return np.full(frames.shape[:2] + (1,), default_hz, dtype=np.float32)
+
+    lags = min_lag + np.argmax(autocorr[..., min_lag:max_lag], axis=-1)
+    peaks = np.take_along_axis(autocorr, lags[..., np.newaxis], axis=-1)[..., 0]
+
+    energy = autocorr[..., 0]
+    voiced = (energy > 0) & (peaks > 0.3 * energy)
+
+    pitch = np.where(voiced, sample_rate / lags, default_hz)
+
+    return pitch[..., np.newaxis].astype(np.float32)
+
+
+def harmonic_init(batch, n_frames, n_osc, initial_hz, **_):
+    """
+    Every oscillator starts on a harmonic of the initial frequency.
+    With one oscillator this is a constant fundamental frequency.
+
+    :return: initial frequencies [b, n_frames, n_osc]
+    """
+    harmonics = np.arange(1, n_osc + 1, dtype=np.float32)
+    return np.broadcast_to(
+        initial_hz * harmonics,
+        (batch.size, n_frames, n_osc)
+    ).astype(np.float32)
+
+
+def uniform_init(batch, n_frames, n_osc, initial_hz, **_):
+    """
+    Every oscillator starts on the initial frequency scaled randomly between
+    0.1 and 1.0, drawn once per example and oscillator.
+
+    :return: initial frequencies [b, n_frames, n_osc]
+    """
+    rand = np.random.uniform(0.1, 1.0, (batch.size, 1, n_osc))
+    return np.broadcast_to(
+        initial_hz * rand,
+        (batch.size, n_frames, n_osc)
+    ).astype(np.float32)
+
+
+def pitch_init(batch, n_frames, n_osc, initial_hz, frame_length=None, frame_step=None, sample_rate=None):
+    """
+    Oscillators start on the harmonics of the original audio's pitch track,
+    falling back to the initial frequency for unvoiced frames.
+
+    :return: initial frequencies [b, n_frames, n_osc]
+    """
+    pitch = estimate_pitch(
+        batch.audios["padded_audio"],
+        frame_length,
+        frame_step,
+        sample_rate,
+        initial_hz
+    )[:, :n_frames, :]
+
+    harmonics = np.arange(1, n_osc + 1, dtype=np.float32)
+    return (pitch * harmonics[np.newaxis, np.newaxis, :]).astype(np.float32)
+
+
+INITIALISERS = {
+    "harmonic": harmonic_init,
+    "uniform": uniform_init,
+    "pitch": pitch_init,
+}
+
+
 class Additive(Synth):
     @staticmethod
     def _exp_sigmoid(x, exponent=10.0, max_value=2.0, threshold=1e-7):
@@ -83,60 +195,63 @@ class Additive(Synth):
 
         :param actlen: actual length of the original example in samples
         :param maxlen: maximum length in the batch of original examples
-        :return: masked delta
+        :return: 0/1 valued masks [b, maxlen]
         """
-        for l in actlen:
-            m = list()
-            for i in range(maxlen):
-                if i < l:
-                    m.append(1)
-                else:
-                    m.append(0)
-            yield m
+        actlen = np.asarray(actlen)[:, np.newaxis]
+        return (np.arange(maxlen)[np.newaxis, :] < actlen).astype(np.int32)
 
     @staticmethod
-    def _gen_f0_hz(batch_size, n_frames, starting_f0_hz):
+    def _init_hz(initialiser, batch, n_frames, n_osc, initial_hz, **kwargs):
         """
-        Initialise dependent frequency variables.
+        Initialise frequency variables with one of the `INITIALISERS`.
 
-        :param batch_size: size of batch data.
-        :param n_frames: number of samples (this is maxlen)
-        :param starting_f0_hz: initial fundamental frequency.
-        :return: vector of the fundamental frequency for each example in a batch
-                -- shape [b, n_frames].
+        :param initialiser: name of the initialisation strategy.
+        :param batch: batch data from the BatchFactory.
+        :param n_frames: number of frames.
+        :param n_osc: number of independent oscillators.
+        :param initial_hz: initial (fundamental) frequency.
+        :return: initial frequencies for each example in a batch
+                -- shape [b, n_frames, n_osc].
         """
-        for _ in range(batch_size):
-            b = list()
-            for _ in range(n_frames):
-                b.append([starting_f0_hz])
-            yield b
+        if initialiser not in INITIALISERS:
+            raise ValueError(
+                "Unknown frequency initialiser: {}".format(initialiser)
+            )
 
-    @staticmethod
-    def _gen_hz(batch_size, n_frames, n_osc, starting_f0_hz=220):
+        return INITIALISERS[initialiser](
+            batch, n_frames, n_osc, initial_hz, **kwargs
+        )
+
+    def _init_hz_input(self, initialiser, batch, n_frames, n_osc, initial_hz, **kwargs):
         """
-        Initialise independent frequency variables.
+        Initial frequencies from `_init_hz` as a placeholder defaulting to
+        this batch's values, so examples swapped into the batch later can
+        feed their own (see `extra_feeds`).
 
-        :param batch_size: size of batch data.
-        :param n_frames: number of samples (this is maxlen).
-        :param n_osc: number of totoal oscillators.
-        :param starting_f0_hz: initial fundamental frequency.
-        :return: vector of the fundamental frequency for each example in a batch
-                -- shape [b, n_frames, n_osc].
+        :return: placeholder of initial frequencies -- [b, n_frames, n_osc].
+        """
+        self.init_hz_args = (initialiser, n_frames, n_osc, initial_hz, kwargs)
+
+        self.initial_hz = tf.placeholder_with_default(
+            self._init_hz(
+                initialiser, batch, n_frames, n_osc, initial_hz, **kwargs
+            ),
+            shape=[batch.size, n_frames, n_osc],
+            name="qq_initial_freq",
+        )
+        return self.initial_hz
+
+    def extra_feeds(self, batch):
+        """
+        Feed the initial frequencies of the batch's current examples.
         """
-        for _ in range(batch_size):
-            a = list()
-            rand = np.random.uniform(0.1, 1.0, n_osc)
-            for _ in range(n_frames):
-                # start somewhat harmonically, otherwise the frequencies values
-                # stick around the same position
-                halfway_harmonic = np.linspace(float(1), float(n_osc), n_osc)
-                flat = np.linspace(float(1), float(1), n_osc)
-                # then uniformly randomise it by scaling the frequencies up or
-                # down by factor of 2
-
-                random_harmonic = starting_f0_hz * halfway_harmonic * rand
-                a.append(starting_f0_hz * flat * rand)
-            yield a
+        initialiser, n_frames, n_osc, initial_hz, kwargs = self.init_hz_args
+
+        return {
+            self.initial_hz: self._init_hz(
+                initialiser, batch, n_frames, n_osc, initial_hz, **kwargs
+            )
+        }
 
     def __init__(
             self,
@@ -258,6 +373,7 @@ class FullyHarmonic(Additive):
             normalise=True,
             initial_hz=440,
             initial_amp=0,
+            initialiser="harmonic",
     ):
         """
         Attack Graph for Harmonic Additive Synthesis.
@@ -270,6 +386,7 @@ class FullyHarmonic(Additive):
         :param normalise: whether to normalise the oscillator bank or not.
         :param initial_hz: initial frequency for fundamental oscillator
         :param initial_amp: initial amplitude for *all* oscillators
+        :param initialiser: how to initialise the fundamental frequency
         :param alpha: scaling factor for amplitude values
         """
 
@@ -287,15 +404,18 @@ class FullyHarmonic(Additive):
         self.n_frames = n_frames = ((maxlen - frame_length) // frame_step) + 1
 
         # batch_size * time * 1
-        f0 = np.array(
-            [f for f in self._gen_f0_hz(batch_size, n_frames, initial_hz)],
-            dtype=np.float32
+        f0 = self._init_hz_input(
+            initialiser,
+            batch,
+            n_frames,
+            1,
+            initial_hz,
+            frame_length=frame_length,
+            frame_step=frame_step,
+            sample_rate=sample_rate,
         )
         # batch_size * time * 1
-        a0 = np.array(
-            [f for f in self._gen_f0_hz(batch_size, n_frames, initial_amp)],
-            dtype=np.float32
-        )
+        a0 = initial_amp * np_one((batch_size, n_frames, 1), np.float32)
         freq_deltas = tf.Variable(
             f0,
             trainable=True,
@@ -370,6 +490,7 @@ class FreqHarmonic(Additive):
             waveform=tf.sin,
             initial_hz=440,
             initial_amp=0,
+            initialiser="harmonic",
     ):
         """
         Attack Graph for Harmonic Additive Synthesis.
@@ -382,6 +503,7 @@ class FreqHarmonic(Additive):
         :param normalise: whether to normalise the oscillator bank or not.
         :param initial_hz: initial frequency for fundamental oscillator.
         :param initial_amp: initial amplitude for *all* oscillators.
+        :param initialiser: how to initialise the fundamental frequency.
         :param alpha: scaling factor for amplitude values
         """
 
@@ -399,9 +521,15 @@ class FreqHarmonic(Additive):
         self.n_frames = n_frames = ((maxlen - frame_length) // frame_step) + 1
 
         # batch_size * time * 1
-        f0 = np.array(
-            [f for f in self._gen_f0_hz(batch_size, n_frames, initial_hz)],
-            dtype=np.float32
+        f0 = self._init_hz_input(
+            initialiser,
+            batch,
+            n_frames,
+            1,
+            initial_hz,
+            frame_length=frame_length,
+            frame_step=frame_step,
+            sample_rate=sample_rate,
         )
         freq_deltas = tf.Variable(
             f0,
@@ -469,6 +597,7 @@ class InHarmonic(Additive):
             normalise=True,
             initial_hz=440,
             initial_amp=0,
+            initialiser="uniform",
     ):
         """
         Attack Graph for Inharmonic Additive Synthesis.
@@ -481,6 +610,7 @@ class InHarmonic(Additive):
         :param normalise: whether to normalise the oscillator bank or not.
         :param initial_hz: initial frequency for *all* oscillators.
         :param initial_amp: initial amplitude for *all* oscillators.
+        :param initialiser: how to initialise the oscillator frequencies.
         :param alpha: scaling factor for amplitude values
         """
         # == Sanity check inputs
@@ -495,10 +625,15 @@ class InHarmonic(Additive):
         self.n_frames = n_frames = ((maxlen - frame_length) // frame_step) + 1
 
         # batch_size * time * n_osc
-        f = np.array(
-            [f for f in
-             self._gen_hz(batch_size, n_frames, n_osc, initial_hz)],
-            dtype=np.float32
+        f = self._init_hz_input(
+            initialiser,
+            batch,
+            n_frames,
+            n_osc,
+            initial_hz,
+            frame_length=frame_length,
+            frame_step=frame_step,
+            sample_rate=sample_rate,
         )
 
         freq_deltas = tf.Variable(
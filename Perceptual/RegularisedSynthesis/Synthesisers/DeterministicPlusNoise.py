@@ -23,6 +23,9 @@ class FreqHarmonicPlusPlain(Synth):
         super().__init__()
         super().add_opt_vars(*self.det.opt_vars, *self.noise.opt_vars)
 
+    def extra_feeds(self, batch):
+        return self.det.extra_feeds(batch)
+
     def synthesise(self):
 
         weighted_det = (1.0 - self.noise_weight) * self.det.synthesise()
@@ -51,6 +54,9 @@ class FullyHarmonicPlusPlain(Synth):
         super().__init__()
         super().add_opt_vars(*self.det.opt_vars, *self.noise.opt_vars)
 
+    def extra_feeds(self, batch):
+        return self.det.extra_feeds(batch)
+
     def synthesise(self):
         weighted_det = (1.0 - self.noise_weight) * self.det.synthesise()
         weighted_noise = self.noise_weight * self.noise.synthesise()
@@ -78,6 +84,9 @@ class InharmonicPlusPlain(Synth):
         super().__init__()
         super().add_opt_vars(*self.det.opt_vars, *self.noise.opt_vars)
 
+    def extra_feeds(self, batch):
+        return self.det.extra_feeds(batch)
+
     def synthesise(self):
         weighted_det = (1.0 - self.noise_weight) * self.det.synthesise()
         weighted_noise = self.noise_weight * self.noise.synthesise()
@@ -11,11 +11,12 @@ from cleverspeech.graph import Outputs
 from cleverspeech.data import Feeds
 
 from cleverspeech.data.etl.batch_generators import get_standard_batch_generator
-from cleverspeech.data.Results import SingleJsonDB, SingleFileWriter
-from cleverspeech.eval import PerceptualStatsBatch
-from cleverspeech.utils.RuntimeUtils import AttackSpawner
 from cleverspeech.utils.Utils import log, args, lcomp
 
+from experiments.Common.Batches import get_bucketed_batch_generator
+from experiments.Common.Optimisers import BatchwiseAdamOptimiser
+from experiments.Common.Runtime import execute
+
 from SecEval import VictimAPI as DeepSpeech
 
 from experiments.Perceptual.Synthesis.Synthesisers import Spectral, \
@@ -38,6 +39,7 @@ MAX_AUDIO_LENGTH = 120000
 TOKENS = " abcdefghijklmnopqrstuvwxyz'-"
 BEAM_WIDTH = 500
 LEARNING_RATE = 10
+OPTIMISER = "adam"
 CONSTRAINT_UPDATE = "geom"
 RESCALE = 0.95
 DECODING_STEP = 100
@@ -53,6 +55,7 @@ SPECTRAL_FRAME_STEP = 256
 SPECTRAL_FRAME_LENGTH = 256
 SPECTRAL_FFT_LENGTH = 256
 SPECTRAL_CONSTANT = 64
+SPECTRAL_N_SCALES = 8
 
 SYNTHS = {
     "inharmonic": Additive.InHarmonic,
@@ -64,39 +67,12 @@ SYNTHS = {
     "stft": Spectral.STFT,
 }
 
-
-def execute(settings, attack_fn, batch_gen):
-
-    # set up the directory we'll use for results
-
-    if not os.path.exists(settings["outdir"]):
-        os.makedirs(settings["outdir"], exist_ok=True)
-
-    file_writer = SingleFileWriter(settings["outdir"])
-
-    # Write the current settings to "settings.json" file.
-
-    settings_db = SingleJsonDB(settings["outdir"])
-    settings_db.open("settings").put(settings)
-    log("Wrote settings.")
-
-    # Manage GPU memory and CPU processes usage.
-
-    attack_spawner = AttackSpawner(
-        gpu_device=settings["gpu_device"],
-        max_processes=settings["max_spawns"],
-        delay=settings["spawn_delay"],
-        file_writer=file_writer,
-    )
-
-    with attack_spawner as spawner:
-        for b_id, batch in batch_gen:
-            log("Running for Batch Number: {}".format(b_id), wrap=True)
-            spawner.spawn(settings, attack_fn, batch)
-
-    # Run the stats function on all successful examples once all attacks
-    # are completed.
-    PerceptualStatsBatch.batch_generate_statistic_file(settings["outdir"])
+# "batchwise_adam" keeps separate Adam state for every example so padding and
+# other examples in the batch don't slow down optimising the shorter ones.
+OPTIMISERS = {
+    "adam": Optimisers.AdamOptimiser,
+    "batchwise_adam": BatchwiseAdamOptimiser,
+}
 
 
 def create_attack_graph(sess, batch, settings):
@@ -128,7 +104,7 @@ def create_attack_graph(sess, batch, settings):
     attack.create_loss_fn()
 
     attack.add_optimiser(
-        Optimisers.AdamOptimiser,
+        OPTIMISERS[settings["optimiser"]],
         learning_rate=settings["learning_rate"]
     )
 
@@ -169,6 +145,7 @@ def inharmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": 1e-8,
@@ -185,7 +162,7 @@ def inharmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -214,6 +191,7 @@ def freq_harmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": 1e-8,
@@ -230,7 +208,7 @@ def freq_harmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -259,6 +237,7 @@ def full_harmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": 1e-8,
@@ -275,7 +254,7 @@ def full_harmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -304,6 +283,7 @@ def detnoise_inharmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": 1e-8,
@@ -320,7 +300,7 @@ def detnoise_inharmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -349,6 +329,7 @@ def detnoise_freq_harmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": 1e-8,
@@ -365,7 +346,7 @@ def detnoise_freq_harmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -394,6 +375,7 @@ def detnoise_full_harmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": 1e-8,
@@ -410,7 +392,7 @@ def detnoise_full_harmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -458,7 +440,7 @@ def spectral_regularised_run(master_settings):
         attack.create_loss_fn()
 
         attack.add_optimiser(
-            Optimisers.AdamOptimiser,
+            OPTIMISERS[settings["optimiser"]],
             learning_rate=settings["learning_rate"]
         )
 
@@ -507,6 +489,7 @@ def spectral_regularised_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "frame_step": run,
                 "frame_length": run,
@@ -521,19 +504,127 @@ def spectral_regularised_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
         log("Finished run.")  # {}.".format(run))
 
 
+def spectral_multiscale_run(master_settings):
+    """
+    STFT synthesiser at a single resolution (`SPECTRAL_FRAME_LENGTH`) with a
+    multi-scale spectral loss on the perturbation, evaluated at
+    `SPECTRAL_N_SCALES` frame sizes from `SPECTRAL_CONSTANT` up in one graph.
+
+    This isn't a replacement for `spectral_regularised_run`: that sweep runs
+    the synthesiser itself at each frame size, with the single scale spectral
+    loss, so it's kept as a separate experiment.
+
+    :return: None
+    """
+    def create_attack_graph(sess, batch, settings):
+
+        synth_cls = SYNTHS[settings["synth_cls"]]
+        synth = synth_cls(batch, **settings["synth"])
+
+        feeds = Feeds.Attack(batch)
+        attack = Constructor(sess, batch, feeds)
+
+        attack.add_hard_constraint(
+            Constraints.L2,
+            r_constant=settings["rescale"],
+            update_method=settings["constraint_update"],
+        )
+
+        attack.add_graph(
+            custom_defs.SynthesisAttack,
+            synth
+        )
+
+        attack.add_victim(
+            DeepSpeech.Model,
+            tokens=settings["tokens"],
+            beam_width=settings["beam_width"]
+        )
+
+        attack.add_loss(CTCLoss)
+        attack.add_loss(
+            custom_defs.MultiScaleSpectralLoss,
+            frame_sizes=settings["spectral_frame_sizes"],
+        )
+        attack.create_loss_fn()
+
+        attack.add_optimiser(
+            OPTIMISERS[settings["optimiser"]],
+            learning_rate=settings["learning_rate"]
+        )
+
+        attack.add_procedure(
+            custom_defs.UpdateOnDecodingSynth,
+            steps=settings["nsteps"],
+            decode_step=settings["decode_step"]
+        )
+
+        attack.add_outputs(
+            Outputs.Base,
+            settings["outdir"],
+        )
+
+        attack.create_feeds()
+
+        return attack
+
+    synth = "stft"
+
+    outdir = os.path.join(OUTDIR, synth + "/")
+    outdir = os.path.join(outdir, "multiscale/")
+
+    settings = {
+        "synth_cls": synth,
+        "audio_indir": AUDIOS_INDIR,
+        "targets_path": TARGETS_PATH,
+        "outdir": outdir,
+        "batch_size": BATCH_SIZE,
+        "tokens": TOKENS,
+        "nsteps": NUMB_STEPS,
+        "decode_step": DECODING_STEP,
+        "beam_width": BEAM_WIDTH,
+        "constraint_update": CONSTRAINT_UPDATE,
+        "rescale": RESCALE,
+        "learning_rate": LEARNING_RATE,
+        "optimiser": OPTIMISER,
+        "synth": {
+            "frame_step": SPECTRAL_FRAME_STEP,
+            "frame_length": SPECTRAL_FRAME_LENGTH,
+            "fft_length": SPECTRAL_FFT_LENGTH * 2,
+        },
+        "spectral_frame_sizes": [
+            SPECTRAL_CONSTANT * 2 ** i for i in range(SPECTRAL_N_SCALES)
+        ],
+        "gpu_device": GPU_DEVICE,
+        "max_spawns": MAX_PROCESSES,
+        "spawn_delay": SPAWN_DELAY,
+        "max_examples": MAX_EXAMPLES,
+        "max_targets": MAX_TARGETS,
+        "max_audio_length": MAX_AUDIO_LENGTH,
+    }
+
+    settings.update(master_settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
+
+    execute(settings, create_attack_graph, batch_gen)
+
+    log("Finished run.")
+
+
 if __name__ == '__main__':
 
     log("", wrap=True)
 
     experiments = {
         "stft": spectral_regularised_run,
+        "stft-multiscale": spectral_multiscale_run,
         "additive-inharmonic": inharmonic_run,
         "additive-freq_harmonic": freq_harmonic_run,
         "additive-full_harmonic": full_harmonic_run,
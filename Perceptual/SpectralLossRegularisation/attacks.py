@@ -7,16 +7,16 @@ from cleverspeech.graph import Constraints
 from cleverspeech.graph import Graphs
 from cleverspeech.graph import Losses
 from cleverspeech.graph import Optimisers
-from cleverspeech.graph import Procedures
 from cleverspeech.graph import Outputs
 from cleverspeech.data import Feeds
 
 from cleverspeech.data.etl.batch_generators import get_standard_batch_generator
-from cleverspeech.data.Results import SingleJsonDB, SingleFileWriter
-from cleverspeech.eval import PerceptualStatsBatch
-from cleverspeech.utils.RuntimeUtils import AttackSpawner
 from cleverspeech.utils.Utils import log, args
 
+from experiments.Common.Batches import get_bucketed_batch_generator
+from experiments.Common.Procedures import FusedUpdateOnDecoding
+from experiments.Common.Runtime import execute
+
 # victim model
 from SecEval import VictimAPI as Victim
 
@@ -45,40 +45,6 @@ NUMB_STEPS = DECODING_STEP ** 2
 BATCH_SIZE = 10
 
 
-def execute(settings, attack_fn, batch_gen):
-
-    # set up the directory we'll use for results
-
-    if not os.path.exists(settings["outdir"]):
-        os.makedirs(settings["outdir"], exist_ok=True)
-
-    file_writer = SingleFileWriter(settings["outdir"])
-
-    # Write the current settings to "settings.json" file.
-
-    settings_db = SingleJsonDB(settings["outdir"])
-    settings_db.open("settings").put(settings)
-    log("Wrote settings.")
-
-    # Manage GPU memory and CPU processes usage.
-
-    attack_spawner = AttackSpawner(
-        gpu_device=settings["gpu_device"],
-        max_processes=settings["max_spawns"],
-        delay=settings["spawn_delay"],
-        file_writer=file_writer,
-    )
-
-    with attack_spawner as spawner:
-        for b_id, batch in batch_gen:
-            log("Running for Batch Number: {}".format(b_id), wrap=True)
-            spawner.spawn(settings, attack_fn, batch)
-
-    # Run the stats function on all successful examples once all attacks
-    # are completed.
-    PerceptualStatsBatch.batch_generate_statistic_file(settings["outdir"])
-
-
 def spectral_run(master_settings):
     """
     """
@@ -114,7 +80,7 @@ def spectral_run(master_settings):
         )
 
         attack.add_procedure(
-            Procedures.UpdateOnDecoding,
+            FusedUpdateOnDecoding,
             steps=settings["nsteps"],
             decode_step=settings["decode_step"]
         )
@@ -151,7 +117,7 @@ def spectral_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
     execute(settings, create_attack_graph, batch_gen)
 
@@ -193,7 +159,7 @@ def multi_scale_l1_spectral_run(master_settings):
         )
 
         attack.add_procedure(
-            Procedures.UpdateOnDecoding,
+            FusedUpdateOnDecoding,
             steps=settings["nsteps"],
             decode_step=settings["decode_step"]
         )
@@ -230,7 +196,7 @@ def multi_scale_l1_spectral_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
     execute(settings, create_attack_graph, batch_gen)
 
@@ -272,7 +238,7 @@ def multi_scale_l2_spectral_run(master_settings):
         )
 
         attack.add_procedure(
-            Procedures.UpdateOnDecoding,
+            FusedUpdateOnDecoding,
             steps=settings["nsteps"],
             decode_step=settings["decode_step"]
         )
@@ -309,7 +275,7 @@ def multi_scale_l2_spectral_run(master_settings):
     }
 
     settings.update(master_settings)
-    batch_gen = get_standard_batch_generator(settings)
+    batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
     execute(settings, create_attack_graph, batch_gen)
 
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Per step benchmarks for the spectral loss regularisation with full length
+batches, comparing the STFT and Parseval versions of the squared magnitude
+loss. Only the spectral loss is optimised (no victim model) so the
+difference isn't hidden by the forward pass.
+
+Usage: python3 benchmarks.py
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from experiments.Common.Spectral import SpectralPlans
+
+
+BATCH_SIZE = 10
+MAX_AUDIO_LENGTH = 120000
+FRAME_SIZES = [128, 512, 2048]
+N_STEPS = 100
+
+
+def time_steps(frame_size, parseval):
+
+    with tf.Graph().as_default():
+
+        audios = tf.constant(
+            np.random.uniform(
+                -2 ** 15, 2 ** 15, (BATCH_SIZE, MAX_AUDIO_LENGTH)
+            ).astype(np.float32)
+        )
+        deltas = tf.Variable(
+            tf.zeros([BATCH_SIZE, MAX_AUDIO_LENGTH], dtype=tf.float32)
+        )
+
+        loss = SpectralPlans().magnitude_mean(
+            audios - deltas,
+            frame_length=frame_size,
+            frame_step=frame_size * 2,
+            fft_length=frame_size,
+            pad_end=True,
+            norm=2,
+            parseval=parseval,
+        )
+
+        train = tf.train.AdamOptimizer(10).minimize(loss, var_list=[deltas])
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+
+            initial = sess.run(loss)
+
+            # warm up
+            sess.run(train)
+
+            start = time.time()
+            for _ in range(N_STEPS):
+                sess.run(train)
+
+            return (time.time() - start) / N_STEPS, initial
+
+
+def spectral_benchmarks():
+
+    print("Spectral loss steps for a {} x {} batch:".format(
+        BATCH_SIZE, MAX_AUDIO_LENGTH
+    ))
+
+    for frame_size in FRAME_SIZES:
+
+        np.random.seed(0)
+        stft_t, stft_loss = time_steps(frame_size, parseval=False)
+
+        np.random.seed(0)
+        parseval_t, parseval_loss = time_steps(frame_size, parseval=True)
+
+        print("{:>6} frames: stft {:8.2f} ms, parseval {:8.2f} ms".format(
+            frame_size, stft_t * 1e3, parseval_t * 1e3
+        ))
+
+        assert np.allclose(stft_loss, parseval_loss, rtol=1e-4)
+
+
+if __name__ == '__main__':
+    spectral_benchmarks()
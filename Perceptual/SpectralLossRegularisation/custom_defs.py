@@ -1,79 +1,98 @@
 import tensorflow as tf
 
+from experiments.Common.Spectral import get_plans
+
+
+def audio_minus_deltas(attack_graph):
+    x = attack_graph.graph.placeholders.audios
+    d = attack_graph.graph.final_deltas
+    return get_plans(attack_graph).signal("audio-deltas", lambda: x - d)
+
 
 class SpectralLoss(object):
-    def __init__(self, attack_graph, frame_size=512, norm=2, loss_weight=10.0e-7):
+    def __init__(self, attack_graph, frame_size=512, norm=2, loss_weight=10.0e-7, parseval=True):
 
-        x = attack_graph.graph.placeholders.audios
-        d = attack_graph.graph.final_deltas
+        plans = get_plans(attack_graph)
 
-        self.spectrogram_diff = tf.signal.stft(
-            signals=x - d,
+        self.mag_loss_fn = plans.magnitude_mean(
+            audio_minus_deltas(attack_graph),
             frame_length=int(frame_size),
             frame_step=int(frame_size * 2),
             fft_length=int(frame_size),
-            pad_end=True
+            pad_end=True,
+            norm=norm,
+            parseval=parseval,
         )
-
-        self.magnitude_diff = tf.cast(tf.abs(self.spectrogram_diff), tf.float32)
-        self.mag_loss_fn = tf.reduce_mean(self.magnitude_diff ** norm, axis=[1, 2])
         self.loss_fn = loss_weight * self.mag_loss_fn
 
 
 class NormalisedSpectralLoss(object):
-    def __init__(self, attack_graph, frame_size=128, overlap=0.75, norm=2, loss_weight=100.0):
+    def __init__(self, attack_graph, frame_size=128, overlap=0.75, norm=2, loss_weight=100.0, parseval=True):
 
         x = attack_graph.graph.placeholders.audios
         d = attack_graph.graph.final_deltas
 
-        self.spectrogram_orig = tf.signal.stft(
-            signals=x,
+        self.sess = attack_graph.sess
+        self.audios = x
+
+        plans = get_plans(attack_graph)
+
+        self.mag_norm_delta = plans.magnitude_mean(
+            d,
             frame_length=int(frame_size),
-            frame_step=int(frame_size * 2),
+            frame_step=int(frame_size * 2 * overlap),
             fft_length=int(frame_size),
-            pad_end=False
+            pad_end=False,
+            norm=norm,
+            parseval=parseval,
         )
 
-        self.spectrogram_delta = tf.signal.stft(
-            signals=d,
+        # The original audio doesn't change during the attack, so calculate its
+        # norm once per batch and feed it in instead of running the original
+        # audio's STFT with every optimisation step.
+        self.orig_norm_fn = plans.magnitude_mean(
+            x,
             frame_length=int(frame_size),
-            frame_step=int(frame_size * 2 * overlap),
+            frame_step=int(frame_size * 2),
             fft_length=int(frame_size),
-            pad_end=False
+            pad_end=False,
+            norm=norm,
+            parseval=parseval,
+        )
+        self.mag_norm_orig = tf.placeholder_with_default(
+            self.original_norms(attack_graph.batch),
+            shape=[attack_graph.batch.size],
+            name="mag_norm_orig"
         )
 
-        self.magnitude_orig = tf.cast(tf.abs(self.spectrogram_orig), tf.float32)
-        self.magnitude_delta = tf.cast(tf.abs(self.spectrogram_delta), tf.float32)
-
-        self.mag_norm_delta = tf.reduce_mean(self.magnitude_delta ** norm, axis=[1, 2])
-        self.mag_norm_orig = tf.reduce_mean(self.magnitude_orig ** norm, axis=[1, 2])
         # dividing at the reduced mean stage avoids us accidentally dividing by
         # zero if we were to have a zero valued original frame.
         self.mag_loss_fn = self.mag_norm_delta / self.mag_norm_orig
 
         self.loss_fn = loss_weight * self.mag_loss_fn
 
+    def original_norms(self, batch):
+        return self.sess.run(
+            self.orig_norm_fn,
+            feed_dict={self.audios: batch.audios["padded_audio"]}
+        )
 
-class MultiScaleSpectralLoss(object):
-    def __init__(self, attack_graph, frame_size=512, norm=1, loss_weight=1.0):
+    def extra_feeds(self, batch):
+        return {self.mag_norm_orig: self.original_norms(batch)}
 
-        x = attack_graph.graph.placeholders.audios
-        d = attack_graph.graph.final_deltas
 
-        self.spectrogram_diff = tf.signal.stft(
-            signals=x - d,
-            frame_length=int(frame_size),
-            frame_step=int(frame_size * 2),
-            fft_length=int(frame_size),
-            pad_end=True
-        )
+class MultiScaleSpectralLoss(object):
+    def __init__(self, attack_graph, frame_sizes=(128, 256, 512, 1024, 2048), norm=1, loss_weight=1.0, max_ratio=4, parseval=True):
 
-        self.magnitude_diff = tf.cast(tf.abs(self.spectrogram_diff), tf.float32)
-        self.log_magnitude_diff = tf.log(self.magnitude_diff + 10.0e-10)
+        plans = get_plans(attack_graph)
 
-        self.mag_loss_fn = tf.reduce_mean(self.magnitude_diff ** norm, axis=[1, 2])
-        self.log_mag_loss_fn = tf.reduce_mean(self.log_magnitude_diff ** norm, axis=[1, 2])
+        self.mag_loss_fn = plans.multi_scale_magnitude_mean(
+            audio_minus_deltas(attack_graph),
+            frame_sizes=frame_sizes,
+            pad_end=True,
+            norm=norm,
+            max_ratio=max_ratio,
+            parseval=parseval,
+        )
 
         self.loss_fn = loss_weight * self.mag_loss_fn
-
-
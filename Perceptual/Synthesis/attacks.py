@@ -12,11 +12,11 @@ from cleverspeech.graph import Outputs
 from cleverspeech.data import Feeds
 
 from cleverspeech.data.etl.batch_generators import get_standard_batch_generator
-from cleverspeech.data.Results import SingleJsonDB, SingleFileWriter
-from cleverspeech.eval import PerceptualStatsBatch
-from cleverspeech.utils.RuntimeUtils import AttackSpawner
 from cleverspeech.utils.Utils import log, args, lcomp
 
+from experiments.Common.Batches import get_bucketed_batch_generator
+from experiments.Common.Optimisers import BatchwiseAdamOptimiser
+from experiments.Common.Runtime import execute
 from experiments.Perceptual.Synthesis.Synthesisers import Spectral, \
     DeterministicPlusNoise, Additive
 
@@ -38,6 +38,7 @@ MAX_AUDIO_LENGTH = 120000
 TOKENS = " abcdefghijklmnopqrstuvwxyz'-"
 BEAM_WIDTH = 500
 LEARNING_RATE = 10
+OPTIMISER = "adam"
 CONSTRAINT_UPDATE = "geom"
 RESCALE = 0.95
 DECODING_STEP = 100
@@ -71,39 +72,12 @@ SYNTHS = {
     "stft": Spectral.STFT,
 }
 
-
-def execute(settings, attack_fn, batch_gen):
-
-    # set up the directory we'll use for results
-
-    if not os.path.exists(settings["outdir"]):
-        os.makedirs(settings["outdir"], exist_ok=True)
-
-    file_writer = SingleFileWriter(settings["outdir"])
-
-    # Write the current settings to "settings.json" file.
-
-    settings_db = SingleJsonDB(settings["outdir"])
-    settings_db.open("settings").put(settings)
-    log("Wrote settings.")
-
-    # Manage GPU memory and CPU processes usage.
-
-    attack_spawner = AttackSpawner(
-        gpu_device=settings["gpu_device"],
-        max_processes=settings["max_spawns"],
-        delay=settings["spawn_delay"],
-        file_writer=file_writer,
-    )
-
-    with attack_spawner as spawner:
-        for b_id, batch in batch_gen:
-            log("Running for Batch Number: {}".format(b_id), wrap=True)
-            spawner.spawn(settings, attack_fn, batch)
-
-    # Run the stats function on all successful examples once all attacks
-    # are completed.
-    PerceptualStatsBatch.batch_generate_statistic_file(settings["outdir"])
+# "batchwise_adam" keeps separate Adam state for every example so padding and
+# other examples in the batch don't slow down optimising the shorter ones.
+OPTIMISERS = {
+    "adam": Optimisers.AdamOptimiser,
+    "batchwise_adam": BatchwiseAdamOptimiser,
+}
 
 
 def create_attack_graph(sess, batch, settings):
@@ -135,7 +109,7 @@ def create_attack_graph(sess, batch, settings):
     attack.create_loss_fn()
 
     attack.add_optimiser(
-        Optimisers.AdamOptimiser,
+        OPTIMISERS[settings["optimiser"]],
         learning_rate=settings["learning_rate"]
     )
 
@@ -176,6 +150,7 @@ def inharmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": ADDITIVE_INITIAL_HZ,
@@ -192,7 +167,7 @@ def inharmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -221,6 +196,7 @@ def freq_harmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": ADDITIVE_INITIAL_HZ,
@@ -237,7 +213,7 @@ def freq_harmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -266,6 +242,7 @@ def full_harmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": ADDITIVE_INITIAL_HZ,
@@ -282,7 +259,7 @@ def full_harmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -311,6 +288,7 @@ def detnoise_inharmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": ADDITIVE_INITIAL_HZ,
@@ -327,7 +305,7 @@ def detnoise_inharmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -355,6 +333,7 @@ def detnoise_freq_harmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": ADDITIVE_INITIAL_HZ,
@@ -371,7 +350,7 @@ def detnoise_freq_harmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -400,6 +379,7 @@ def detnoise_full_harmonic_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": LEARNING_RATE,
+            "optimiser": OPTIMISER,
             "synth": {
                 "n_osc": ADDITIVE_N_OSC,
                 "initial_hz": ADDITIVE_INITIAL_HZ,
@@ -416,7 +396,7 @@ def detnoise_full_harmonic_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
@@ -455,6 +435,7 @@ def spectral_run(master_settings):
             "constraint_update": CONSTRAINT_UPDATE,
             "rescale": RESCALE,
             "learning_rate": 100,
+            "optimiser": OPTIMISER,
             "synth": {
                 "frame_step": run,
                 "frame_length": run,
@@ -469,7 +450,7 @@ def spectral_run(master_settings):
         }
 
         settings.update(master_settings)
-        batch_gen = get_standard_batch_generator(settings)
+        batch_gen = get_bucketed_batch_generator(get_standard_batch_generator, settings)
 
         execute(settings, create_attack_graph, batch_gen)
 
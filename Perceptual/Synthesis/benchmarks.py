@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Start up benchmarks for synthesis attacks with full length batches.
+
+Usage: python3 benchmarks.py
+"""
+import time
+
+from types import SimpleNamespace
+
+import numpy as np
+import tensorflow as tf
+
+from experiments.Perceptual.Synthesis.Synthesisers import Additive
+
+
+BATCH_SIZE = 10
+MAX_AUDIO_LENGTH = 120000
+N_OSC = 64
+FRAME_LENGTH = 128
+FRAME_STEP = 128
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return time.time() - start, result
+
+
+def looped_masks(lengths, max_len):
+    """
+    Python loop mask generation, one list append per sample.
+    """
+    masks = list()
+    for l in lengths:
+        m = list()
+        for i in range(max_len):
+            if i < l:
+                m.append(1)
+            else:
+                m.append(0)
+        masks.append(m)
+    return np.array(masks, dtype=np.float32)
+
+
+def broadcast_masks(lengths, max_len):
+    lengths = np.asarray(lengths)[:, np.newaxis]
+    return (np.arange(max_len)[np.newaxis, :] < lengths).astype(np.float32)
+
+
+def graph_masks(lengths, max_len):
+    with tf.Graph().as_default():
+        lengths = tf.placeholder_with_default(
+            np.asarray(lengths, dtype=np.int32), shape=[len(lengths)]
+        )
+        masks = tf.sequence_mask(lengths, maxlen=max_len, dtype=tf.float32)
+        with tf.Session() as sess:
+            return sess.run(masks)
+
+
+def mask_benchmarks():
+
+    lengths = np.random.randint(
+        MAX_AUDIO_LENGTH // 2, MAX_AUDIO_LENGTH, BATCH_SIZE
+    )
+    lengths[0] = MAX_AUDIO_LENGTH
+
+    print("Padding masks for a {} x {} batch:".format(BATCH_SIZE, MAX_AUDIO_LENGTH))
+
+    reference = None
+
+    for name, fn in [
+        ("python loops", looped_masks),
+        ("numpy broadcast", broadcast_masks),
+        ("tf.sequence_mask", graph_masks),
+    ]:
+        t, masks = timed(fn, lengths, MAX_AUDIO_LENGTH)
+        print("{:>20}: {:10.2f} ms".format(name, t * 1e3))
+
+        if reference is None:
+            reference = masks
+        assert np.array_equal(reference, masks)
+
+
+def looped_hz(batch_size, n_frames, n_osc, initial_hz):
+    """
+    Python loop frequency initialisation, one list append per frame.
+    """
+    hz = list()
+    for _ in range(batch_size):
+        a = list()
+        rand = np.random.uniform(0.1, 1.0, n_osc)
+        for _ in range(n_frames):
+            a.append(initial_hz * np.ones(n_osc) * rand)
+        hz.append(a)
+    return np.array(hz, dtype=np.float32)
+
+
+def fake_batch():
+    lengths = np.random.randint(
+        MAX_AUDIO_LENGTH // 2, MAX_AUDIO_LENGTH, BATCH_SIZE
+    )
+    lengths[0] = MAX_AUDIO_LENGTH
+    audios = np.random.uniform(-2 ** 15, 2 ** 15, (BATCH_SIZE, MAX_AUDIO_LENGTH))
+    return SimpleNamespace(
+        size=BATCH_SIZE,
+        audios={
+            "max_samples": MAX_AUDIO_LENGTH,
+            "n_samples": lengths,
+            "padded_audio": audios.astype(np.float32),
+        }
+    )
+
+
+def construct_synth(batch, initialiser):
+    with tf.Graph().as_default():
+        return Additive.InHarmonic(
+            batch,
+            n_osc=N_OSC,
+            frame_length=FRAME_LENGTH,
+            frame_step=FRAME_STEP,
+            initialiser=initialiser,
+        )
+
+
+def initialiser_benchmarks():
+
+    batch = fake_batch()
+    n_frames = ((MAX_AUDIO_LENGTH - FRAME_LENGTH) // FRAME_STEP) + 1
+
+    print("Frequency initialisation for a {} x {} x {} synth:".format(
+        BATCH_SIZE, n_frames, N_OSC
+    ))
+
+    np.random.seed(0)
+    t, looped = timed(looped_hz, BATCH_SIZE, n_frames, N_OSC, 440)
+    print("{:>20}: {:10.2f} ms".format("python loops", t * 1e3))
+
+    np.random.seed(0)
+    t, vectorised = timed(
+        Additive.uniform_init, batch, n_frames, N_OSC, 440
+    )
+    print("{:>20}: {:10.2f} ms".format("uniform_init", t * 1e3))
+    assert np.allclose(looped, vectorised)
+
+    for name in Additive.INITIALISERS:
+        t, _ = timed(construct_synth, batch, name)
+        print("{:>20}: {:10.2f} ms".format("InHarmonic " + name, t * 1e3))
+
+
+if __name__ == '__main__':
+    mask_benchmarks()
+    initialiser_benchmarks()
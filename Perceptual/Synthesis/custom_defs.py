@@ -3,7 +3,10 @@ import numpy as np
 
 from cleverspeech.graph.Placeholders import Placeholders
 from cleverspeech.graph.Procedures import UpdateOnDecoding, UpdateOnLoss
-from cleverspeech.utils.Utils import np_arr, np_zero, np_one, lcomp
+
+from experiments.Common.Procedures import AsyncDecode, Checkpoints, \
+    RetireAndRefill
+from experiments.Common.Spectral import get_plans
 
 
 class SynthesisAttack:
@@ -27,12 +30,19 @@ class SynthesisAttack:
 
         self.placeholders = Placeholders(batch_size, max_len)
 
-        self.masks = tf.Variable(
-            tf.zeros([batch_size, max_len]),
-            trainable=False,
-            validate_shape=True,
+        # Mask value == 1 when actual < max, == 0 when actual > max.
+        # Generated in graph from the actual lengths so there's no need to
+        # build and assign a [batch size, max_len] mask before the attack runs.
+        self.lengths = tf.placeholder_with_default(
+            np.asarray(act_lengths, dtype=np.int32),
+            shape=[batch_size],
+            name='qq_lengths'
+        )
+
+        self.masks = tf.sequence_mask(
+            self.lengths,
+            maxlen=max_len,
             dtype=tf.float32,
-            name='qq_masks'
         )
 
         self.synthesiser = synthesiser
@@ -64,63 +74,75 @@ class SynthesisAttack:
             clip_value_max=upper
         )
 
-        # initialise static variables
-        initial_masks = np_arr(
-            lcomp(self._gen_mask(act_lengths, max_len)),
-            np.float32
-        )
+        self.opt_vars = synthesiser.opt_vars
 
-        sess.run(self.masks.assign(initial_masks))
+    def extra_feeds(self, batch):
+        """
+        Feed the padding mask lengths (and anything the synthesiser built from
+        the batch), in case the batch's examples have been swapped out since
+        the graph was built.
+        """
+        feeds = {self.lengths: np.asarray(batch.audios["n_samples"], np.int32)}
 
-        self.opt_vars = synthesiser.opt_vars
+        if hasattr(self.synthesiser, "extra_feeds"):
+            feeds.update(self.synthesiser.extra_feeds(batch))
 
+        return feeds
 
-    @staticmethod
-    def _gen_mask(lengths, max_len):
-        """
-        Generate the zero / one valued mask for the perturbations in a batch
-        Mask value == 1 when actual < max, == 0 when actual > max
 
-        :param lengths: number of samples per audio example in a batch
-        :param max_len: maximum numb. of samples of audio examples in a batch
-        :yield: 0/1 valued mask vector of length max_len
-        """
-        for l in lengths:
-            m = list()
-            for i in range(max_len):
-                if i < l:
-                    m.append(1)
-                else:
-                    m.append(0)
-            yield m
+def frame_lengths(batch, name):
+    """
+    Number of frames of each example, as a placeholder defaulting to the
+    batch's values so refilled examples can feed their own (see
+    `extra_feeds`).
+    """
+    return tf.placeholder_with_default(
+        np.asarray(batch.audios["ds_feats"], dtype=np.float32),
+        shape=[batch.size],
+        name=name,
+    )
+
+
+class FrameLengthFeeds(object):
+    """
+    Feeds the `n_frames` placeholder of a loss built with `frame_lengths`.
+    """
+    def extra_feeds(self, batch):
+        return {
+            self.n_frames: np.asarray(batch.audios["ds_feats"], np.float32)
+        }
 
 
-class AdditiveAmplitudeLoss(object):
+class AdditiveAmplitudeLoss(FrameLengthFeeds):
     def __init__(self, attack_graph, loss_weight=1.0):
 
         g, b = attack_graph, attack_graph.batch
 
         assert b.audios["ds_feats"].all() > 0
 
+        self.n_frames = frame_lengths(b, "amplitude_loss_n_frames")
+
         self.loss_fn = tf.reduce_sum(
             tf.abs(g.synthesis.amplitude_deltas),
             axis=[1, 2]
         )
-        self.loss_fn = self.loss_fn * loss_weight / b.audios["ds_feats"]
+        self.loss_fn = self.loss_fn * loss_weight / self.n_frames
 
 
-class AdditiveEnergyLoss(object):
+class AdditiveEnergyLoss(FrameLengthFeeds):
     def __init__(self, attack_graph, loss_weight=1.0):
 
         g, b = attack_graph, attack_graph.batch
 
         assert b.audios["ds_feats"].all() > 0
 
+        self.n_frames = frame_lengths(b, "energy_loss_n_frames")
+
         self.loss_fn = tf.reduce_sum(
             tf.square(g.synthesis.amplitude_deltas),
             axis=[1, 2]
         )
-        self.loss_fn = self.loss_fn * loss_weight / b.audios["ds_feats"]
+        self.loss_fn = self.loss_fn * loss_weight / self.n_frames
 
 
 class DetNoiseRMSRatioLoss(object):
@@ -146,10 +168,58 @@ class SpectralLoss(object):
         self.loss_fn = loss_weight * self.mag_loss_fn
 
 
-class UpdateOnDecodingSynth(UpdateOnDecoding):
+class MultiScaleSpectralLoss(object):
+    def __init__(self, attack, frame_sizes=(512,), norm: int = 2, loss_weight: float = 1e-3, max_ratio: int = 4):
+        """
+        Spectral magnitude of the final perturbation at several resolutions
+        in one graph (the FFTs are batched where the frame sizes allow).
+        """
+        plans = get_plans(attack)
+
+        self.mag_loss_fn = plans.multi_scale_magnitude_mean(
+            attack.graph.final_deltas,
+            frame_sizes=frame_sizes,
+            pad_end=True,
+            norm=norm,
+            max_ratio=max_ratio,
+        )
+
+        self.loss_fn = loss_weight * self.mag_loss_fn
+
+
+class SingleDecode(object):
+    """
+    Mixin for procedures that need both the top one and top five decodings.
+
+    The top decoding is the first of the top five beams, so the beam search
+    only needs to run once per decode step.
+    """
+
+    def decode(self):
+        """
+        :return: decodings, probs, top five decodings, top five probs
+        """
+
+        top_5_decodings, top_5_probs = self.attack.victim.inference(
+            self.attack.batch,
+            feed=self.attack.feeds.attack,
+            decoder="batch",
+            top_five=True,
+        )
+
+        decodings = [d[0] for d in top_5_decodings]
+        probs = [p[0] for p in top_5_probs]
+
+        return decodings, probs, top_5_decodings, top_5_probs
+
+
+class UpdateOnDecodingSynth(RetireAndRefill, AsyncDecode, Checkpoints, SingleDecode, UpdateOnDecoding):
 
     def decode_step_logic(self):
 
+        if self.decode_pool is not None:
+            return self.async_decode_step_logic()
+
         # we can't do the rounding for synthesis attack unfortunately.
         # (at least I don't think so? maybe it's just slightly more complex?)
 
@@ -166,19 +236,7 @@ class UpdateOnDecodingSynth(UpdateOnDecoding):
         # keep the top 5 scoring decodings and their probabilities as that might
         # be useful come analysis time...
 
-        top_5_decodings, top_5_probs = self.attack.victim.inference(
-            self.attack.batch,
-            feed=self.attack.feeds.attack,
-            decoder="batch",
-            top_five=True,
-        )
-
-        decodings, probs = self.attack.victim.inference(
-            self.attack.batch,
-            feed=self.attack.feeds.attack,
-            decoder="batch",
-            top_five=False,
-        )
+        decodings, probs, top_5_decodings, top_5_probs = self.decode()
 
         targets = self.attack.batch.targets["phrases"]
 
@@ -199,25 +257,23 @@ class UpdateOnDecodingSynth(UpdateOnDecoding):
         }
 
 
-class UpdateOnLossSynth(UpdateOnLoss):
+class UpdateOnLossSynth(AsyncDecode, SingleDecode, UpdateOnLoss):
+
+    def snapshot_values(self):
+        return {"loss": self.tf_run(self.attack.loss_fn)}
+
+    def success_inputs(self, snapshot, decodings):
+        target_loss = [self.loss_bound for _ in range(self.attack.batch.size)]
+        return snapshot["values"]["loss"], target_loss
 
     def decode_step_logic(self):
 
-        loss = self.tf_run(self.attack.loss_fn)
+        if self.decode_pool is not None:
+            return self.async_decode_step_logic()
 
-        top_5_decodings, top_5_probs = self.attack.victim.inference(
-            self.attack.batch,
-            feed=self.attack.feeds.attack,
-            decoder="batch",
-            top_five=True,
-        )
+        loss = self.tf_run(self.attack.loss_fn)
 
-        decodings, probs = self.attack.victim.inference(
-            self.attack.batch,
-            feed=self.attack.feeds.attack,
-            decoder="batch",
-            top_five=False,
-        )
+        decodings, probs, top_5_decodings, top_5_probs = self.decode()
 
         target_loss = [self.loss_bound for _ in range(self.attack.batch.size)]
         targets = self.attack.batch.targets["phrases"]
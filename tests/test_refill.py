@@ -0,0 +1,170 @@
+import types
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("cleverspeech")
+
+from experiments.Common.Batches import copy_example, select_examples
+from experiments.Common.Procedures import RetireAndRefill, \
+    check_refeedable, example_variables, refeed
+from experiments.Perceptual.Synthesis import custom_defs
+from experiments.Perceptual.Synthesis.Synthesisers.Additive import \
+    FullyHarmonic, pitch_init
+
+
+SAMPLE_RATE = 16000
+MAX_SAMPLES = 4096
+FRAME_LENGTH = 512
+INITIAL_HZ = 440
+
+
+class Batch(object):
+    def __init__(self, pitches, lengths):
+        """
+        Sine waves of a fixed pitch, zero padded to `MAX_SAMPLES`.
+        """
+        samples = np.arange(MAX_SAMPLES)
+        audios = [
+            np.where(
+                samples < n,
+                1e4 * np.sin(2 * np.pi * hz * samples / SAMPLE_RATE),
+                0,
+            )
+            for hz, n in zip(pitches, lengths)
+        ]
+
+        self.size = len(pitches)
+        self.audios = {
+            "padded_audio": np.asarray(audios, dtype=np.float32),
+            "n_samples": np.asarray(lengths),
+            "max_samples": MAX_SAMPLES,
+            "ds_feats": np.asarray(lengths) // 320,
+            "basenames": ["{}hz".format(hz) for hz in pitches],
+        }
+        self.targets = {"phrases": ["target"] * self.size}
+
+
+class Clip(object):
+    @staticmethod
+    def clip(x):
+        return x
+
+
+class Attack(object):
+    def __init__(self, sess, batch, graph):
+        self.sess = sess
+        self.batch = batch
+        self.graph = graph
+        self.optimiser = object()
+        self.loss = []
+        self.create_feeds()
+
+    def create_feeds(self):
+        self.feeds = types.SimpleNamespace(attack=dict())
+
+
+def expected_freqs(batch, n_frames):
+    return pitch_init(
+        batch, n_frames, 1, INITIAL_HZ,
+        frame_length=FRAME_LENGTH,
+        frame_step=FRAME_LENGTH,
+        sample_rate=SAMPLE_RATE,
+    )
+
+
+def test_refilled_rows_are_padded_with_zeros():
+
+    batch = Batch([200, 300], [MAX_SAMPLES, 3000])
+    wide = Batch([200, 300], [MAX_SAMPLES, MAX_SAMPLES])
+
+    # a one example batch whose last sample is real audio
+    example = select_examples(batch, [0])
+
+    assert copy_example(wide, 1, example, 0)
+    assert np.array_equal(wide.audios["padded_audio"][1], batch.audios["padded_audio"][0])
+
+    short = select_examples(batch, [1])
+
+    assert copy_example(wide, 0, short, 0)
+    assert np.all(wide.audios["padded_audio"][0, 3000:] == 0)
+
+
+def test_pitch_initialised_rows_are_reset_for_refilled_examples():
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+
+        batch = Batch([200, 300], [MAX_SAMPLES, 3000])
+
+        synth = FullyHarmonic(
+            batch,
+            n_osc=4,
+            frame_length=FRAME_LENGTH,
+            frame_step=FRAME_LENGTH,
+            sample_rate=SAMPLE_RATE,
+            initial_hz=INITIAL_HZ,
+            initialiser="pitch",
+        )
+        graph = custom_defs.SynthesisAttack(sess, batch, Clip(), synth)
+        attack = Attack(sess, batch, graph)
+
+        sess.run(tf.global_variables_initializer())
+        check_refeedable(attack)
+
+        before = sess.run(synth.freq_deltas)
+        assert np.allclose(before, expected_freqs(batch, synth.n_frames))
+
+        refill = Batch([120], [2000])
+        assert copy_example(attack.batch, 0, refill, 0)
+
+        refeed(attack)
+
+        procedure = types.SimpleNamespace(
+            attack=attack, reset_vars=example_variables(attack)
+        )
+        RetireAndRefill.reset_examples(procedure, [0])
+
+        after = sess.run(synth.freq_deltas)
+        expected = expected_freqs(attack.batch, synth.n_frames)
+
+        assert np.allclose(after[0], expected[0])
+        assert not np.allclose(after[0], before[0])
+        assert np.allclose(after[1], before[1])
+
+
+def test_graphs_with_constant_initial_values_are_refused():
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+
+        batch = Batch([200, 300], [MAX_SAMPLES, 3000])
+        n_frames = MAX_SAMPLES // FRAME_LENGTH
+
+        freqs = tf.Variable(expected_freqs(batch, n_frames), name="qq_freq")
+        graph = types.SimpleNamespace(opt_vars=[freqs])
+        attack = Attack(sess, batch, graph)
+
+        with pytest.raises(ValueError):
+            check_refeedable(attack)
+
+
+def test_graphs_assigning_variables_after_initialisation_are_refused():
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+
+        batch = Batch([200, 300], [MAX_SAMPLES, 3000])
+
+        deltas = tf.Variable(tf.zeros([batch.size, MAX_SAMPLES]), name="qq_delta")
+        bounds = tf.Variable(
+            tf.zeros([batch.size, 1]), trainable=False, name="qq_bounds"
+        )
+        graph = types.SimpleNamespace(opt_vars=[deltas])
+        attack = Attack(sess, batch, graph)
+
+        sess.run(tf.global_variables_initializer())
+        check_refeedable(attack)
+
+        bounds.load(np.asarray([[1.0], [2.0]]), sess)
+
+        with pytest.raises(ValueError):
+            check_refeedable(attack)